@@ -0,0 +1,969 @@
+"""
+Benchmarks for ztraining. Run from the tests directory:
+
+    python bench_ztraining.py [benchmark ...]
+
+Without arguments, all benchmarks are run.
+"""
+import asyncio
+from collections import OrderedDict
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+from xml.dom import minidom
+
+from fitparse import FitFile
+import numpy as np
+import pandas as pd
+import pytz
+from zwift.activity import Activity, decode_fit_file, process_fit_data
+from zwift.request import download_file
+
+if True:
+    sys.path.insert(0, os.path.abspath('..'))
+    from ztraining import ActivityStore, FTPHistory, ZwiftSession, ZwiftTraining
+    from ztraining.ztraining import xml_get_text, xml_path_val
+
+
+SAMPLE_DIR = 'tcx_gpx_fit_files'
+BENCH_DIR = 'bench-ztraining-data'
+
+
+def timeit(func, repeat=5):
+    """
+    Returns the best time of several runs of func, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def sample_files(extensions=('tcx', 'gpx', 'fit')):
+    files = [os.path.join(SAMPLE_DIR, f) for f in sorted(os.listdir(SAMPLE_DIR))]
+    return [f for f in files if f.split('.')[-1].lower() in extensions]
+
+
+def bench_activity_store():
+    """
+    Load time and disk size of the activity storage formats.
+    """
+    activities = [ZwiftTraining.parse_file(file) for file in sample_files()]
+    rows = []
+    for fmt in ['csv', 'npz', 'parquet']:
+        activities_dir = os.path.join(BENCH_DIR, fmt)
+        shutil.rmtree(activities_dir, ignore_errors=True)
+        store = ActivityStore.create(fmt, activities_dir)
+        try:
+            for df, meta in activities:
+                store.save(df, meta['dtime'])
+        except ImportError as e:
+            print(f'Skipping {fmt}: {str(e).splitlines()[0]}')
+            continue
+
+        dtimes = store.list_dtimes()
+        load_time = timeit(lambda: [store.load(dtime) for dtime in dtimes])
+        size = sum([os.path.getsize(store.path(dtime)) for dtime in dtimes])
+        rows.append(dict(format=fmt, activities=len(dtimes), load_time=load_time, size=size))
+
+    df = pd.DataFrame(rows).set_index('format')
+    df['load_time_vs_csv'] = (df['load_time'] / df.loc['csv', 'load_time']).round(3)
+    df['size_vs_csv'] = (df['size'] / df.loc['csv', 'size']).round(3)
+    print(df)
+
+
+def bench_import_files(workers_list=(1, 2, 4)):
+    """
+    Throughput of import_files() with different number of worker processes.
+    """
+    files = sample_files()
+    rows = []
+    for workers in workers_list:
+        profile_dir = os.path.join(BENCH_DIR, f'import-{workers}')
+        conf_file = os.path.join(BENCH_DIR, f'import-{workers}.json')
+        with open(conf_file, 'w') as f:
+            json.dump({'dir': profile_dir}, f)
+
+        def run():
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            zt = ZwiftTraining(conf_file, quiet=True)
+            zt.import_files(SAMPLE_DIR, workers=workers, quiet=True)
+
+        elapsed = timeit(run, repeat=2)
+        rows.append(dict(workers=workers, files=len(files), time=elapsed, files_per_sec=len(files)/elapsed))
+
+    print(pd.DataFrame(rows).set_index('workers').round(3))
+
+
+def bench_import_window(from_dtime='2020-05-17', to_dtime='2020-05-17'):
+    """
+    Time of import_files() of the sample files with a date range, parsing every file
+    (without probe_file()) vs only the files whose start time is in the range.
+    """
+    profile_dir = os.path.join(BENCH_DIR, 'import-window')
+    conf_file = os.path.join(BENCH_DIR, 'import-window.json')
+    with open(conf_file, 'w') as f:
+        json.dump({'dir': profile_dir}, f)
+        
+    def run():
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        zt = ZwiftTraining(conf_file, quiet=True)
+        return zt.import_files(SAMPLE_DIR, from_dtime=from_dtime, to_dtime=to_dtime, quiet=True)
+    
+    with mock.patch.object(ZwiftTraining, 'probe_file', return_value=OrderedDict(dtime=None)):
+        n_updates = run()
+        rows = [dict(mode='parse all', time=timeit(run, repeat=2))]
+    assert run() == n_updates
+    rows.append(dict(mode='probe_file', time=timeit(run, repeat=2)))
+    print(f'{len(sample_files())} files, {n_updates} in {from_dtime} - {to_dtime}')
+    print(pd.DataFrame(rows).set_index('mode').round(3))
+
+
+def bench_import_incremental(n_copies=100):
+    """
+    Time of repeated import_files() of an export folder holding the sample files and 
+    n_copies copies of each sample FIT file (duplicates of the imported activities), 
+    with and without the import manifest.
+    """
+    profile_dir = os.path.join(BENCH_DIR, 'import-incremental')
+    conf_file = os.path.join(BENCH_DIR, 'import-incremental.json')
+    with open(conf_file, 'w') as f:
+        json.dump({'dir': profile_dir}, f)
+    export_dir = os.path.join(BENCH_DIR, 'import-incremental-export')
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.makedirs(export_dir)
+    for file in sample_files():
+        shutil.copy2(file, export_dir)
+        if file.lower().endswith('.fit'):
+            for i in range(n_copies):
+                shutil.copy2(file, os.path.join(export_dir, f'copy{i}-{os.path.basename(file)}'))
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    
+    zt = ZwiftTraining(conf_file, quiet=True)
+    t0 = time.perf_counter()
+    n_updates = zt.import_files(export_dir, quiet=True)
+    rows = [dict(mode='first import', time=time.perf_counter() - t0)]
+    
+    def run_without_manifest():
+        os.remove(zt.import_manifest_file)
+        return zt.import_files(export_dir, quiet=True)
+    
+    def run():
+        return zt.import_files(export_dir, quiet=True)
+    
+    assert run_without_manifest() == 0 and run() == 0
+    rows.append(dict(mode='reimport, no manifest', time=timeit(run_without_manifest, repeat=3)))
+    rows.append(dict(mode='reimport', time=timeit(run, repeat=3)))
+    print(f'{len(os.listdir(export_dir))} files, {n_updates} imported, {len(zt.get_activities())} activities')
+    print(pd.DataFrame(rows).set_index('mode').round(3))
+    
+    
+def make_profile(name, n_activities=200, path=os.path.join(SAMPLE_DIR, '4944741403.fit')):
+    """
+    Create a profile containing copies of a sample activity, one every day, and an
+    FTP update every 30 days. Returns the configuration file of the profile.
+    """
+    profile_dir = os.path.join(BENCH_DIR, name)
+    conf_file = os.path.join(BENCH_DIR, f'{name}.json')
+    with open(conf_file, 'w') as f:
+        json.dump({'dir': profile_dir}, f)
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    
+    df, meta = ZwiftTraining.parse_file(path)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    with zt.catalog.batch():
+        for i in range(n_activities):
+            delta = pd.Timedelta(days=i)
+            meta_copy = OrderedDict(meta, dtime=meta['dtime'] + delta, src_file=f'{i}-{meta["src_file"]}')
+            data = df.copy()
+            data['dtime'] = data['dtime'] + delta
+            zt.save_activity(data, meta_copy, quiet=True)
+    days = range(0, n_activities, 30)
+    pd.DataFrame({'dtime': [meta['dtime'].normalize() + pd.Timedelta(days=d) for d in days],
+                  'ftp': [200 + (d // 30) % 20 for d in days]}).to_csv(zt.zwift_profile_updates_csv, index=False)
+    return conf_file
+
+
+def make_long_tcx(path, hours=10):
+    """
+    Generate TCX file with GPS, HR, cadence, speed and power data every second.
+    """
+    n = int(hours * 3600)
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2013-11-09 05:04:11', tz='UTC')
+    latt = -7.9 + np.cumsum(rng.normal(0, 1e-5, n))
+    long = 112.9 + np.cumsum(rng.normal(0, 1e-5, n))
+    elevation = 500 + np.cumsum(rng.normal(0, 0.3, n))
+    speed = rng.uniform(4, 10, n)
+    distance = np.cumsum(speed)
+    hr = rng.integers(100, 180, n)
+    cadence = rng.integers(60, 100, n)
+    power = rng.integers(50, 400, n)
+    
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" '
+                'xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">\n'
+                '<Activities><Activity Sport="Biking"><Id>2013-11-09T05:04:11Z</Id>\n'
+                '<Lap StartTime="2013-11-09T05:04:11Z"><Calories>5000</Calories><Track>\n')
+        for i in range(n):
+            t = (start + pd.Timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            f.write(f'<Trackpoint><Time>{t}</Time>'
+                    f'<Position><LatitudeDegrees>{latt[i]:.7f}</LatitudeDegrees>'
+                    f'<LongitudeDegrees>{long[i]:.7f}</LongitudeDegrees></Position>'
+                    f'<AltitudeMeters>{elevation[i]:.1f}</AltitudeMeters>'
+                    f'<DistanceMeters>{distance[i]:.1f}</DistanceMeters>'
+                    f'<HeartRateBpm><Value>{hr[i]}</Value></HeartRateBpm>'
+                    f'<Cadence>{cadence[i]}</Cadence>'
+                    f'<Extensions><ns3:TPX><ns3:Speed>{speed[i]:.2f}</ns3:Speed>'
+                    f'<ns3:Watts>{power[i]}</ns3:Watts></ns3:TPX></Extensions></Trackpoint>\n')
+        f.write('</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n')
+
+
+def legacy_parse_tcx_file(path):
+    """
+    The DOM based TCX parser used before the streaming parser, for comparison.
+    """
+    with open(path, 'r') as f:
+        doc = f.read().strip()
+    doc = minidom.parseString(doc)
+    
+    sport = doc.getElementsByTagName('Activities')[0] \
+               .getElementsByTagName('Activity')[0] \
+               .attributes['Sport'].value \
+               .lower()
+    title = xml_path_val(doc, 'Activities|Activity|Notes', '')
+    
+    calories = 0
+    for node in doc.getElementsByTagName('Calories'):
+        s = xml_get_text(node)
+        if s.strip():
+            calories += float(s.strip())
+    if not calories:
+        calories = np.NaN
+    
+    rows = []
+    for trackpoint in doc.getElementsByTagName('Trackpoint'):
+        raw_time = pd.Timestamp(xml_path_val(trackpoint, 'Time'))
+        speed = xml_path_val(trackpoint, 'Speed', np.NaN)
+        if pd.isnull(speed):
+            speed = xml_path_val(trackpoint, 'ns3:Speed', np.NaN)
+        power = xml_path_val(trackpoint, 'Watts', np.NaN)
+        if pd.isnull(power):
+            power = xml_path_val(trackpoint, 'ns3:Watts', np.NaN)
+        rows.append(OrderedDict(dtime=raw_time, 
+                                latt=xml_path_val(trackpoint, 'LatitudeDegrees', np.NaN),
+                                long=xml_path_val(trackpoint, 'LongitudeDegrees', np.NaN),
+                                elevation=xml_path_val(trackpoint, 'AltitudeMeters', np.NaN),
+                                distance=xml_path_val(trackpoint, 'DistanceMeters', np.NaN),
+                                hr=xml_path_val(trackpoint, 'HeartRateBpm|Value', np.NaN),
+                                cadence=xml_path_val(trackpoint, 'Cadence', np.NaN),
+                                speed=speed, power=power, temp=np.NaN))
+        
+    df = pd.DataFrame(rows)
+    df['dtime'] = df['dtime'].dt.tz_convert(pytz.timezone("Asia/Jakarta")).dt.tz_localize(None)
+    df['distance'] = df['distance'].astype('float') / 1000
+    meta = OrderedDict(dtime=df['dtime'].iloc[0], sport=sport, title=title, 
+                       src_file=os.path.split(path)[-1], route='', bike='', 
+                       wheel='', note='', calories=calories)
+    return ZwiftTraining._process_activity(df, meta, copy=False)
+
+
+def make_long_gpx(path, hours=10):
+    """
+    Generate GPX file with Garmin TrackPointExtension and power data every second.
+    """
+    n = int(hours * 3600)
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2019-01-26 00:41:53', tz='UTC')
+    latt = -7.28 + np.cumsum(rng.uniform(2e-5, 8e-5, n))
+    long = 112.73 + np.cumsum(rng.normal(0, 1e-5, n))
+    elevation = 50 + np.cumsum(rng.normal(0, 0.3, n))
+    
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+                'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n'
+                '<trk><name>Long Ride</name><type>Ride</type><trkseg>\n')
+        for i in range(n):
+            t = (start + pd.Timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            f.write(f'<trkpt lat="{latt[i]:.7f}" lon="{long[i]:.7f}"><ele>{elevation[i]:.1f}</ele>'
+                    f'<time>{t}</time><extensions><power>{rng.integers(50, 400)}</power>'
+                    f'<gpxtpx:TrackPointExtension><gpxtpx:atemp>30</gpxtpx:atemp>'
+                    f'<gpxtpx:hr>{rng.integers(100, 180)}</gpxtpx:hr><gpxtpx:cad>{rng.integers(60, 100)}</gpxtpx:cad>'
+                    f'</gpxtpx:TrackPointExtension></extensions></trkpt>\n')
+        f.write('</trkseg></trk></gpx>\n')
+
+
+def legacy_parse_gpx_file(path):
+    """
+    The DOM based GPX parser used before the streaming parser, for comparison.
+    """
+    with open(path, 'r') as f:
+        doc = f.read().strip()
+    doc = minidom.parseString(doc)
+    
+    title = xml_path_val(doc, 'trk|name', '')
+    if 'ride' in title.lower():
+        sport = 'biking'
+    elif 'run' in title.lower():
+        sport = 'running'
+    else:
+        sport = xml_path_val(doc, 'trk|type').lower()
+    
+    rows = []
+    for trackpoint in doc.getElementsByTagName('trkpt'):
+        rows.append(OrderedDict(dtime=pd.Timestamp(xml_path_val(trackpoint, 'time')), 
+                                latt=trackpoint.attributes['lat'].value,
+                                long=trackpoint.attributes['lon'].value,
+                                elevation=xml_path_val(trackpoint, 'ele', np.NaN), distance=np.NaN,
+                                hr=xml_path_val(trackpoint, 'extensions|gpxtpx:hr', np.NaN),
+                                cadence=xml_path_val(trackpoint, 'extensions|gpxtpx:cad', np.NaN),
+                                speed=np.NaN, 
+                                power=xml_path_val(trackpoint, 'extensions|power', np.NaN),
+                                temp=xml_path_val(trackpoint, 'extensions|gpxtpx:atemp', np.NaN)))
+        
+    df = pd.DataFrame(rows)
+    df['dtime'] = df['dtime'].dt.tz_convert(pytz.timezone("Asia/Jakarta")).dt.tz_localize(None)
+    meta = OrderedDict(dtime=df['dtime'].iloc[0], sport=sport, title=title, src_file=os.path.split(path)[-1],
+                       route='', bike='', wheel='', note='')
+    return ZwiftTraining._process_activity(df, meta, copy=False)
+
+
+def legacy_parse_fit_records(records, meta):
+    """
+    The dict based FIT record decoding used before the columnar decoding, for comparison.
+    """
+    rows = []
+    for data in records:
+        raw_time = data.get('timestamp', data.get('time', None))
+        rows.append(OrderedDict(dtime=raw_time, 
+                                latt=data.get('position_lat', data.get('lat', np.NaN)),
+                                long=data.get('position_long', data.get('lng', np.NaN)),
+                                elevation=data.get('altitude', np.NaN), distance=data.get('distance', np.NaN),
+                                hr=data.get('heart_rate', data.get('heartrate', np.NaN)),
+                                cadence=data.get('cadence', np.NaN), speed=data.get('speed', np.NaN),
+                                power=data.get('power', np.NaN), temp=data.get('temperature', np.NaN)))
+    df = pd.DataFrame(rows)
+    df['dtime'] = df['dtime'] + pd.Timedelta(hours=7)
+    meta['dtime'] = df['dtime'].iloc[0]
+    if 'timestamp' in records[0]:
+        if not pd.isnull(df['latt'].iloc[0]):
+            if df['latt'].max() > 90 or df['latt'].min() < -90:
+                df['latt'] *= 180/(2**31)
+                df['long'] *= 180/(2**31)
+        max_dist = df['distance'].max()
+        if not pd.isnull(max_dist) and max_dist >= 1000:
+            df['distance'] /= 1000 if max_dist < 1000000 else 100000
+    meta['sport'] = 'cycling'
+    return ZwiftTraining._process_activity(df, meta, copy=False)
+
+
+def legacy_parse_fit_file(path):
+    records = [m.get_values() for m in FitFile(path).get_messages('record')]
+    meta = OrderedDict(dtime=None, sport='', title='', src_file=os.path.split(path)[-1],
+                       route='', bike='', wheel='', note='', )
+    return legacy_parse_fit_records(records, meta)
+
+
+PARSERS = {
+    'legacy_tcx': legacy_parse_tcx_file,
+    'tcx': ZwiftTraining.parse_tcx_file,
+    'legacy_gpx': legacy_parse_gpx_file,
+    'gpx': ZwiftTraining.parse_gpx_file,
+    'legacy_fit': legacy_parse_fit_file,
+    'fit': ZwiftTraining.parse_fit_file,
+}
+
+
+def measure_parser(parser, path):
+    """
+    Run in a fresh process by run_parser(). Prints the peak RSS increase (KB) and
+    the elapsed time of parsing the file.
+    """
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    PARSERS[parser](path)
+    elapsed = time.perf_counter() - t0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(peak_rss - baseline_rss, elapsed)
+
+
+def run_parser(parser, path):
+    code = f'import bench_ztraining as b; b.measure_parser({parser!r}, {path!r})'
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+    rss, elapsed = output.split()[-2:]
+    return dict(parser=parser, file=os.path.split(path)[1], peak_rss_mb=int(rss)/1024, 
+                time=float(elapsed))
+
+
+def bench_parse_tcx():
+    """
+    Peak memory and time of the streaming TCX parser vs the DOM based parser.
+    """
+    path = os.path.join(SAMPLE_DIR, '102574211.tcx')
+    if not os.path.exists(path):
+        path = os.path.join(BENCH_DIR, 'long-10h.tcx')
+        make_long_tcx(path)
+        
+    rows = [run_parser(parser, path) for parser in ['legacy_tcx', 'tcx']]
+    print(pd.DataFrame(rows).set_index('parser').round(3))
+
+
+def bench_parse_gpx():
+    """
+    Peak memory and time of the streaming GPX parser vs the DOM based parser, for
+    different track lengths.
+    """
+    rows = []
+    for hours in [1, 4]:
+        path = os.path.join(BENCH_DIR, f'long-{hours}h.gpx')
+        make_long_gpx(path, hours=hours)
+        rows.extend([run_parser(parser, path) for parser in ['legacy_gpx', 'gpx']])
+    print(pd.DataFrame(rows).set_index('parser').round(3))
+
+
+def bench_parse_fit():
+    """
+    Peak memory and time of parsing the largest sample FIT file, and the time to
+    convert Zwift's get_data() records (i.e. without the FIT decoding by fitparse).
+    """
+    path = max(sample_files(['fit']), key=os.path.getsize)
+    rows = [run_parser(parser, path) for parser in ['legacy_fit', 'fit']]
+    print(pd.DataFrame(rows).set_index('parser').round(3))
+    
+    with open(path, 'rb') as f:
+        records = process_fit_data(decode_fit_file(f.read()))
+    legacy_time = timeit(lambda: legacy_parse_fit_records(records, OrderedDict(src_file='')), repeat=3)
+    new_time = timeit(lambda: ZwiftTraining.parse_fit_records(records, OrderedDict(src_file='')), repeat=3)
+    print(f'Zwift records ({len(records)}): legacy: {legacy_time:.3f}s, columnar: {new_time:.3f}s')
+
+
+def bench_distance(hours=4):
+    """
+    Time to calculate the movement between consecutive GPS samples of a ride, and the
+    difference to geopy's geodesic distance, for each distance method.
+    """
+    n = int(hours * 3600)
+    rng = np.random.default_rng(0)
+    latt = pd.Series(-7.28 + np.cumsum(rng.uniform(2e-5, 8e-5, n)))
+    long = pd.Series(112.73 + np.cumsum(rng.normal(0, 1e-5, n)))
+    coords = (latt.shift(), long.shift(), latt, long)
+    
+    expected = ZwiftTraining.measure_distances(*coords, method='geodesic')
+    rows = []
+    for method in ZwiftTraining.DISTANCE_METHODS:
+        elapsed = timeit(lambda: ZwiftTraining.measure_distances(*coords, method=method), 
+                         repeat=1 if method == 'geodesic' else 5)
+        dist = ZwiftTraining.measure_distances(*coords, method=method)
+        rows.append(dict(method=method, time=elapsed, 
+                         max_error_m=np.nanmax(np.abs(dist - expected)),
+                         total_error_pct=100 * abs(np.nansum(dist) - np.nansum(expected)) / np.nansum(expected)))
+    print(f'{n} samples')
+    print(pd.DataFrame(rows).set_index('method').round(6))
+
+
+def legacy_calc_max_powers(df):
+    """
+    calc_max_powers() with one rolling pass per period, as before calc_mean_max().
+    """
+    df = df[['dtime', 'power']].dropna()
+    df = df[ (df['power'] >= 20) & (df['power'] <= 3000)]
+    result = {'dtime': df.iloc[0]['dtime']}
+    for p in ZwiftTraining.POWER_CURVE_PERIODS:
+        result[str(p)] = round(df['power'].rolling(p).mean().max(), 1)
+    return result
+
+
+def bench_max_powers():
+    """
+    Time of calc_max_powers() for a single 1h, 4h and 12h ride.
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for hours in [1, 4, 12]:
+        n = hours * 3600
+        df = pd.DataFrame({'dtime': pd.date_range('2020-01-01', periods=n, freq='S'),
+                           'power': rng.integers(50, 400, n) / 2})
+        legacy = timeit(lambda: legacy_calc_max_powers(df), repeat=3)
+        new = timeit(lambda: ZwiftTraining.calc_max_powers(df), repeat=3)
+        assert pd.Series(legacy_calc_max_powers(df)).equals(pd.Series(ZwiftTraining.calc_max_powers(df)))
+        rows.append(dict(hours=hours, legacy=legacy, cumsum=new, speedup=legacy/new))
+    print(pd.DataFrame(rows).set_index('hours').round(4))
+
+
+def bench_power_curve(n_activities=200):
+    """
+    Time of calc_power_curve() over all activities, when the max powers need to be
+    calculated from the activity data vs read from the power curve cache.
+    """
+    conf_file = make_profile('power-curve', n_activities)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    
+    def uncached():
+        os.remove(zt.power_curve_file)
+        zt.power_curve_cache.invalidate()
+        zt.calc_power_curve()
+        
+    rows = [dict(mode='activity data', time=timeit(uncached, repeat=3)),
+            dict(mode='cache', time=timeit(lambda: zt.calc_power_curve(), repeat=3)),
+            dict(mode='cache, new instance', 
+                 time=timeit(lambda: ZwiftTraining(conf_file, quiet=True).calc_power_curve(), repeat=3))]
+    print(f'{n_activities} activities')
+    print(pd.DataFrame(rows).set_index('mode').round(4))
+
+
+def bench_zones(n_activities=200):
+    """
+    Time of the power and hr zone reports over all activities, and over each week
+    (like plot_power_zones_duration2()), with and without the activity histograms.
+    """
+    conf_file = make_profile('zones', n_activities)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    activities = zt.get_activities()
+    from_dtime, to_dtime = activities['dtime'].iloc[0].normalize(), activities['dtime'].iloc[-1]
+    weeks = pd.date_range(from_dtime, to_dtime, freq='W-MON')
+    
+    def all_reports():
+        zt.calc_power_zones_duration(from_dtime, to_dtime, with_sst=True)
+        zt.calc_hr_zones_duration(from_dtime, to_dtime, max_hr=180)
+        
+    def weekly_reports():
+        for start in weeks:
+            zt.calc_power_zones_duration(start, start + pd.Timedelta(days=6))
+    
+    def without_histograms(func):
+        def run():
+            shutil.rmtree(zt.histograms_dir, ignore_errors=True)
+            func()
+        return run
+    
+    rows = [dict(report='all', histograms=False, time=timeit(without_histograms(all_reports), repeat=3)),
+            dict(report='all', histograms=True, time=timeit(all_reports, repeat=3)),
+            dict(report=f'{len(weeks)} weeks', histograms=False, time=timeit(without_histograms(weekly_reports), repeat=3)),
+            dict(report=f'{len(weeks)} weeks', histograms=True, time=timeit(weekly_reports, repeat=3))]
+    print(f'{n_activities} activities')
+    print(pd.DataFrame(rows).set_index(['report', 'histograms']).round(4))
+
+
+
+def bench_archive(n_activities=3*365):
+    """
+    Time of the power curve with max_hr (which reads the data of every activity) and of
+    the zone reports without histograms, reading the activity data files vs the sample
+    archive. Also the time to rebuild and check the archive.
+    """
+    conf_file = make_profile('archive', n_activities)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    activities = zt.get_activities()
+    from_dtime, to_dtime = activities['dtime'].iloc[0].normalize(), activities['dtime'].iloc[-1]
+    
+    def power_curve():
+        zt.calc_power_curve(max_hr=170)
+        
+    def zones():
+        shutil.rmtree(zt.histograms_dir, ignore_errors=True)
+        zt.calc_power_zones_duration(from_dtime, to_dtime)
+    
+    rows = [dict(source='files', func='power_curve', time=timeit(power_curve, repeat=2)),
+            dict(source='files', func='zones', time=timeit(zones, repeat=2))]
+    rows.append(dict(source='archive', func='rebuild', time=timeit(lambda: zt.rebuild_archive(quiet=True), repeat=1)))
+    rows.append(dict(source='archive', func='check', time=timeit(lambda: zt.check_archive(quiet=True), repeat=1)))
+    rows += [dict(source='archive', func='power_curve', time=timeit(power_curve, repeat=2)),
+             dict(source='archive', func='zones', time=timeit(zones, repeat=2))]
+    print(f'{n_activities} activities')
+    print(pd.DataFrame(rows).set_index(['func', 'source']).sort_index().round(4))
+
+def bench_ftp_history(n_updates=100, n_dtimes=5000):
+    """
+    Time of looking up the FTP of many activity times, one at a time with get_ftp()
+    vs with get_ftp_many().
+    """
+    rng = np.random.default_rng(0)
+    updates = pd.DataFrame({'dtime': pd.Timestamp('2015-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 8*365, n_updates)), unit='D'),
+                            'ftp': rng.integers(150, 350, n_updates)})
+    ftph = FTPHistory(updates)
+    dtimes = pd.Timestamp('2015-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 8*365*24*3600, n_dtimes)), unit='s')
+    
+    def one_by_one():
+        return np.array([ftph.get_ftp(dtime) for dtime in dtimes], dtype=float)
+    
+    assert np.array_equal(one_by_one(), ftph.get_ftp_many(dtimes), equal_nan=True)
+    rows = [dict(mode='get_ftp', time=timeit(one_by_one, repeat=3)),
+            dict(mode='get_ftp_many', time=timeit(lambda: ftph.get_ftp_many(dtimes), repeat=3))]
+    print(f'{n_dtimes} lookups in {n_updates} FTP updates')
+    print(pd.DataFrame(rows).set_index('mode').round(4))
+
+
+def bench_training_form(n_activities=3*365):
+    """
+    Time of calc_training_form() when calculated over the whole history vs continued
+    from the training load checkpoint.
+    """
+    conf_file = make_profile('training-form', n_activities)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    
+    def full():
+        zt.invalidate_training_load()
+        zt.calc_training_form()
+        
+    rows = [dict(mode='whole history', time=timeit(full, repeat=3)),
+            dict(mode='checkpoint', time=timeit(lambda: zt.calc_training_form(), repeat=3)),
+            dict(mode='checkpoint, new instance', 
+                 time=timeit(lambda: ZwiftTraining(conf_file, quiet=True).calc_training_form(), repeat=3))]
+    print(f'{n_activities} activities')
+    print(pd.DataFrame(rows).set_index('mode').round(4))
+
+
+def legacy_process_activity(df, meta, min_kph=3, copy=True):
+    """
+    _process_activity() before it was restructured into NumPy arrays, for comparison.
+    """
+    if copy:
+        df = df.copy()
+
+    MAX_ELE = 9000
+    MAX_HR = 250
+    MAX_POWER = 2500
+    MAX_CADENCE = 210
+    MAX_SPEED = 100
+    MAX_TEMP = 55
+
+    df['latt'] = df['latt'].astype('float')
+    df['long'] = df['long'].astype('float')
+    df['elevation'] = df['elevation'].astype('float').clip(upper=MAX_ELE)
+    df['distance'] = df['distance'].astype('float')
+    df['hr'] = df['hr'].astype('float').clip(upper=MAX_HR)
+    df['power'] = df['power'].astype('float').clip(upper=MAX_POWER)
+    df['cadence'] = df['cadence'].astype('float').clip(upper=MAX_CADENCE)
+    df['speed'] = df['speed'].astype('float').clip(upper=MAX_SPEED)
+    df['temp'] = df['temp'].astype('float').clip(upper=MAX_TEMP)
+
+    mpos = list(df.columns).index('distance')
+    if pd.isnull(df['distance'].iloc[0]):
+        if pd.isnull(df['latt'].iloc[0]):
+            assert False, "Unable to calculate distance because GPS coordinates are null"
+        movement = ZwiftTraining.measure_distances(df['latt'].shift(), df['long'].shift(), 
+                                                   df['latt'], df['long'])
+        df.insert(mpos, 'movement', np.nan_to_num(movement, nan=0))
+        df['distance'] = df['movement'].cumsum() / 1000
+    else:
+        df.insert(mpos, 'movement', (df['distance'] * 1000).diff())
+
+    df.loc[0, 'movement'] = df.loc[0, 'distance'] * 1000
+    df['movement'] = df['movement'].round(3)
+
+    max_movement = MAX_SPEED * 1000 / 3600
+    df['movement'] = df['movement'].clip(upper=max_movement)
+
+    # absolute duration
+    start_time = df.iloc[0]['dtime']
+    df.insert(1, 'duration', (df['dtime'] - start_time).dt.total_seconds())
+
+    # recalculate speed.
+    tick_elapsed = df['duration'].diff().fillna(1)
+    df['speed'] = df['movement'] * 3600 / 1000 / tick_elapsed
+    df['speed'] = df['speed'].replace(np.inf, np.NaN)
+    df.loc[ df['speed'] > 100, 'speed'] = 100
+
+    # Smoothen speed, power, hr
+    df['speed'] = df['speed'].rolling(3, min_periods=1).mean()
+    df['power'] = df['power'].rolling(2, min_periods=1).mean()
+    df['hr'] = df['hr'].rolling(2, min_periods=1).mean()
+    df['cadence'] = df['cadence'].rolling(2, min_periods=1).mean()
+    df['temp'] = df['temp'].rolling(2, min_periods=1).mean()
+
+    # remove non-movement
+    min_movement = min_kph*1000 / 3600
+    df = df[ df['movement'] >= min_movement]
+
+    # moving time
+    df.insert(2, 'mov_duration', range(0, len(df)))
+
+    sports = {
+        'biking': 'cycling',
+        'cycling': 'cycling',
+        'cycling_transportation': 'cycling',
+        'cycling_sport': 'cycling',
+        '17': 'cycling', # strava GPX export
+        'ride': 'cycling',
+        'virtualride': 'cycling',
+        'virtualrun': 'running',
+        'run': 'running',
+        'running': 'running',
+        'other': 'other',
+    }
+    meta['sport'] = sports[ meta['sport'] ]
+
+    if len(df):
+        meta['distance'] = np.round(df["distance"].iloc[-1], 3)
+        meta['duration'] = pd.Timedelta(seconds=df.iloc[-1]['duration'])
+        meta['mov_duration'] = pd.Timedelta(seconds=df.iloc[-1]['mov_duration'])
+        if False:
+            climb = df['elevation'].diff()
+            meta['elevation'] = np.round(climb[ climb > 0.05 ].sum(), 1)
+        else:
+            climb = df['elevation'].rolling(6).mean().diff()
+            meta['elevation'] = np.round(climb[ climb > 0 ].sum(), 1)
+        meta['speed_avg'] = np.round(meta['distance'] / (meta['mov_duration'].total_seconds() / 3600), 1)
+        meta['speed_max'] = np.round(df["speed"].max(), 1)
+        meta['hr_avg'] = np.round(df["hr"].mean(), 2)
+        meta['hr_max'] = df['hr'].max()
+        meta['power_avg'] = np.round(df["power"].mean(), 2)
+        meta['power_max'] = df["power"].max()
+        meta['power_np'] = np.round(ZwiftTraining.calc_normalized_power(df["power"].values,
+                                                                        duration=df["duration"].values), 2)
+        meta['power_vi'] = np.round(meta['power_np'] / meta['power_avg'], 3) if meta['power_avg'] else np.NaN
+        cadence = df["cadence"]
+        cadence = cadence[ cadence > 0 ]
+        meta['cadence_avg'] = np.round(cadence.mean(), 2)
+        meta['cadence_max'] = np.ceil(df["cadence"].max())
+        meta['temp_avg'] = round(df["temp"].mean(), 1)
+        meta['temp_max'] = df["temp"].max()
+    else:
+        meta['distance'] = np.NaN
+        meta['duration'] = np.NaN
+        meta['mov_duration'] = np.NaN
+        meta['elevation'] = np.NaN
+        meta['speed_avg'] = np.NaN
+        meta['speed_max'] = np.NaN
+        meta['hr_avg'] = np.NaN
+        meta['hr_max'] = np.NaN
+        meta['power_avg'] = np.NaN
+        meta['power_max'] = np.NaN
+        meta['power_np'] = np.NaN
+        meta['power_vi'] = np.NaN
+        meta['cadence_avg'] = np.NaN
+        meta['cadence_max'] = np.NaN
+        meta['temp_avg'] = np.NaN
+        meta['temp_max'] = np.NaN
+
+    # Move calories to end of dictionary
+    if 'calories' in meta:
+        calories = meta['calories']
+        del meta['calories']
+    else:
+        calories = np.NaN
+    meta['calories'] = calories
+
+    # Round some values
+    df = df.copy()
+    df['elevation'] = df['elevation'].astype('float').round(2)
+    df['distance'] = df['distance'].astype('float').round(3)
+    df['speed'] = df['speed'].astype('float').round(2)
+
+    return df, meta
+
+
+def raw_activity(path):
+    """
+    Returns the (df, meta) which the parser of the file passes to _process_activity().
+    """
+    process_activity = ZwiftTraining._process_activity
+    ZwiftTraining._process_activity = staticmethod(lambda df, meta, **kwargs: (df, meta))
+    try:
+        return ZwiftTraining.parse_file(path)
+    finally:
+        ZwiftTraining._process_activity = process_activity
+
+
+PROCESSORS = {
+    'legacy_process': legacy_process_activity,
+    'process': ZwiftTraining._process_activity,
+}
+
+
+def measure_process(processor, path):
+    """
+    Run in a fresh process by run_process(). Prints the peak RSS increase (KB) and
+    the elapsed time of processing the parsed samples of the file.
+    """
+    df, meta = raw_activity(path)
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    PROCESSORS[processor](df, meta)
+    elapsed = time.perf_counter() - t0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(peak_rss - baseline_rss, elapsed)
+
+
+def run_process(processor, path):
+    code = f'import bench_ztraining as b; b.measure_process({processor!r}, {path!r})'
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+    rss, elapsed = output.split()[-2:]
+    return dict(processor=processor, file=os.path.split(path)[1], peak_rss_mb=int(rss)/1024, 
+                time=float(elapsed))
+
+
+def bench_process_activity():
+    """
+    Peak memory and time of _process_activity() vs the DataFrame based version, for
+    the 10 hours TCX file and the Bromo 100K FIT file. Also checks that both give the
+    same result.
+    """
+    tcx_path = os.path.join(SAMPLE_DIR, '102574211.tcx')
+    if not os.path.exists(tcx_path):
+        tcx_path = os.path.join(BENCH_DIR, 'long-10h.tcx')
+        make_long_tcx(tcx_path)
+    
+    rows = []
+    for path in [tcx_path, os.path.join(SAMPLE_DIR, '132442327.fit')]:
+        df, meta = raw_activity(path)
+        legacy_df, legacy_meta = legacy_process_activity(df, OrderedDict(meta))
+        new_df, new_meta = ZwiftTraining._process_activity(df, OrderedDict(meta))
+        pd.testing.assert_frame_equal(new_df, legacy_df, check_exact=True)
+        assert pd.Series(new_meta).equals(pd.Series(legacy_meta))
+        rows.extend([run_process(processor, path) for processor in PROCESSORS])
+    print(pd.DataFrame(rows).set_index('processor').round(3))
+
+def bench_calories(n_activities=3*365):
+    """
+    Time of updating the calories of every activity, one row at a time (the old
+    _zwift_update_calories()) vs ActivityCatalog.update(), and of getting the calories
+    of the sample files by parsing them vs scan_file_summary().
+    """
+    conf_file = make_profile('calories', n_activities)
+    zt = ZwiftTraining(conf_file, quiet=True)
+    calories_updates = {src_file: float(i) for i, src_file in enumerate(zt.get_activities()['src_file'])}
+    
+    def one_by_one():
+        df = zt.catalog.df.copy()
+        for src_file, cal in calories_updates.items():
+            found = df[ df['src_file']==src_file ]
+            df.loc[ found.index, 'calories' ] = cal
+        zt.catalog.save(df)
+        
+    def bulk():
+        zt.catalog.update(pd.DataFrame({'src_file': list(calories_updates.keys()),
+                                        'calories': list(calories_updates.values())}))
+        
+    rows = [dict(func='update', mode='one by one', time=timeit(one_by_one, repeat=2)),
+            dict(func='update', mode='catalog.update', time=timeit(bulk, repeat=2))]
+    files = sample_files(('tcx', 'fit'))
+    rows += [dict(func='calories', mode='parse_file', time=timeit(lambda: [ZwiftTraining.parse_file(f) for f in files], repeat=1)),
+             dict(func='calories', mode='scan_file_summary', time=timeit(lambda: [ZwiftTraining.scan_file_summary(f) for f in files]))]
+    print(f'{n_activities} activities, {len(files)} files')
+    print(pd.DataFrame(rows).set_index(['func', 'mode']).round(4))
+    
+    
+def bench_zwift_client(n_activities=50, latency=0.002):
+    """
+    Time to list and download the FIT files of activities from a local stand-in of the
+    Zwift servers, with zwift.Client's Activity (a new connection for every request)
+    vs ZwiftSession, one by one and concurrently with asyncio.
+    """
+    from test_ztraining import FakeAuthToken, ZwiftStandInServer
+    
+    server = ZwiftStandInServer(n_activities, latency=latency)
+    auth = FakeAuthToken(server)
+    activity_client = Activity(1, auth.get_access_token)
+    activity_client.request.BASE_URL = server.url
+    session = ZwiftSession(auth, 1, base_url=server.url, file_url=server.file_url)
+    
+    def legacy():
+        for activity in activity_client.list(start=0, limit=n_activities):
+            data = activity_client.get_activity(activity['id'])
+            download_file(server.file_url.format(bucket=data['fitFileBucket'], key=data['fitFileKey']))
+            
+    def serial():
+        for activity in session.list(start=0, limit=n_activities):
+            session.get_fit(activity['id'])
+            
+    async def concurrent():
+        activities = await session.alist(start=0, limit=n_activities)
+        await asyncio.gather(*[session.aget_fit(activity['id']) for activity in activities])
+        
+    rows = []
+    try:
+        for mode, func in [('zwift.Activity', legacy), ('ZwiftSession', serial), 
+                           ('ZwiftSession async', lambda: asyncio.run(concurrent()))]:
+            server.connections = server.requests = 0
+            elapsed = timeit(func, repeat=3)
+            rows.append(dict(mode=mode, time=elapsed, requests=server.requests / 3, 
+                             connections=server.connections / 3))
+    finally:
+        session.close()
+        server.close()
+    print(f'{n_activities} activities, {latency*1000:g} ms latency. Requests and new connections per run:')
+    print(pd.DataFrame(rows).set_index('mode').round(3))
+    
+
+def bench_zwift_sync(n_activities=24, latency=0.05, modes=((None, None), (4, None), (4, 4))):
+    """
+    Time of zwift_update() downloading activities from a local stand-in of the Zwift
+    servers, with different numbers of download threads (workers) and parse processes,
+    and the counters of the download, parse and save stages.
+    """
+    from test_ztraining import FakeAuthToken, ZwiftStandInServer
+    
+    server = ZwiftStandInServer(n_activities, latency=latency)
+    session = ZwiftSession(FakeAuthToken(server), 1, base_url=server.url, file_url=server.file_url)
+    client = SimpleNamespace(get_profile=lambda: SimpleNamespace(profile=dict(id=1, useMetric=True)),
+                             get_activity=lambda player_id: session)
+    profile_dir = os.path.join(BENCH_DIR, 'zwift-sync')
+    conf_file = os.path.join(BENCH_DIR, 'zwift-sync.json')
+    with open(conf_file, 'w') as f:
+        json.dump({'dir': profile_dir}, f)
+        
+    rows = []
+    try:
+        for workers, processes in modes:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            zt = ZwiftTraining(conf_file, quiet=True)
+            zt.zwift_client = client
+            t0 = time.perf_counter()
+            n_updates = zt.zwift_update(max=n_activities, profile=False, workers=workers, processes=processes,
+                                        quiet=True)
+            elapsed = time.perf_counter() - t0
+            assert n_updates == n_activities
+            rows.append(dict(workers=workers or 1, processes=processes or 1, time=elapsed))
+            print(f'workers: {workers}, processes: {processes}')
+            print(zt.zwift_sync_stats)
+    finally:
+        session.close()
+        server.close()
+    print(f'{n_activities} activities, {latency*1000:g} ms latency')
+    print(pd.DataFrame(rows).set_index(['workers', 'processes']).round(3))
+    
+
+BENCHMARKS = {
+    'activity_store': bench_activity_store,
+    'import_files': bench_import_files,
+    'import_window': bench_import_window,
+    'import_incremental': bench_import_incremental,
+    'parse_tcx': bench_parse_tcx,
+    'parse_gpx': bench_parse_gpx,
+    'parse_fit': bench_parse_fit,
+    'distance': bench_distance,
+    'max_powers': bench_max_powers,
+    'power_curve': bench_power_curve,
+    'zones': bench_zones,
+    'zones_3y': lambda: bench_zones(3*365),
+    'archive': bench_archive,
+    'ftp_history': bench_ftp_history,
+    'training_form': bench_training_form,
+    'process_activity': bench_process_activity,
+    'calories': bench_calories,
+    'zwift_client': bench_zwift_client,
+    'zwift_sync': bench_zwift_sync,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    for name in names:
+        print(f'=== {name} ===')
+        BENCHMARKS[name]()
+    shutil.rmtree(BENCH_DIR, ignore_errors=True)
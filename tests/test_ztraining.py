@@ -1,15 +1,190 @@
+import asyncio
+import collections
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import numpy as np
 import os
 import pandas as pd
 import shutil
 import sys
+import threading
 import time
+from types import SimpleNamespace
 import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from fitparse import FitFile
+from zwift.activity import decode_fit_file, process_fit_data
 
 if True:
     sys.path.insert(0, os.path.abspath('..'))
-    from ztraining import ZwiftTraining, FTPHistory
+    from ztraining import ActivityCatalog, ActivityData, ActivityStore, ImportManifest, ZwiftSession, ZwiftTraining, FTPHistory
+    
+
+class FakeZwiftClient:
+    """
+    Stands in for zwift.Client. Serves n_activities generated rides (newest first), 
+    sleeping latency seconds for each request. The first get_data() of each activity
+    in fail_ids raises an error. Records the time of the requests, the number of
+    requests of each kind, and the maximum number of concurrent requests.
+    """
+    def __init__(self, n_activities=10, latency=0.02, fail_ids=()):
+        self.latency = latency
+        self.fail_ids = set(fail_ids)
+        self.activities = []
+        for i in range(n_activities):
+            start = pd.Timestamp('2020-01-01', tz='UTC') + pd.Timedelta(days=n_activities - i)
+            self.activities.append(self.make_activity(1000 + i, start))
+        self.request_times = []
+        self.calls = collections.Counter()
+        self.max_active = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        
+    @staticmethod
+    def make_activity(activity_id, start):
+        return dict(id=activity_id, id_str=str(activity_id), 
+                    startDate=start.strftime('%Y-%m-%dT%H:%M:%S.000+0000'),
+                    sport='CYCLING', name=f'Ride {activity_id}', calories=300.0, duration='0:10')
+    
+    def add_activities(self, n):
+        """Add n newer activities, one per hour, on top of the list"""
+        newest = pd.Timestamp(self.activities[0]['startDate'])
+        first_id = max(a['id'] for a in self.activities) + 1
+        new = [self.make_activity(first_id + i, newest + pd.Timedelta(hours=i+1)) for i in range(n)]
+        self.activities[:0] = new[::-1]
+        
+    def get_profile(self):
+        return SimpleNamespace(profile=dict(id=1, useMetric=True))
+    
+    def get_activity(self, player_id):
+        return FakeZwiftActivity(self)
+    
+    def request(self, func, kind=None):
+        with self._lock:
+            self.request_times.append(time.monotonic())
+            self.calls[kind] += 1
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+        try:
+            time.sleep(self.latency)
+            return func()
+        finally:
+            with self._lock:
+                self._active -= 1
+            
+    def records(self, activity_id):
+        if activity_id in self.fail_ids:
+            self.fail_ids.remove(activity_id)
+            raise ConnectionError(f'Connection reset getting {activity_id}')
+        activity = [a for a in self.activities if a['id'] == activity_id][0]
+        start = pd.Timestamp(activity['startDate']).tz_convert(None)
+        return [dict(time=start + pd.Timedelta(seconds=i), lat=-7.9, lng=112.9, altitude=10.0, 
+                     distance=i * 0.008, heartrate=130, cadence=85, speed=28.8, 
+                     power=150 + (activity_id + i) % 50)
+                for i in range(600)]
+
+
+class FakeZwiftActivity:
+    def __init__(self, client):
+        self.client = client
+        
+    def list(self, start=0, limit=10):
+        return self.client.request(lambda: self.client.activities[start:start+limit], 'list')
+    
+    def get_activity(self, activity_id):
+        return self.client.request(lambda: [a for a in self.client.activities if a['id'] == activity_id][0])
+    
+    def get_data(self, activity_id):
+        return self.client.request(lambda: self.client.records(activity_id), 'get_data')
     
     
+class ZwiftStandInServer:
+    """
+    Local HTTP server standing in for the Zwift API and FIT file storage, serving 
+    n_activities copies of fit_file. API requests without the current token get 401.
+    Each response is delayed by latency seconds. Counts the requests and connections.
+    """
+    def __init__(self, n_activities=10, fit_file='tcx_gpx_fit_files/1873571076.fit', latency=0):
+        with open(fit_file, 'rb') as f:
+            self.fit_data = f.read()
+        self.activities = [FakeZwiftClient.make_activity(1000 + i, pd.Timestamp('2020-01-01', tz='UTC') + pd.Timedelta(days=n_activities - i))
+                           for i in range(n_activities)]
+        self.latency = latency
+        self.token = 'token-1'
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+                    
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                url = urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if parts[0] == 'fit':
+                    return self.send(200, server.fit_data, 'application/octet-stream')
+                if self.headers.get('Authorization') != f'Bearer {server.token}':
+                    return self.send(401, b'')
+                if parts[-1] == 'activities':
+                    query = parse_qs(url.query)
+                    start, limit = int(query['start'][0]), int(query['limit'][0])
+                    return self.send_json(server.activities[start:start+limit])
+                activity_id = int(parts[-1])
+                return self.send_json(dict(id=activity_id, fitFileBucket='fit', fitFileKey=f'{activity_id}.fit'))
+            
+            def send_json(self, obj):
+                self.send(200, json.dumps(obj).encode(), 'application/json')
+                
+            def send(self, status, body, content_type='text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, *args):
+                pass
+            
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.file_url = self.url + '/{bucket}/{key}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        
+
+class FakeAuthToken:
+    """
+    Stands in for zwift.AuthToken, getting the current token of a ZwiftStandInServer.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.access_token = None
+        self.refreshes = 0
+        
+    def get_access_token(self):
+        if self.access_token is None:
+            self.refreshes += 1
+            self.access_token = self.server.token
+        return self.access_token
+    
+
 class TestZwiftTraining(unittest.TestCase):
     def verify_gpx1(self, meta):
         self.assertEqual(meta['dtime'], pd.Timestamp('2019-01-26 07:41:53'))
@@ -33,7 +208,57 @@ class TestZwiftTraining(unittest.TestCase):
         
         self.assertAlmostEqual(df['mov_duration'].iloc[-1], 12*60+11, delta=60)
         self.assertAlmostEqual(df['distance'].iloc[-1], 3.16, delta=0.2)
-    
+
+    def test_distance_methods(self):
+        for path in ['tcx_gpx_fit_files/2246203970.gpx', 'tcx_gpx_fit_files/3925200538.fit']:
+            if path.endswith('.gpx'):
+                df, _ = ZwiftTraining.parse_gpx_file(path)
+            else:
+                df, _ = ZwiftTraining.parse_fit_file(path)
+            df = df.dropna(subset=['latt', 'long'])
+            coords = (df['latt'].shift(), df['long'].shift(), df['latt'], df['long'])
+            expected = ZwiftTraining.measure_distances(*coords, method='geodesic')
+            self.assertTrue(pd.isnull(expected[0]))
+
+            vincenty = ZwiftTraining.measure_distances(*coords, method='vincenty')
+            self.assertTrue(pd.isnull(vincenty[0]))
+            self.assertLess(np.nanmax(np.abs(vincenty - expected)), 0.001)
+
+            haversine = ZwiftTraining.measure_distances(*coords, method='haversine')
+            self.assertLess(np.nanmax(np.abs(haversine - expected) / np.maximum(expected, 1)), 0.006)
+            self.assertAlmostEqual(np.nansum(haversine), np.nansum(expected), delta=np.nansum(expected)*0.005)
+
+    def test_parse_gpx_extensions(self):
+        # Each trackpoint uses a different flavor of extension namespace
+        exts = ['<gpxtpx:TrackPointExtension><gpxtpx:hr>120</gpxtpx:hr><gpxtpx:cad>80</gpxtpx:cad>'
+                '<gpxtpx:atemp>25</gpxtpx:atemp></gpxtpx:TrackPointExtension><power>200</power>',
+                '<tpx2:TrackPointExtension><tpx2:hr>120</tpx2:hr><tpx2:cad>80</tpx2:cad>'
+                '<tpx2:atemp>25</tpx2:atemp></tpx2:TrackPointExtension><pwr:PowerInWatts>200</pwr:PowerInWatts>',
+                '<gpxdata:hr>120</gpxdata:hr><gpxdata:cadence>80</gpxdata:cadence>'
+                '<gpxdata:temp>25</gpxdata:temp><gpxdata:power>200</gpxdata:power>']
+        points = ''.join(f'<trkpt lat="{-7.28 + i*0.0001:.4f}" lon="112.73"><ele>10</ele>'
+                         f'<time>2020-05-01T00:00:{i:02d}Z</time><extensions>{exts[i % 3]}</extensions></trkpt>'
+                         for i in range(12))
+        if not os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            os.makedirs(ZwiftTraining.DEFAULT_PROFILE_DIR)
+        path = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'extensions-test.gpx')
+        with open(path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>'
+                    '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+                    'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
+                    'xmlns:tpx2="http://www.garmin.com/xmlschemas/TrackPointExtension/v2" '
+                    'xmlns:pwr="http://www.garmin.com/xmlschemas/PowerExtension/v1" '
+                    'xmlns:gpxdata="http://www.cluetrust.com/XML/GPXDATA/1/0">'
+                    f'<trk><name>Morning Ride</name><trkseg>{points}</trkseg></trk></gpx>')
+
+        df, meta = ZwiftTraining.parse_gpx_file(path)
+        self.assertEqual(meta['sport'], 'cycling')
+        self.assertEqual(meta['title'], 'Morning Ride')
+        self.assertEqual(meta['dtime'], pd.Timestamp('2020-05-01 07:00:00'))
+        for field, value in [('hr', 120), ('cadence', 80), ('temp', 25), ('power', 200)]:
+            self.assertEqual(df[field].isnull().sum(), 0, field)
+            self.assertAlmostEqual(meta[f'{field}_avg'], value, delta=0.01, msg=field)
+
     def verify_tcx1(self, meta):
         self.assertEqual(meta['dtime'], pd.Timestamp('2013-11-09 05:04:11'))
         self.assertEqual(meta['sport'], 'cycling')
@@ -92,7 +317,16 @@ class TestZwiftTraining(unittest.TestCase):
         self.assertAlmostEqual(df['duration'].iloc[-1], pd.Timedelta('2:09:53').total_seconds(), delta=2*60)
         self.assertAlmostEqual(df['mov_duration'].iloc[-1], pd.Timedelta('2:01:06').total_seconds(), delta=2*60)
         self.assertAlmostEqual(df['distance'].iloc[-1], 54.94, delta=1)
-    
+
+    def test_parse_fit_records_zwift(self):
+        # The same activity, as records returned by Zwift's get_data()
+        from zwift.activity import decode_fit_file, process_fit_data
+        with open('tcx_gpx_fit_files/2020-06-27-06-38-50.fit', 'rb') as f:
+            records = process_fit_data(decode_fit_file(f.read()))
+        df, meta = ZwiftTraining.parse_fit_records(records, OrderedDict(src_file='zwift'))
+        self.verify_fit1(meta)
+        self.assertAlmostEqual(df['distance'].iloc[-1], 54.94, delta=1)
+
     def verify_fit2(self, meta, skip_hr=False, skip_temp=False):
         self.assertEqual(meta['dtime'].replace(second=0), pd.Timestamp('2020-05-17 16:23:00'))
         self.assertEqual(meta['sport'], 'cycling')
@@ -185,24 +419,338 @@ class TestZwiftTraining(unittest.TestCase):
         self.assertAlmostEqual(meta['temp_avg'], 27, delta=0.5)
         self.assertAlmostEqual(meta['temp_max'], 27, delta=0.5)
         
+    def test_scan_file_summary(self):
+        for path in ['tcx_gpx_fit_files/4944741403.fit', 'tcx_gpx_fit_files/132442327.fit',
+                     'tcx_gpx_fit_files/activity_4944741403.tcx', 'tcx_gpx_fit_files/Afternoon_Trainer_Ride.tcx']:
+            summary = ZwiftTraining.scan_file_summary(path)
+            self.assertEqual(summary['src_file'], os.path.split(path)[-1])
+            if path.endswith('.fit'):
+                session = list(FitFile(path).get_messages('session'))[0]
+                self.assertEqual(summary['calories'], session.get_value('total_calories'))
+                self.assertEqual(summary['sport'], session.get_value('sport'))
+            else:
+                _, meta = ZwiftTraining.parse_tcx_file(path)
+                np.testing.assert_equal(summary['calories'], meta['calories'])
+                self.assertEqual(summary['sport'], 'biking')
+                
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        df, meta = ZwiftTraining.parse_tcx_file('tcx_gpx_fit_files/activity_4944741403.tcx')
+        meta['calories'] = np.NaN
+        zt.save_activity(df, meta, quiet=True)
+        zt._update_tcx_calories('tcx_gpx_fit_files', max=10)
+        self.assertEqual(zt.get_activities()['calories'].iloc[0], 289)
+        
+    def test_probe_file(self):
+        for file in sorted(os.listdir('tcx_gpx_fit_files')):
+            path = os.path.join('tcx_gpx_fit_files', file)
+            probe = ZwiftTraining.probe_file(path)
+            _, meta = ZwiftTraining.parse_file(path)
+            self.assertEqual(probe['src_file'], file)
+            self.assertEqual(probe['dtime'], meta['dtime'])
+        self.assertEqual(ZwiftTraining.probe_file('tcx_gpx_fit_files/2246203970.gpx')['sport'], 'ride')
+        self.assertEqual(ZwiftTraining.probe_file('tcx_gpx_fit_files/activity_4944741403.tcx')['sport'], 'biking')
+        
+        # Files outside the date range are not parsed
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        with mock.patch.object(ZwiftTraining, 'parse_file', side_effect=ZwiftTraining.parse_file) as parse_file:
+            n_updates = zt.import_files('tcx_gpx_fit_files', from_dtime='2020-05-17', to_dtime='2020-05-17', quiet=True)
+        # Three exports of the same ride
+        self.assertEqual(n_updates, 1)
+        self.assertEqual(parse_file.call_count, 1)
+        
+    def test_process_activity(self):
+        n = 10
+        df = pd.DataFrame(OrderedDict(dtime=pd.date_range('2020-01-01 06:00', periods=n, freq='S'),
+                                      latt=np.NaN, long=np.NaN, elevation=np.arange(n) * 0.5,
+                                      distance=[0, 0.005, 0.01, 0.01, 0.01, 0.015, 0.02, 0.025, 0.03, 0.035],
+                                      hr=np.arange(n) + 100., cadence=80., speed=np.NaN, 
+                                      power=[100, 200, 300, 400, 500, 2600, 100, 100, 100, 100], temp=np.NaN))
+        orig = df.copy()
+        result, meta = ZwiftTraining._process_activity(df, OrderedDict(dtime=df['dtime'].iloc[0], sport='ride'))
+        pd.testing.assert_frame_equal(df, orig)
+        
+        self.assertEqual(list(result.columns), ['dtime', 'duration', 'mov_duration', 'latt', 'long', 'elevation',
+                                                'movement', 'distance', 'hr', 'cadence', 'speed', 'power', 'temp'])
+        # Samples without movement are removed, but keep their index
+        self.assertEqual(list(result.index), [1, 2, 5, 6, 7, 8, 9])
+        self.assertEqual(list(result['mov_duration']), list(range(7)))
+        self.assertEqual(list(result['duration']), [1, 2, 5, 6, 7, 8, 9])
+        self.assertEqual(list(result['movement']), [5] * 7)
+        self.assertEqual(list(result['speed']), [9, 12, 6, 12, 18, 18, 18])
+        # Clipped at 2500, then smoothed
+        self.assertEqual(list(result['power']), [150, 250, 1500, 1300, 100, 100, 100])
+        self.assertEqual(meta['sport'], 'cycling')
+        self.assertEqual(meta['mov_duration'], pd.Timedelta(seconds=6))
+        self.assertEqual(meta['power_max'], 1500)
+
     def test_import_files(self):
         if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
             shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
             
         zt = ZwiftTraining('test.json', quiet=False)
         n_updates = zt.import_files('tcx_gpx_fit_files', quiet=False)
-        self.assertEqual(n_updates, 9)
+        # Two copies of a ride, and three exports of another
+        self.assertEqual(n_updates, 6)
         
         df = zt.get_activities(from_dtime='2013-11-09', to_dtime='2020-06-27', sport='cycling')
-        self.assertEqual(len(df), 9)
+        self.assertEqual(len(df), 6)
         
         time.sleep(0.5)
         n_updates = zt.import_files('tcx_gpx_fit_files', quiet=False)
         self.assertEqual(n_updates, 0)
 
         df = zt.get_activities()
-        self.assertEqual(len(df), 9)
+        self.assertEqual(len(df), 6)
+
+    def test_import_files_parallel(self):
+        results = []
+        for workers in [None, 3]:
+            if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+                shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+            zt = ZwiftTraining('test.json', quiet=True)
+            n_updates = zt.import_files('tcx_gpx_fit_files', max=3, from_dtime='2020-01-01', 
+                                        workers=workers, quiet=True)
+            # The other files are duplicates of these two rides
+            self.assertEqual(n_updates, 2)
+            results.append(zt.get_activities())
+        
+        pd.testing.assert_frame_equal(results[0], results[1])
+        
+    def test_import_manifest(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        import_dir = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'import-test')
+        os.makedirs(import_dir)
+        for file in ['1873571076.fit', '2020-06-27-06-38-50.fit', '3925200538.fit', 
+                     '4944741403.fit', 'activity_4944741403.tcx']:
+            shutil.copy2(os.path.join('tcx_gpx_fit_files', file), import_dir)
+        
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertEqual(zt.import_files(import_dir, quiet=True), 3)
+        self.assertEqual(sorted(zt.get_activities()['src_file']), 
+                         ['1873571076.fit', '2020-06-27-06-38-50.fit', '4944741403.fit'])
+        
+        df = ImportManifest(zt.import_manifest_file).df.set_index('src_file')
+        self.assertEqual(df.loc['3925200538.fit', 'hash'], df.loc['2020-06-27-06-38-50.fit', 'hash'])
+        self.assertEqual(df.loc['3925200538.fit', 'status'], 'duplicate')
+        self.assertEqual(df.loc['activity_4944741403.tcx', 'status'], 'duplicate')
+        self.assertEqual((df['status']=='imported').sum(), 3)
+        
+        # Unchanged files are not read again
+        zt = ZwiftTraining('test.json', quiet=True)
+        with mock.patch.object(ImportManifest, 'hash_file') as hash_file, \
+             mock.patch.object(ZwiftTraining, 'probe_file') as probe_file:
+            self.assertEqual(zt.import_files(import_dir, quiet=True), 0)
+        self.assertEqual(hash_file.call_count, 0)
+        self.assertEqual(probe_file.call_count, 0)
+        self.assertEqual(len(zt.get_activities()), 3)
+        
+        # A deleted activity is imported again, from one of its copies
+        zt.delete_activity(src_file='2020-06-27-06-38-50.fit')
+        os.remove(os.path.join(import_dir, '2020-06-27-06-38-50.fit'))
+        self.assertEqual(zt.import_files(import_dir, quiet=True), 1)
+        self.assertTrue(zt.activity_exists(src_file='3925200538.fit'))
+        
+        # An incomplete row of an interrupted write is ignored, and replaced by the next row
+        with open(zt.import_manifest_file, 'a') as f:
+            f.write('/x/b.fit,12')
+        shutil.copy2(os.path.join('tcx_gpx_fit_files', '132442327.fit'), import_dir)
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertEqual(zt.import_files(import_dir, quiet=True), 1)
+        df = ImportManifest(zt.import_manifest_file).df
+        self.assertNotIn('/x/b.fit', list(df['path']))
+        self.assertEqual(len(df), 6)
+        self.assertEqual(df.set_index('src_file').loc['132442327.fit', 'status'], 'imported')
+        
+        # An unreadable manifest is started over
+        with open(zt.import_manifest_file, 'a') as f:
+            f.write('/x/b.fit,12,1,2,3,4,5,6,7\n')
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertEqual(zt.import_files(import_dir, quiet=True), 0)
+        self.assertEqual(sorted(ImportManifest(zt.import_manifest_file).df['src_file']), sorted(os.listdir(import_dir)))
+        
+    def test_activity_stores(self):
+        df, meta = ZwiftTraining.parse_fit_file('tcx_gpx_fit_files/4944741403.fit')
+        activities_dir = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'store-test')
+        shutil.rmtree(activities_dir, ignore_errors=True)
+        
+        for fmt in ['csv', 'npz']:
+            store = ActivityStore.create(fmt, activities_dir)
+            store.save(df, meta['dtime'])
+            self.assertEqual(store.list_dtimes(), [meta['dtime']])
+            loaded = store.load(meta['dtime'])
+            self.assertEqual(list(loaded.columns), list(df.columns))
+            pd.testing.assert_frame_equal(loaded, df.reset_index(drop=True), check_dtype=False)
+            store.delete(meta['dtime'])
+            self.assertFalse(store.exists(meta['dtime']))
+        
+    def test_activity_data(self):
+        for path in ['tcx_gpx_fit_files/4944741403.fit', 'tcx_gpx_fit_files/132442327.fit',
+                     'tcx_gpx_fit_files/2246203970.gpx', 'tcx_gpx_fit_files/activity_4944741403.tcx']:
+            df, meta = ZwiftTraining.parse_file(path)
+            df = df.reset_index(drop=True)
+            data = ActivityData.from_dataframe(df)
+            self.assertEqual(len(data), len(df))
+            self.assertEqual(data.start, meta['dtime'])
+            self.assertEqual(data.offsets.dtype, np.int32)
+            self.assertEqual(data.hr.dtype, np.float16)
+            self.assertEqual(data.power.dtype, np.float32)
+            self.assertLess(data.nbytes, df.memory_usage(index=False).sum() * 0.6)
+            # Channels are plain arrays, not copies
+            self.assertIs(data.power, data.power)
+            pd.testing.assert_frame_equal(data.to_dataframe(), df, check_exact=True)
+            
+        with self.assertRaises(AttributeError):
+            data.foo = 1
+            
+        # Decimal temperatures, smoothed from 0.1 degree readings
+        df['temp'] = np.resize([21.3, 21.35, 21.4, -0.05, np.NaN], len(df))
+        pd.testing.assert_frame_equal(ActivityData.from_dataframe(df).to_dataframe(), df, check_exact=True)
+            
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.save_activity(df, meta, quiet=True)
+        data = zt.get_activity_data(dtime=meta['dtime'], compact=True)
+        self.assertIsInstance(data, ActivityData)
+        pd.testing.assert_frame_equal(data.to_dataframe(), zt.get_activity_data(dtime=meta['dtime']))
+        
+    def test_migrate_activities(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.activity_store = ActivityStore.create('csv', zt.activities_dir)
+        df, meta = ZwiftTraining.parse_fit_file('tcx_gpx_fit_files/4944741403.fit')
+        zt.save_activity(df, meta, quiet=True)
+        
+        zt.activity_store = ActivityStore.create('npz', zt.activities_dir)
+        before = zt.get_activity_data(dtime=meta['dtime'])
+        report = zt.migrate_activities(quiet=True)
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report['src_format'].iloc[0], 'csv')
+        self.assertFalse(os.path.exists(os.path.join(zt.activities_dir, meta['dtime'].strftime('%Y-%m-%d_%H-%M-%S.csv'))))
+        after = zt.get_activity_data(dtime=meta['dtime'])
+        pd.testing.assert_frame_equal(before, after, check_dtype=False)
 
+    def test_activity_catalog(self):
+        if not os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            os.makedirs(ZwiftTraining.DEFAULT_PROFILE_DIR)
+        path = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'catalog-test.csv')
+        if os.path.exists(path):
+            os.remove(path)
+            
+        catalog = ActivityCatalog(path)
+        self.assertIsNone(catalog.df)
+        self.assertFalse(catalog.exists(src_file='a.fit'))
+        
+        df = pd.DataFrame([dict(dtime=pd.Timestamp('2020-01-02 10:00:00'), title='B', src_file='B.fit',
+                                duration=pd.Timedelta(hours=1), mov_duration=pd.Timedelta(hours=1)),
+                           dict(dtime=pd.Timestamp('2020-01-01 10:00:00'), title=None, src_file='a.fit',
+                                duration=pd.Timedelta(hours=2), mov_duration=pd.Timedelta(hours=1))])
+        catalog.save(df)
+        self.assertEqual(list(catalog.df['src_file']), ['a.fit', 'B.fit'])
+        self.assertTrue(catalog.exists(src_file='A.FIT'))
+        self.assertTrue(catalog.exists(src_file='b.fit'))
+        self.assertFalse(catalog.exists(src_file='c.fit'))
+        self.assertTrue(catalog.exists(dtime='2020-01-01 11:59:00'))
+        self.assertTrue(catalog.exists(dtime='2020-01-01 12:01:00'))   # within tolerance
+        self.assertFalse(catalog.exists(dtime='2020-01-01 12:02:00'))
+        self.assertTrue(catalog.exists(dtime='2020-01-02 09:59:00'))   # within tolerance
+        self.assertFalse(catalog.exists(dtime='2020-01-01 09:58:00'))
+        self.assertEqual(list(catalog.positions('2020-01-02', None)), [1])
+        
+        # Modified by someone else
+        time.sleep(0.01)
+        raw = pd.read_csv(path)
+        raw.iloc[:1].to_csv(path, index=False)
+        self.assertEqual(len(catalog.df), 1)
+        self.assertFalse(catalog.exists(src_file='b.fit'))
+        
+    def test_activity_catalog_update(self):
+        if not os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            os.makedirs(ZwiftTraining.DEFAULT_PROFILE_DIR)
+        path = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'update-test.csv')
+        for p in [path, path + '.journal']:
+            if os.path.exists(p):
+                os.remove(p)
+                
+        catalog = ActivityCatalog(path)
+        self.assertEqual(catalog.update({'a.fit': dict(calories=100.)}), ['a.fit'])
+        rows = [dict(dtime=pd.Timestamp('2020-01-01') + pd.Timedelta(days=i), title=f'{i}', src_file=f'{i}.fit',
+                     duration=pd.Timedelta(hours=1), mov_duration=pd.Timedelta(hours=1), calories=np.NaN)
+                for i in range(5)]
+        catalog.save(pd.DataFrame(rows))
+        catalog.put(dict(rows[0], dtime=pd.Timestamp('2020-02-01'), title='journal', src_file='j.fit'))
+        
+        updates = pd.DataFrame({'src_file': ['3.fit', 'x.fit', '1.fit', 'j.fit', '3.fit'],
+                                'calories': [300., 1., 100., 50., 333.]})
+        self.assertEqual(catalog.update(updates), ['x.fit'])
+        self.assertFalse(os.path.exists(path + '.journal'))
+        catalog = ActivityCatalog(path)
+        np.testing.assert_array_equal(catalog.df['calories'], [np.NaN, 100, np.NaN, 333, np.NaN, 50])
+        self.assertEqual(list(catalog.df['title']), ['0', '1', '2', '3', '4', 'journal'])
+        
+        catalog.update({'2.fit': dict(title='Two', calories=200.)})
+        self.assertEqual(catalog.df['title'].iloc[2], 'Two')
+        self.assertEqual(catalog.df['calories'].iloc[2], 200)
+        
+    def test_activity_journal(self):
+        if not os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            os.makedirs(ZwiftTraining.DEFAULT_PROFILE_DIR)
+        path = os.path.join(ZwiftTraining.DEFAULT_PROFILE_DIR, 'journal-test.csv')
+        for p in [path, path + '.journal']:
+            if os.path.exists(p):
+                os.remove(p)
+        
+        def row(dtime, src_file, power_avg):
+            return dict(dtime=pd.Timestamp(dtime), title='', src_file=src_file, route='', 
+                        duration=pd.Timedelta(hours=1), mov_duration=pd.Timedelta(hours=1), 
+                        power_avg=power_avg)
+        
+        catalog = ActivityCatalog(path)
+        with catalog.batch():
+            catalog.put(row('2020-01-02 10:00:00', 'b.fit', 100))
+            catalog.put(row('2020-01-01 10:00:00', 'a.fit', 110))
+            catalog.put(row('2020-01-03 10:00:00', 'c.fit', 120))
+            catalog.put(row('2020-01-02 10:00:00', 'b.fit', 130))   # overwrite
+            catalog.delete('c.fit', '2020-01-03 10:00:00')
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(list(catalog.df['src_file']), ['a.fit', 'b.fit'])
+            
+            # Replayed from journal by another reader
+            other = ActivityCatalog(path)
+            pd.testing.assert_frame_equal(other.df, catalog.df)
+            
+        # Compacted at the end of batch
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.journal'))
+        self.assertEqual(list(catalog.df['power_avg']), [110, 130])
+        pd.testing.assert_frame_equal(other.df, catalog.df, check_dtype=False)
+        
+        # Interrupted write leaves incomplete line in the journal
+        catalog.put(row('2020-01-04 10:00:00', 'd.fit', 140))
+        with open(path + '.journal', 'a') as f:
+            f.write('{"op": "put", "src_fi')
+        other = ActivityCatalog(path)
+        self.assertEqual(list(other.df['src_file']), ['a.fit', 'b.fit', 'd.fit'])
+        
+        # The next entries replace the incomplete line, and bad lines are skipped 
+        # when the journal is replayed
+        catalog.put(row('2020-01-05 10:00:00', 'e.fit', 150))
+        with open(path + '.journal', 'a') as f:
+            f.write('{"op": "put", "src_file": "x.fit"\n')
+        catalog.put(row('2020-01-06 10:00:00', 'f.fit', 160))
+        self.assertEqual(list(catalog.df['src_file']), ['a.fit', 'b.fit', 'd.fit', 'e.fit', 'f.fit'])
+        other = ActivityCatalog(path)
+        pd.testing.assert_frame_equal(other.df, catalog.df)
+        self.assertTrue(other.exists(dtime='2020-01-06 10:30:00'))
+        self.assertTrue(other.exists(src_file='E.FIT'))
+        
     def test_zwift_update(self):
         if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
             shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
@@ -214,11 +762,341 @@ class TestZwiftTraining(unittest.TestCase):
         df = zt.get_activities(to_dtime=pd.Timestamp.now())
         self.assertEqual(len(df), 1)
 
+    def test_zwift_update_concurrent(self):
+        results = []
+        for workers, processes in [(None, None), (4, None), (4, 2)]:
+            if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+                shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+            zt = ZwiftTraining('test.json', quiet=True)
+            zt.zwift_client = client = FakeZwiftClient(n_activities=12, fail_ids=[1003])
+            n_updates = zt.zwift_update(max=12, batch=5, profile=False, workers=workers, processes=processes,
+                                        quiet=True)
+            self.assertEqual(n_updates, 12)
+            self.assertEqual(client.fail_ids, set())
+            results.append(zt.get_activities())
+            stats = zt.zwift_sync_stats
+            self.assertEqual(list(stats.index), ['fetch', 'parse', 'save'])
+            self.assertEqual(list(stats['done']), [12, 12, 12])
+            self.assertEqual(stats['failed'].sum(), 0)
+            self.assertLessEqual(stats['max_queued'].max(), 8)
+            self.assertGreater(stats.loc['fetch', 'busy'], 12 * client.latency)
+            if workers:
+                self.assertGreater(client.max_active, 1)
+                # The downloads plus the listing of the activities
+                self.assertLessEqual(client.max_active, workers + 1)
+                
+        pd.testing.assert_frame_equal(results[0], results[1])
+        pd.testing.assert_frame_equal(results[0], results[2])
+        self.assertEqual(list(results[1]['src_file']), [f'{1000+i}.zwift' for i in reversed(range(12))])
+        
+        # Nothing new
+        self.assertEqual(zt.zwift_update(max=12, profile=False, workers=4, quiet=True), 0)
+        
+        # Rate limited
+        shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.zwift_client = client = FakeZwiftClient(n_activities=6, latency=0)
+        zt.zwift_update(max=6, profile=False, workers=4, rate_limit=20, quiet=True)
+        times = sorted(client.request_times)
+        self.assertGreaterEqual(times[-1] - times[0], 0.9 * (len(times) - 1) / 20)
+
+    def test_zwift_session(self):
+        server = ZwiftStandInServer(n_activities=6, latency=0.01)
+        auth = FakeAuthToken(server)
+        expected = process_fit_data(decode_fit_file(server.fit_data))
+        try:
+            with ZwiftSession(auth, 1, base_url=server.url, file_url=server.file_url, pool_size=3) as session:
+                activities = session.list(start=0, limit=10)
+                self.assertEqual([a['id'] for a in activities], list(range(1000, 1006)))
+                self.assertEqual(session.get_data(1000), expected)
+                self.assertEqual(server.connections, 1)
+                
+                # The token expires: the concurrent downloads share a single refresh
+                server.token = 'token-2'
+                results = asyncio.run(session.aget_data_many([a['id'] for a in activities]))
+                self.assertEqual(results, [expected] * len(activities))
+                self.assertEqual(auth.refreshes, 2)
+                self.assertLessEqual(server.connections, 3)
+                self.assertEqual(len(asyncio.run(session.alist(start=4, limit=10))), 2)
+        finally:
+            server.close()
+            
+        # All the Zwift requests share one activity client
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.zwift_client = FakeZwiftClient()
+        self.assertIs(zt.zwift_activity_client, zt.zwift_activity_client)
+        
+    def test_zwift_update_resume(self):
+        shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.zwift_client = client = FakeZwiftClient(n_activities=20, latency=0)
+        
+        # Backfill stopped by max
+        self.assertEqual(zt.zwift_update(max=8, batch=5, profile=False, quiet=True), 8)
+        state = zt.zwift_sync_state
+        self.assertIsNone(state['high_water'])
+        self.assertEqual(state['checkpoint']['index'], 8)
+        self.assertEqual(state['checkpoint']['high_water']['id'], 1000)
+        
+        # Interrupted by a failed download, after saving 1008-1011
+        client.fail_ids = {1012}
+        with self.assertRaises(ConnectionError):
+            zt.zwift_update(max=10, batch=5, profile=False, retries=0, quiet=True)
+        state = zt.zwift_sync_state
+        self.assertEqual(len(zt.get_activities()), 12)
+        self.assertEqual(state['checkpoint']['index'], 12)
+        self.assertEqual(pd.Timestamp(state['checkpoint']['dtime']), 
+                         zt.get_activities()['dtime'].min())
+        
+        # New activities meanwhile are synced first, then the backfill continues
+        client.add_activities(2)
+        for _ in range(5):
+            zt.zwift_update(max=10, batch=5, profile=False, quiet=True)
+            if not zt.zwift_sync_state['checkpoint']:
+                break
+        state = zt.zwift_sync_state
+        self.assertIsNone(state['checkpoint'])
+        self.assertEqual(state['high_water']['id'], client.activities[0]['id'])
+        self.assertEqual(sorted(zt.get_activities()['src_file']),
+                         sorted(f'{a["id"]}.zwift' for a in client.activities))
+        
+        # Only the new activities are fetched
+        client.add_activities(3)
+        client.calls.clear()
+        self.assertEqual(zt.zwift_update(max=50, batch=10, profile=False, quiet=True), 3)
+        self.assertEqual(client.calls['list'], 1)
+        self.assertEqual(client.calls['get_data'], 3)
+        self.assertEqual(zt.zwift_sync_state['high_water']['id'], client.activities[0]['id'])
+        
+        # Explicit ranges don't use (nor move) the cursor
+        client.calls.clear()
+        self.assertEqual(zt.zwift_update(max=50, batch=10, profile=False, incremental=False, quiet=True), 0)
+        self.assertGreater(client.calls['list'], 1)
+        self.assertEqual(zt.zwift_sync_state['high_water']['id'], client.activities[0]['id'])
+
     def not_test_benny(self):
         zt = ZwiftTraining('../benny.json')
         n_updates = zt.update('/home/bennylp/Desktop/Google Drive/My Drive/Personal/Cycling/activities/raw')
         print(f'Done {n_updates} updates')
 
+    def test_calc_max_powers(self):
+        power = pd.Series([100, 150.5, 300, 250, 50, 120.5, 400, 10, 350, 200])
+        periods = [1, 2, 3, 5, 10, 11]
+        expected = [power.rolling(p).mean().max() for p in periods]
+        np.testing.assert_array_equal(ZwiftTraining.calc_mean_max(power, periods), expected)
+
+        df = pd.DataFrame({'dtime': pd.date_range('2020-01-01', periods=len(power), freq='S'),
+                           'power': power})
+        result = ZwiftTraining.calc_max_powers(df)
+        self.assertEqual(result['dtime'], pd.Timestamp('2020-01-01'))
+        self.assertEqual(result['1'], 400)
+        self.assertEqual(result['2'], 375)
+        self.assertEqual(result['5'], 234.1)   # without the 10 watts sample
+        self.assertTrue(np.isnan(result['10']))
+        self.assertEqual(len(result), len(ZwiftTraining.POWER_CURVE_PERIODS) + 1)
+
+    def test_calc_normalized_power(self):
+        power = pd.Series(np.tile([100.]*45 + [300.]*15, 10))
+        expected = (power.rolling(30).mean().dropna() ** 4).mean() ** 0.25
+        self.assertAlmostEqual(ZwiftTraining.calc_normalized_power(power), expected, places=6)
+        self.assertGreater(ZwiftTraining.calc_normalized_power(power), power.mean())
+        self.assertEqual(ZwiftTraining.calc_normalized_power(np.full(100, 200.)), 200)
+        self.assertEqual(ZwiftTraining.calc_normalized_power([100, 200, np.NaN]), 150)
+        self.assertTrue(np.isnan(ZwiftTraining.calc_normalized_power([np.NaN, np.NaN])))
+        
+        # The window is 30 seconds of elapsed time, not 30 samples
+        duration = np.arange(len(power))
+        self.assertAlmostEqual(ZwiftTraining.calc_normalized_power(power, duration=duration), expected, places=6)
+        duration = np.where(duration < 300, duration, duration + 20)
+        gap = pd.Series(power.values, index=pd.to_timedelta(duration, unit='s')).rolling('30s').mean()
+        expected = (gap[ duration >= 29 ] ** 4).mean() ** 0.25
+        self.assertAlmostEqual(ZwiftTraining.calc_normalized_power(power, duration=duration), expected, places=6)
+        self.assertNotAlmostEqual(ZwiftTraining.calc_normalized_power(power), expected, places=2)
+        
+        df, meta = ZwiftTraining.parse_fit_file('tcx_gpx_fit_files/4944741403.fit')
+        self.assertAlmostEqual(meta['power_np'], ZwiftTraining.calc_normalized_power(df['power'], duration=df['duration']), 
+                               places=2)
+        self.assertGreaterEqual(meta['power_np'], meta['power_avg'])
+        self.assertAlmostEqual(meta['power_vi'], meta['power_np'] / meta['power_avg'], places=3)
+
+    def test_power_curve_cache(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.import_files('tcx_gpx_fit_files', from_dtime='2020-01-01', quiet=True)
+        dtimes = zt._list_activity_dtimes()
+        self.assertGreaterEqual(len(dtimes), 2)
+        self.assertEqual(list(zt.power_curve_cache.df.index), dtimes)
+
+        curve = zt.calc_power_curve()
+        self.assertEqual(list(curve.index), dtimes)
+        self.assertEqual(list(curve.columns), [str(p) for p in ZwiftTraining.POWER_CURVE_PERIODS])
+
+        # Rebuilt from the activity data
+        os.remove(zt.power_curve_file)
+        pd.testing.assert_frame_equal(ZwiftTraining('test.json', quiet=True).calc_power_curve(), curve)
+
+        # The incomplete last row of an interrupted write is ignored, and replaced by the next row
+        columns = zt.power_curve_cache.columns
+        with open(zt.power_curve_file, 'a') as f:
+            f.write('2021-01-01 00:00:00,100.0,9')
+        cache = ZwiftTraining('test.json', quiet=True).power_curve_cache
+        self.assertEqual(list(cache.df.index), dtimes)
+        cache.put([dict(dtime=pd.Timestamp('2021-01-02'), **{c: 1. for c in columns})])
+        cache = ZwiftTraining('test.json', quiet=True).power_curve_cache
+        self.assertEqual(list(cache.df.index), dtimes + [pd.Timestamp('2021-01-02')])
+        
+        # An unreadable file is rebuilt from the activity data
+        with open(zt.power_curve_file, 'a') as f:
+            f.write('2021-01-03 00:00:00,' + ','.join(['1.0'] * (len(columns) + 2)) + '\n')
+        zt = ZwiftTraining('test.json', quiet=True)
+        pd.testing.assert_frame_equal(zt.calc_power_curve(), curve)
+        
+        dtime = curve.index[0]
+        zt.delete_activity(dtime=dtime, quiet=True)
+        self.assertNotIn(dtime, zt.power_curve_cache.df.index)
+        self.assertNotIn(dtime, ZwiftTraining('test.json', quiet=True).power_curve_cache.df.index)
+        pd.testing.assert_frame_equal(zt.calc_power_curve(), curve.iloc[1:])
+
+    def test_activity_histograms(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.import_files('tcx_gpx_fit_files', from_dtime='2020-01-01', quiet=True)
+        pd.DataFrame([dict(dtime=pd.Timestamp('2020-05-01'), ftp=200)]).to_csv(zt.zwift_profile_updates_csv,
+                                                                               index=False)
+
+        # Expected durations, from the activity data
+        power_zones = [0] + ZwiftTraining.POWER_ZONES + [1e10]
+        hr_zones = [0] + ZwiftTraining.HR_ZONES + [1e10]
+        power_duration = np.zeros(len(power_zones)-1)
+        hr_duration = np.zeros(len(hr_zones)-1)
+        for dtime in zt.get_activities(sport='cycling')['dtime']:
+            data = zt.get_activity_data(dtime=dtime)
+            pct_ftp = data['power'] / 200
+            pct_hr = data['hr'] / 180
+            for i in range(len(power_zones)-1):
+                power_duration[i] += ((pct_ftp > power_zones[i]) & (pct_ftp <= power_zones[i+1])).sum()
+            for i in range(len(hr_zones)-1):
+                hr_duration[i] += ((pct_hr > hr_zones[i]) & (pct_hr <= hr_zones[i+1])).sum()
+
+        for i in range(2):
+            power = zt.calc_power_zones_duration('2020-01-01', '2020-12-31')
+            self.assertEqual(list(power['duration']), list(power_duration))
+            hr = zt.calc_hr_zones_duration('2020-01-01', '2020-12-31', max_hr=180)
+            self.assertEqual(list(hr['duration']), list(hr_duration))
+            if i == 0:
+                # Next, calculated from the activity data again
+                shutil.rmtree(zt.histograms_dir)
+
+        dtime = zt.get_activities()['dtime'].iloc[0]
+        self.assertTrue(os.path.exists(zt.histograms.path(dtime)))
+        zt.delete_activity(dtime=dtime, quiet=True)
+        self.assertFalse(os.path.exists(zt.histograms.path(dtime)))
+
+    def test_sample_archive(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.import_files('tcx_gpx_fit_files', quiet=True)
+        self.assertFalse(zt.archive.exists())
+        expected_curve = zt.calc_power_curve(max_hr=160)
+        
+        dtimes = zt._list_activity_dtimes()
+        self.assertEqual(zt.rebuild_archive(quiet=True), len(dtimes))
+        self.assertEqual(zt.archive.dtimes(), dtimes)
+        self.assertEqual(zt.check_archive(verify=True, quiet=True), [])
+        
+        # Zero-copy views of the memory mapped files
+        data = zt.archive.load(dtimes[0])
+        self.assertIsInstance(data.power.base, np.memmap)
+        pd.testing.assert_frame_equal(zt.calc_power_curve(max_hr=160), expected_curve)
+        
+        # Kept up to date
+        dtime = zt.get_activities()['dtime'].iloc[-1]
+        zt.delete_activity(dtime=dtime, quiet=True)
+        self.assertNotIn(dtime, zt.archive.dtimes())
+        df, meta = ZwiftTraining.parse_file('tcx_gpx_fit_files/4944741403.fit')
+        zt.save_activity(df, meta, overwrite=True, quiet=True)
+        self.assertTrue(zt.archive.contains(meta['dtime']))
+        pd.testing.assert_frame_equal(zt.archive.load(meta['dtime']).to_dataframe(), 
+                                      df.reset_index(drop=True))
+        self.assertEqual(zt.check_archive(verify=True, quiet=True), [])
+        
+        # Samples of an interrupted write are overwritten by the next one
+        with open(zt.archive.path('power'), 'ab') as f:
+            f.write(b'garbage!')
+        self.assertEqual(len(zt.check_archive(quiet=True)), 1)
+        zt.save_activity(df, meta, overwrite=True, quiet=True)
+        self.assertEqual(zt.check_archive(verify=True, quiet=True), [])
+        
+        # An incomplete index row is ignored, and replaced by the next row
+        with open(zt.archive.index_path, 'a') as f:
+            f.write(f'{meta["dtime"]},{meta["dtime"]},12')
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertEqual(zt.check_archive(verify=True, quiet=True), [])
+        zt.save_activity(df, meta, overwrite=True, quiet=True)
+        self.assertEqual(ZwiftTraining('test.json', quiet=True).check_archive(verify=True, quiet=True), [])
+        
+        # A rebuild interrupted after moving the old archive aside
+        os.replace(zt.archive_dir, zt.archive_dir + '.old')
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertTrue(zt.archive.contains(meta['dtime']))
+        
+        # Same archive read by a new instance, then rebuilt without the replaced samples
+        size = os.path.getsize(zt.archive.path('power'))
+        zt = ZwiftTraining('test.json', quiet=True)
+        self.assertTrue(zt.archive.contains(meta['dtime']))
+        zt.rebuild_archive(quiet=True)
+        self.assertLess(os.path.getsize(zt.archive.path('power')), size)
+        self.assertEqual(zt.check_archive(verify=True, quiet=True), [])
+        
+    def test_training_load(self):
+        if os.path.exists(ZwiftTraining.DEFAULT_PROFILE_DIR):
+            shutil.rmtree(ZwiftTraining.DEFAULT_PROFILE_DIR, ignore_errors=True)
+        zt = ZwiftTraining('test.json', quiet=True)
+        zt.import_files('tcx_gpx_fit_files', quiet=True)
+        pd.DataFrame([dict(dtime=pd.Timestamp('2013-10-01'), ftp=230),
+                      dict(dtime=pd.Timestamp('2020-05-01'), ftp=200)]).to_csv(zt.zwift_profile_updates_csv,
+                                                                               index=False)
+
+        def expected():
+            # ewm() over the whole history
+            tss = zt._calc_daily_tss('cycling')
+            df = pd.DataFrame({'tss': tss,
+                               'Fitness (CTL)': tss.ewm(span=42).mean(),
+                               'Fatigue (ATL)': tss.ewm(span=7).mean()})
+            df['Form (TSB)'] = df['Fitness (CTL)'] - df['Fatigue (ATL)']
+            return df
+
+        def check(df):
+            pd.testing.assert_frame_equal(df, expected(), check_exact=True, check_names=False,
+                                          check_freq=False)
+
+        form = zt.calc_training_form()
+        check(form)
+        self.assertTrue(os.path.exists(zt.training_load_file(42, 7)))
+        self.assertGreater(form['tss'].sum(), 0)
+
+        # Continued from the checkpoint, in the same and a new instance
+        check(zt.calc_training_form())
+        check(ZwiftTraining('test.json', quiet=True).calc_training_form())
+        zt.invalidate_training_load('2020-01-01')
+        self.assertEqual(zt._training_load(42, 7).df.index[-1], pd.Timestamp('2019-12-31'))
+        check(zt.calc_training_form())
+
+        # Partial
+        pd.testing.assert_frame_equal(zt.calc_training_form(from_dtime='2020-01-01'),
+                                      form.loc['2020-01-01':], check_exact=True)
+
+        # Deleting an activity recalculates from its date
+        dtime = zt.get_activities(sport='cycling')['dtime'].iloc[-1]
+        zt.delete_activity(dtime=dtime, quiet=True)
+        self.assertLess(zt._training_load(42, 7).df.index[-1], dtime.normalize())
+        form2 = zt.calc_training_form()
+        check(form2)
+        self.assertLess(form2['tss'].sum(), form['tss'].sum())
+
     def test_ftp_history(self):
         df = pd.DataFrame([dict(dtime=pd.Timestamp('2020-01-01 10:00:00'), ftp=250), 
                            dict(dtime=pd.Timestamp('2020-06-01 10:00:00'), ftp=260)])
@@ -243,8 +1121,23 @@ class TestZwiftTraining(unittest.TestCase):
         self.assertEqual(f.get_ftp('2020-01-01'), 250)   # right on
         self.assertEqual(f.get_ftp('2020-01-10'), 250)
         self.assertEqual(f.get_ftp('2019-12-02'), 240)   # less than MAX_PRIOR_VALIDITY
-        
-    
+
+        # Bulk lookup must agree with get_ftp()
+        dates = ['2019-06-01', '2019-12-02', '2019-12-31', '2020-01-01', '2020-01-10',
+                 '2020-02-15', '2020-05-29', '2020-06-01', '2021-01-01']
+        ftps = f.get_ftp_many(dates)
+        self.assertEqual(len(ftps), len(dates))
+        for dtime, ftp in zip(dates, ftps):
+            expected = f.get_ftp(dtime)
+            if expected is None:
+                self.assertTrue(np.isnan(ftp))
+            else:
+                self.assertEqual(ftp, expected)
+
+        f = FTPHistory(df, default_ftp=200)
+        self.assertEqual(list(f.get_ftp_many(['2019-06-01', '2020-01-01'])), [200, 250])
+
+
 if __name__ == '__main__':
     if False:
         suite = unittest.TestSuite()
@@ -1 +1,2 @@
-from .ztraining import FTPHistory, ZwiftTraining
+from .ztraining import (ActivityCatalog, ActivityData, ActivityHistograms, ActivityStore, FTPHistory, 
+                        ImportManifest, PowerCurveCache, SampleArchive, ZwiftSession, ZwiftTraining)
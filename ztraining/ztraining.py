@@ -1,19 +1,37 @@
+import array
+import asyncio
+import bisect
+import builtins
+import collections
 from collections import OrderedDict
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import glob
+import hashlib
+import io
 import json
 import math
 import os
 import re
+import shutil
+import struct
 import sys
+import threading
+import time
 from xml.dom import minidom
+from xml.etree import ElementTree
 
 from fitparse import FitFile, FitParseError
 from geopy import distance
 import pytz
+import requests
 from sklearn.linear_model import LinearRegression
 from sklearn.svm import SVR
 from zwift import Client
+from zwift.activity import decode_fit_file, process_fit_data
+from zwift.error import RequestException
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -29,6 +47,293 @@ def sec_to_str(sec, full=False):
     return s
 
 
+def atomic_to_csv(df, path):
+    """
+    Write df to CSV file, so that the file is either completely written or unchanged.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        df.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def truncate_partial_line(path):
+    """
+    Remove the incomplete last line left by an interrupted write from a file which is
+    appended to line by line, so that the next line appended does not join it. 
+    Returns the size of the file, or None if it does not exist.
+    """
+    try:
+        f = open(path, 'rb+')
+    except FileNotFoundError:
+        return None
+    with f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            pos = f.read(end - start).rfind(b'\n')
+            if pos >= 0:
+                end = start + pos + 1
+                break
+            end = start
+        if end != size:
+            f.truncate(end)
+        return end
+
+
+def read_appended_csv(path, **kwargs):
+    """
+    Read a CSV file which is appended to line by line, ignoring the incomplete last line 
+    left by an interrupted write. Returns None if the file does not have a complete 
+    header line.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    data = data[:data.rfind(b'\n') + 1]
+    if not data:
+        return None
+    return pd.read_csv(io.BytesIO(data), **kwargs)
+
+
+def file_stat(path):
+    """
+    Returns (mtime_ns, size) of the file, or None if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+
+class FileCache:
+    """
+    In-memory copy of a file (df), which is only re-read when the modification time or
+    size of the file changes, e.g. when it has been modified by another process.
+    Subclasses set path and implement _load(stat), which reads the file (or starts 
+    empty if stat is None, i.e. the file does not exist) and sets _df and _stat.
+    """
+    def __init__(self):
+        self._df = None
+        self._stat = None
+        
+    @property
+    def df(self):
+        """
+        The returned DataFrame is shared and must not be modified in place.
+        """
+        stat = self._file_stat()
+        if stat != self._stat or self._df is None:
+            self._load(stat)
+        return self._df
+    
+    def invalidate(self):
+        self._df = None
+        self._stat = None
+        
+    def _file_stat(self):
+        return file_stat(self.path)
+    
+    def _load(self, stat):
+        raise NotImplementedError()
+
+
+class RateLimiter:
+    """
+    Spaces out calls of wait() from any number of threads so that there are at most
+    rate calls per second. No limit if rate is None or zero.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1. / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+        
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            t = max(now, self._next)
+            self._next = t + self.interval
+        if t > now:
+            time.sleep(t - now)
+
+
+def call_with_retry(func, retries=3, backoff=1., limiter=None, no_retry=()):
+    """
+    Call func(), retrying up to retries times when it raises an exception other than 
+    no_retry, waiting backoff seconds before the first retry and doubling it after each.
+    If limiter (RateLimiter) is specified, every attempt waits for it.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return func()
+        except no_retry:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            sys.stderr.write(f'Warning: {e.__class__.__name__}: {str(e)}. Retrying in {backoff * 2**attempt:g}s\n')
+            time.sleep(backoff * 2**attempt)
+
+
+def timed_call(func, *args):
+    """
+    Call func(*args). Returns (seconds elapsed, return value).
+    """
+    t0 = time.perf_counter()
+    value = func(*args)
+    return time.perf_counter() - t0, value
+
+
+class StageCounters:
+    """
+    Counters of a stage of a pipeline: the number of items done and failed, the seconds
+    spent on them (summed over the workers), the seconds that the next stage waited for
+    them, and the maximum number of items pending in the stage.
+    """
+    def __init__(self, stage=None):
+        self.stage = stage
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.
+        self.wait = 0.
+        self.max_queued = 0
+        
+    def add(self, busy):
+        self.done += 1
+        self.busy += busy
+        
+    def to_dict(self):
+        return OrderedDict(stage=self.stage, done=self.done, failed=self.failed, busy=round(self.busy, 3), 
+                           wait=round(self.wait, 3), max_queued=self.max_queued)
+    
+    @staticmethod
+    def to_dataframe(counters):
+        return pd.DataFrame([c.to_dict() for c in counters]).set_index('stage')
+
+
+class ZwiftSession:
+    """
+    Client of the Zwift activities of a player, sharing a pool of keep-alive connections
+    and the access token between threads and asyncio tasks. zwift.Client's Activity
+    opens a new connection for every request.
+    
+    list(), get_activity() and get_data() are the same as zwift.Client's Activity, so
+    the session can be used in its place. The async variants (alist(), aget_activity(),
+    aget_fit(), aget_data() and aget_data_many()) run them in a pool of pool_size 
+    threads, one per pooled connection.
+    
+    Parameters:
+    - auth_token: Object with get_access_token(), normally zwift.Client's auth_token.
+                  Its access_token is cleared to refresh the token if it is rejected.
+    - player_id:  Zwift player id.
+    - base_url:   URL of the Zwift API.
+    - file_url:   Format of the URL of the FIT files, with the bucket and key of the
+                  activity.
+    - pool_size:  Maximum number of connections per host and of concurrent requests
+                  of the async methods.
+    """
+    BASE_URL = 'https://us-or-rly101.zwift.com'
+    FILE_URL = 'https://{bucket}.s3.amazonaws.com/{key}'
+    HEADERS = {'User-Agent': 'Zwift/115 CFNetwork/758.0.2 Darwin/15.0.0'}
+    
+    def __init__(self, auth_token, player_id, base_url=BASE_URL, file_url=FILE_URL, pool_size=8):
+        self.auth_token = auth_token
+        self.player_id = player_id
+        self.base_url = base_url
+        self.file_url = file_url
+        self.session = requests.Session()
+        self.session.headers.update(self.HEADERS)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+        self._token = None
+        self._token_lock = threading.Lock()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        
+    def close(self):
+        self._executor.shutdown()
+        self.session.close()
+        
+    def access_token(self, rejected=None):
+        """
+        Get the access token, refreshing it in one thread at a time. rejected is a token
+        which the server did not accept. It is refreshed unless another thread already did.
+        """
+        with self._token_lock:
+            if rejected is not None and rejected == self._token:
+                self.auth_token.access_token = None
+            self._token = self.auth_token.get_access_token()
+            return self._token
+        
+    def _get(self, url, accept='application/json', auth=True):
+        def get(token):
+            headers = {'Accept': accept}
+            if token:
+                headers['Authorization'] = 'Bearer ' + token
+            return self.session.get(url, headers=headers)
+        
+        token = self.access_token() if auth else None
+        resp = get(token)
+        if resp.status_code == 401 and auth:
+            # The token expired meanwhile
+            resp = get(self.access_token(rejected=token))
+        if not resp.ok:
+            raise RequestException(f'{resp.status_code} - {resp.reason}')
+        return resp
+        
+    def list(self, start=0, limit=20):
+        return self._get(f'{self.base_url}/api/profiles/{self.player_id}/activities/?start={start}&limit={limit}').json()
+    
+    def get_activity(self, activity_id):
+        return self._get(f'{self.base_url}/api/profiles/{self.player_id}/activities/{activity_id}').json()
+    
+    def get_fit(self, activity_id):
+        """
+        Download the FIT file of an activity.
+        """
+        activity = self.get_activity(activity_id)
+        url = self.file_url.format(bucket=activity['fitFileBucket'], key=activity['fitFileKey'])
+        return self._get(url, accept='*/*', auth=False).content
+    
+    def get_data(self, activity_id):
+        return process_fit_data(decode_fit_file(self.get_fit(activity_id)))
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+    
+    async def alist(self, start=0, limit=20):
+        return await self._run(self.list, start, limit)
+    
+    async def aget_activity(self, activity_id):
+        return await self._run(self.get_activity, activity_id)
+    
+    async def aget_fit(self, activity_id):
+        return await self._run(self.get_fit, activity_id)
+    
+    async def aget_data(self, activity_id):
+        return await self._run(self.get_data, activity_id)
+    
+    async def aget_data_many(self, activity_ids):
+        """
+        get_data() of several activities concurrently. Returns the results in the same order.
+        """
+        return await asyncio.gather(*[self.aget_data(activity_id) for activity_id in activity_ids])
+
+
 def xml_get_text(element):
     rc = []
     for node in element.childNodes:
@@ -53,6 +358,108 @@ def xml_path_val(element, tag_names, default=None):
     return xml_get_text(element)
 
 
+def xml_local_name(tag):
+    """
+    Tag name without the namespace, e.g. "{http://www.garmin.com/...}Watts" -> "Watts"
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+# WGS-84 ellipsoid, the same that geopy uses by default
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+EARTH_MEAN_RADIUS = 6371008.8
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance between arrays of coordinates (in degrees), in meters.
+    Fast, but the error may reach 0.6% since the earth is treated as a sphere.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)]
+    h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_MEAN_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def vincenty_distance(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    """
+    Distance on the WGS-84 ellipsoid between arrays of coordinates (in degrees), in meters,
+    using Vincenty's inverse formula. For the distance between consecutive GPS samples
+    the result matches geopy's geodesic distance to well under a millimeter.
+    Coordinates which fail to converge (nearly antipodal points) are returned as NaN.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)]
+    f = WGS84_F
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lam = L
+        converged = False
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam)**2 + 
+                                (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam)**2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # cos2_alpha is zero on the equator line
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            prev_lam = lam
+            lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * 
+                                                 (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+            diff = np.abs(lam - prev_lam)
+            if not np.any(diff > tol):
+                converged = True
+                break
+        
+        u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m**2) - 
+                                       B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)))
+        dist = WGS84_B * A * (sigma - delta_sigma)
+    
+    if not converged:
+        dist = np.where(diff > tol, np.NaN, dist)
+    return dist
+
+
+class ColumnBuffer:
+    """
+    Preallocated float columns (filled with NaN) which grow as rows are appended.
+    Used by the streaming parsers to avoid building a row object per sample.
+    """
+    def __init__(self, names, capacity=4096):
+        self.names = names
+        self.arrays = {name: np.full(capacity, np.NaN) for name in names}
+        self.n_rows = 0
+        
+    def append_row(self):
+        capacity = len(self.arrays[self.names[0]])
+        if self.n_rows == capacity:
+            for name in self.names:
+                arr = np.full(capacity * 2, np.NaN)
+                arr[:capacity] = self.arrays[name]
+                self.arrays[name] = arr
+        self.n_rows += 1
+        
+    def set(self, name, value):
+        self.arrays[name][self.n_rows-1] = value
+        
+    def get(self, name):
+        return self.arrays[name][self.n_rows-1]
+        
+    def columns(self):
+        return OrderedDict([(name, self.arrays[name][:self.n_rows]) for name in self.names])
+
+
 class FTPHistory:
     MAX_VALIDITY = 3*30
     MAX_PRIOR_VALIDITY = 30
@@ -64,34 +471,1062 @@ class FTPHistory:
         self.default_ftp = default_ftp
         self.max_validity = max_validity
         self.max_prior_validity = self.MAX_PRIOR_VALIDITY
+        
+        # For the lookup: the dates (as datetime64) and the FTP values, in the same order
+        self._dates = df['dtime'].dt.normalize().values
+        self._ftps = df['ftp'].values
     
     def get_ftp(self, dtime):
-        date = pd.Timestamp(dtime).date()
-        min_date = date - pd.Timedelta(days=self.max_validity)
-        max_date = date + pd.Timedelta(days=self.max_prior_validity)
-        ftp = self.ftp_history.loc[min_date:max_date]
-        if not len(ftp):
+        """
+        FTP at the specified time: the last FTP set within max_validity days before (or at)
+        that date, otherwise the first FTP set within MAX_PRIOR_VALIDITY days after that
+        date, otherwise default_ftp.
+        """
+        idx, found = self._lookup(pd.DatetimeIndex([pd.Timestamp(dtime)]))
+        if not found[0]:
             return self.default_ftp
+        val = self._ftps[idx[0]]
+        return self.default_ftp if not val else val
+    
+    def get_ftp_many(self, dtimes):
+        """
+        Returns array of the FTP at each of dtimes (see get_ftp()). Missing FTP is NaN
+        if default_ftp is None.
+        """
+        idx, found = self._lookup(pd.DatetimeIndex(dtimes))
+        default = np.NaN if self.default_ftp is None else self.default_ftp
+        ftp = np.full(len(idx), default, dtype=float)
+        ftp[found] = self._ftps[idx[found]]
+        ftp[ ftp == 0 ] = default
+        return ftp
+    
+    def _lookup(self, dtimes):
+        # Index of the FTP entry of each of dtimes, and whether one is found
+        dates = dtimes.normalize().values
+        n = len(self._dates)
+        after = np.searchsorted(self._dates, dates, side='right')
+        before = after - 1
+        if n == 0:
+            return before, np.zeros(len(dates), dtype=bool)
+        
+        min_dates = dates - np.timedelta64(self.max_validity, 'D')
+        max_dates = dates + np.timedelta64(self.max_prior_validity, 'D')
+        found_before = (before >= 0) & (self._dates[np.clip(before, 0, n-1)] >= min_dates)
+        found_after = (after < n) & (self._dates[np.clip(after, 0, n-1)] <= max_dates)
+        return np.where(found_before, before, after), found_before | found_after
+
+
+class ActivityData:
+    """
+    Compact representation of the samples of an activity (as returned by 
+    _process_activity() and ActivityStore.load()), for holding many activities in memory.
+    
+    Each channel is a typed NumPy array attribute, which can be used directly without
+    copying. The sample times are the activity start time plus int32 offsets in seconds,
+    which are also their durations, and the moving time of each sample is its position.
+    hr and cadence are float16, which holds their (smoothed) half integer values exactly
+    and keeps NaN for missing samples. power is float32, and elevation, speed and temp
+    are float32 which are rounded back to their saved precision by to_dataframe(), so 
+    the DataFrame is the same as the original.
+    """
+    # Channel -> (dtype, decimals to round to when converted back to float64)
+    CHANNELS = OrderedDict([('latt', (np.float64, None)),
+                            ('long', (np.float64, None)),
+                            ('elevation', (np.float32, 2)),
+                            ('movement', (np.float64, None)),
+                            ('distance', (np.float64, None)),
+                            ('hr', (np.float16, None)),
+                            ('cadence', (np.float16, None)),
+                            ('speed', (np.float32, 2)),
+                            ('power', (np.float32, None)),
+                            ('temp', (np.float32, 2))])
+    
+    __slots__ = ['start', 'offsets'] + list(CHANNELS.keys())
+    
+    def __init__(self, start, offsets, **channels):
+        self.start = pd.Timestamp(start)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        for name, (dtype, _) in self.CHANNELS.items():
+            values = channels.get(name)
+            if values is None:
+                values = np.full(len(self.offsets), np.NaN, dtype=dtype)
+            setattr(self, name, np.asarray(values, dtype=dtype))
+    
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        Convert activity data DataFrame. The sample times are truncated to seconds.
+        """
+        dtimes = df['dtime'].to_numpy()
+        if not len(dtimes):
+            start = np.datetime64('NaT')
+        elif 'duration' in df:
+            # The activity starts at duration zero, whose sample may have been dropped
+            start = dtimes[0] - np.timedelta64(int(df['duration'].iloc[0]), 's')
+        else:
+            start = dtimes[0]
+        offsets = ((dtimes - start) // np.timedelta64(1, 's')).astype(np.int32)
+        channels = {name: df[name].to_numpy(dtype=float) for name in cls.CHANNELS if name in df}
+        return cls(start, offsets, **channels)
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + sum([getattr(self, name).nbytes for name in self.CHANNELS])
+    
+    @property
+    def dtimes(self):
+        return self.start.to_datetime64().astype('datetime64[ns]') + self.offsets.astype('timedelta64[s]')
+    
+    def to_dataframe(self):
+        """
+        Returns the data as DataFrame with float64 channels, like ActivityStore.load().
+        """
+        data = OrderedDict(dtime=self.dtimes, duration=self.offsets.astype(float),
+                           mov_duration=np.arange(len(self)))
+        for name, (_, decimals) in self.CHANNELS.items():
+            values = getattr(self, name).astype(float)
+            data[name] = values if decimals is None else np.round(values, decimals)
+        return pd.DataFrame(data)
+
+
+class ActivityStore:
+    """
+    Storage backend for the data (samples) of each activity. Each activity is stored
+    in its own file in the activities directory, named after the activity start time.
+    """
+    FORMAT = None
+    EXTENSION = None
+    FILENAME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+    def __init__(self, activities_dir):
+        self.activities_dir = activities_dir
+
+    @staticmethod
+    def create(fmt, activities_dir):
+        stores = {cls.FORMAT: cls for cls in ACTIVITY_STORES}
+        if fmt not in stores:
+            raise ValueError(f'Unsupported activity format "{fmt}". Valid values: {list(stores.keys())}')
+        return stores[fmt](activities_dir)
+
+    def path(self, dtime):
+        filename = pd.Timestamp(dtime).strftime(self.FILENAME_FORMAT) + self.EXTENSION
+        return os.path.join(self.activities_dir, filename)
+
+    def exists(self, dtime):
+        return os.path.exists(self.path(dtime))
+
+    def list_dtimes(self):
+        """
+        Get the start time of all activities saved in this store, sorted ascending.
+        """
+        files = glob.glob(os.path.join(self.activities_dir, '20*' + self.EXTENSION))
+        dtimes = []
+        for file in files:
+            filepart = os.path.split(file)[1][:-len(self.EXTENSION)]
+            try:
+                dtimes.append(pd.Timestamp(datetime.datetime.strptime(filepart, self.FILENAME_FORMAT)))
+            except ValueError:
+                continue
+        return sorted(dtimes)
+
+    def save(self, df, dtime):
+        if not os.path.exists(self.activities_dir):
+            os.makedirs(self.activities_dir)
+        self._write(df, self.path(dtime))
+
+    def load(self, dtime):
+        return self._read(self.path(dtime))
+
+    def delete(self, dtime):
+        os.remove(self.path(dtime))
+
+    def _write(self, df, path):
+        raise NotImplementedError()
+
+    def _read(self, path):
+        raise NotImplementedError()
+
+
+class CsvActivityStore(ActivityStore):
+    FORMAT = 'csv'
+    EXTENSION = '.csv'
+
+    def _write(self, df, path):
+        df.to_csv(path, index=False)
+
+    def _read(self, path):
+        return pd.read_csv(path, parse_dates=['dtime'])
+
+
+class NpzActivityStore(ActivityStore):
+    """
+    Each column is saved as a typed NumPy array in a compressed .npz file.
+    """
+    FORMAT = 'npz'
+    EXTENSION = '.npz'
+
+    def _write(self, df, path):
+        arrays = OrderedDict([(col, df[col].to_numpy()) for col in df.columns])
+        np.savez_compressed(path, **arrays)
+
+    def _read(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            return pd.DataFrame(OrderedDict([(col, data[col]) for col in data.files]))
+
+
+class ParquetActivityStore(ActivityStore):
+    """
+    Requires pyarrow (or fastparquet) to be installed.
+    """
+    FORMAT = 'parquet'
+    EXTENSION = '.parquet'
+
+    def _write(self, df, path):
+        df.to_parquet(path, index=False, compression='zstd')
+
+    def _read(self, path):
+        return pd.read_parquet(path)
+
+
+ACTIVITY_STORES = [CsvActivityStore, NpzActivityStore, ParquetActivityStore]
+
+
+class SampleArchive(FileCache):
+    """
+    The samples of all activities in one raw binary file per channel (with the dtypes of
+    ActivityData, plus the int32 time offsets), memory mapped so that the samples of any
+    activity are zero-copy slices, without opening and parsing a file per activity. The
+    index file has the start time, position and length of the samples of each activity.
+    
+    The archive is append-only. Saving an activity appends its samples and an index row, 
+    and deleting an activity appends an index row with length -1; the last row of each 
+    activity is used. The samples are written before the index row, starting at the end
+    of the indexed samples, so anything left by an interrupted write is overwritten by 
+    the next one, and an incomplete index row is ignored and truncated before the next 
+    row. rebuild() writes a new archive without the replaced and deleted samples.
+    """
+    INDEX_COLUMNS = ['dtime', 'start', 'position', 'length']
+    
+    def __init__(self, archive_dir):
+        super().__init__()
+        self.archive_dir = archive_dir
+        self.index_path = os.path.join(archive_dir, 'index.csv')
+        self.dtypes = OrderedDict([('offsets', np.int32)] + 
+                                  [(name, dtype) for name, (dtype, _) in ActivityData.CHANNELS.items()])
+        self._end = 0
+        self._maps = {}
+        if not os.path.exists(archive_dir) and os.path.exists(archive_dir + '.old'):
+            # Interrupted rebuild() which has moved the old archive aside
+            os.replace(archive_dir + '.old', archive_dir)
+        
+    def path(self, name):
+        return os.path.join(self.archive_dir, f'{name}.bin')
+    
+    def exists(self):
+        return os.path.exists(self.index_path)
+    
+    @property
+    def index(self):
+        """
+        The index (df): DataFrame with the start, position and length of the samples of 
+        each activity, indexed by dtime (sorted).
+        """
+        return self.df
+    
+    def invalidate(self):
+        super().invalidate()
+        self._maps = {}
+        
+    def dtimes(self, from_dtime=None, to_dtime=None):
+        index = self.index.loc[from_dtime:to_dtime]
+        return list(index.index)
+    
+    def contains(self, dtime):
+        return pd.Timestamp(dtime) in self.index.index
+    
+    def load(self, dtime):
+        """
+        Returns the samples of the activity as ActivityData, whose channels are views of 
+        the memory mapped files, or None if the activity is not in the archive.
+        """
+        dtime = pd.Timestamp(dtime)
+        index = self.index
+        if dtime not in index.index:
+            return None
+        row = index.loc[dtime]
+        lo, hi = row['position'], row['position'] + row['length']
+        arrays = {name: self._map(name)[lo:hi] for name in self.dtypes}
+        offsets = arrays.pop('offsets')
+        return ActivityData(row['start'], offsets, **arrays)
+    
+    def put(self, dtime, data, sync=True):
+        """
+        Append the samples of the activity (DataFrame or ActivityData), replacing the
+        previous samples of the activity, if any.
+        """
+        if not isinstance(data, ActivityData):
+            data = ActivityData.from_dataframe(data)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.index
+        position = self._end
+        for name, dtype in self.dtypes.items():
+            values = data.offsets if name == 'offsets' else getattr(data, name)
+            with open(self.path(name), 'ab') as f:
+                f.truncate(position * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._append_index(dtime, data.start, position, len(data), sync=sync)
+        
+    def delete(self, dtime):
+        if self.contains(dtime):
+            self._append_index(dtime, pd.NaT, -1, -1)
+            
+    def rebuild(self, activities):
+        """
+        Replace the archive with a new one containing activities, an iterable of 
+        (dtime, DataFrame or ActivityData). Returns the number of activities.
+        """
+        tmp_archive = SampleArchive(self.archive_dir + '.tmp')
+        shutil.rmtree(tmp_archive.archive_dir, ignore_errors=True)
+        os.makedirs(tmp_archive.archive_dir)
+        with open(tmp_archive.index_path, 'w') as f:
+            f.write(','.join(self.INDEX_COLUMNS) + '\n')
+        count = 0
+        for dtime, data in activities:
+            tmp_archive.put(dtime, data, sync=False)
+            count += 1
+        for name in list(self.dtypes) + ['index']:
+            path = tmp_archive.index_path if name == 'index' else tmp_archive.path(name)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            with open(path, 'rb+') as f:
+                os.fsync(f.fileno())
+                
+        self.invalidate()
+        old_dir = self.archive_dir + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(self.archive_dir):
+            os.replace(self.archive_dir, old_dir)
+        os.replace(tmp_archive.archive_dir, self.archive_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return count
+    
+    def check(self):
+        """
+        Check that the samples of every activity in the index are in the channel files.
+        Returns list of the problems found.
+        """
+        problems = []
+        if not self.exists():
+            return [f'Archive index {self.index_path} not found']
+        self.invalidate()
+        self.index
+        end = self._end
+        for name, dtype in self.dtypes.items():
+            path = self.path(name)
+            if not os.path.exists(path):
+                problems.append(f'{path} not found')
+                continue
+            size = os.path.getsize(path)
+            itemsize = np.dtype(dtype).itemsize
+            if size < end * itemsize:
+                problems.append(f'{path} has {size // itemsize} samples, the index needs {end}')
+            elif size > end * itemsize:
+                problems.append(f'{path} has {size // itemsize - end} samples after the indexed samples')
+        if not problems:
+            for dtime in self.index.index:
+                offsets = self.load(dtime).offsets
+                if len(offsets) and (offsets[0] < 0 or np.any(np.diff(offsets) < 0)):
+                    problems.append(f'Time offsets of {dtime} are not increasing from the start')
+        return problems
+        
+    def _map(self, name):
+        path = self.path(name)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        cached = self._maps.get(name)
+        if cached is None or cached[0] != size:
+            dtype = self.dtypes[name]
+            arr = np.memmap(path, dtype=dtype, mode='r') if size else np.array([], dtype=dtype)
+            cached = self._maps[name] = (size, arr)
+        return cached[1]
+    
+    def _append_index(self, dtime, start, position, length, sync=True):
+        dtime = pd.Timestamp(dtime)
+        index = self.index
+        write_header = not truncate_partial_line(self.index_path)
+        with open(self.index_path, 'a') as f:
+            if write_header:
+                f.write(','.join(self.INDEX_COLUMNS) + '\n')
+            f.write(f'{dtime},{"" if pd.isnull(start) else pd.Timestamp(start)},{position},{length}\n')
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        
+        index = index[ index.index != dtime ]
+        if length >= 0:
+            self._end = max(self._end, position + length)
+            row = pd.DataFrame(OrderedDict(start=[pd.Timestamp(start)], position=[position], length=[length]),
+                               index=pd.DatetimeIndex([dtime], name='dtime'))
+            index = pd.concat([index, row]).sort_index()
+        self._df = index
+        self._stat = self._file_stat()
+        
+    def _file_stat(self):
+        return file_stat(self.index_path)
+        
+    def _load(self, stat):
+        df = read_appended_csv(self.index_path, parse_dates=['dtime', 'start']) if stat is not None else None
+        if df is None:
+            df = pd.DataFrame(columns=self.INDEX_COLUMNS)
+            df['dtime'] = pd.to_datetime(df['dtime'])
+            df['start'] = pd.to_datetime(df['start'])
+        # Bad rows of an interrupted write
+        df = df.dropna(subset=['position', 'length'])
+        df['position'] = df['position'].astype('int64')
+        df['length'] = df['length'].astype('int64')
+        self._end = max(0, int((df['position'] + df['length']).max())) if len(df) else 0
+        df = df.drop_duplicates('dtime', keep='last')
+        df = df[ df['length'] >= 0 ]
+        self._df = df.set_index('dtime').sort_index()
+        self._stat = stat
+
+
+class ActivityCatalog(FileCache):
+    """
+    In-memory copy of the activity list (activities.csv), indexed by src_file and by
+    start/end time. df is the activity list sorted by dtime, or None if the activity 
+    file does not exist.
+    
+    New and deleted rows are appended to a journal file next to the activity file
+    instead of rewriting it. The journal is merged into the activity file (compacted)
+    when it grows beyond COMPACT_THRESHOLD entries or when a batch() ends.
+    """
+    COMPACT_THRESHOLD = 50
+    
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.journal_path = path + '.journal'
+        self._journal_len = 0
+        self._batch_level = 0
+        
+    def save(self, df):
+        """
+        Replace the activity list with df and write it to the activity file.
+        """
+        atomic_to_csv(df.sort_values('dtime'), self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        # Let it be re-read so that the types are exactly as read from file
+        self.invalidate()
         
-        while len(ftp) >= 2 and ftp.index[1] <= date:
-            ftp = ftp.iloc[1:]
-        while len(ftp) >= 2 and ftp.index[-2] >= date:
-            ftp = ftp.iloc[:-1]
+    def update(self, updates):
+        """
+        Update columns of existing activities in one operation, and write the activity file.
         
-        assert len(ftp) <= 2
-        val = ftp.iloc[0]
-        return self.default_ftp if not val else val
+        Parameters:
+        - updates:   DataFrame with a src_file column and the columns to update, or dict
+                     of src_file -> dict of column values. All rows with the src_file are
+                     updated. If a src_file appears more than once, the last one is used.
+                     
+        Returns:
+          List of the src_files which are not in the activity list
+        """
+        if isinstance(updates, dict):
+            updates = pd.DataFrame.from_dict(updates, orient='index').rename_axis('src_file').reset_index()
+        updates = updates.drop_duplicates('src_file', keep='last').set_index('src_file')
+        df = self.df
+        if df is None:
+            return list(updates.index)
+        
+        # Position of each activity in updates, or -1
+        positions = updates.index.get_indexer(df['src_file'])
+        matched = positions >= 0
+        if matched.any():
+            df = df.copy()
+            for col in updates.columns:
+                df.loc[matched, col] = updates[col].to_numpy()[positions[matched]]
+            self.save(df)
+        return list(updates.index[~updates.index.isin(df['src_file'])])
+        
+    def put(self, row):
+        """
+        Add an activity row (dict), replacing existing rows with the same src_file.
+        """
+        self._append_journal(OrderedDict(op='put', src_file=row['src_file'], 
+                                         row=OrderedDict([(k, self._to_json(v)) for k, v in row.items()])))
         
+    def delete(self, src_file, dtime):
+        """
+        Delete activity rows with the specified src_file and dtime.
+        """
+        self._append_journal(OrderedDict(op='delete', src_file=src_file, dtime=str(pd.Timestamp(dtime))))
+        
+    def compact(self):
+        """
+        Merge the journal into the activity file.
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        df = self.df
+        if df is not None:
+            self.save(df)
+        else:
+            os.remove(self.journal_path)
+            self.invalidate()
         
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager to defer compaction until the end of a series of updates.
+        """
+        self._batch_level += 1
+        try:
+            yield self
+        finally:
+            self._batch_level -= 1
+            if self._batch_level == 0:
+                self.compact()
+        
+    def positions(self, from_dtime=None, to_dtime=None):
+        """
+        Get the (sorted) row positions of activities starting between from_dtime and 
+        to_dtime, inclusive.
+        """
+        if self.df is None:
+            return np.array([], dtype=int)
+        lo = 0 if from_dtime is None else np.searchsorted(self._starts, pd.Timestamp(from_dtime).value, side='left')
+        hi = len(self._starts) if to_dtime is None else np.searchsorted(self._starts, pd.Timestamp(to_dtime).value, side='right')
+        return np.sort(self._order[lo:hi])
+    
+    def src_file_positions(self, src_file, ignore_case=False):
+        if self.df is None:
+            return []
+        if ignore_case:
+            return self._src_files_lower.get(src_file.lower(), [])
+        return self._src_files.get(src_file, [])
+        
+    def exists(self, dtime=None, src_file=None, tolerance=90):
+        """
+        Check if an activity which was running at dtime (with tolerance in seconds) or an
+        activity imported from src_file (case insensitive) exists.
+        """
+        if self.df is None:
+            return False
+        if dtime is not None:
+            dtime = pd.Timestamp(dtime).value
+            tolerance = int(tolerance * 1e9)
+            idx = np.searchsorted(self._starts, dtime + tolerance, side='right')
+            return bool(idx > 0 and self._max_ends[idx-1] >= dtime - tolerance)
+        elif src_file is not None:
+            return len(self.src_file_positions(src_file, ignore_case=True)) > 0
+        else:
+            assert False, "Either dtime or src_file must be specified"
+            
+    def _file_stat(self):
+        return (file_stat(self.path), file_stat(self.journal_path))
+    
+    def _load(self, stat):
+        df = pd.read_csv(self.path, parse_dates=['dtime']) if stat[0] is not None else None
+        entries = []
+        if stat[1] is not None:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Incomplete line of an interrupted write
+                        continue
+        for entry in entries:
+            df = self._apply(df, entry)
+        self._journal_len = len(entries)
+        self._set(df, stat)
+        
+    def _append_journal(self, entry):
+        df = self.df
+        truncate_partial_line(self.journal_path)
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_len += 1
+        stat = self._file_stat()
+        if not self._append_row(entry, stat):
+            self._set(self._apply(df, entry), stat)
+        
+        if self._batch_level == 0 and self._journal_len >= self.COMPACT_THRESHOLD:
+            self.compact()
+        
+    def _append_row(self, entry, stat):
+        """
+        Apply a put entry of a new activity which starts after the other activities (the
+        usual case when activities are saved in time order) to the cached activity list,
+        without sorting and re-indexing it. Returns False if the entry is not such a put.
+        """
+        df = self._df
+        src_file = entry['src_file']
+        if entry['op'] != 'put' or df is None or not len(df) or not isinstance(src_file, str) or \
+                src_file in self._src_files or not set(entry['row']).issubset(df.columns):
+            return False
+        row = pd.DataFrame([entry['row']]).reindex(columns=df.columns)
+        row['dtime'] = pd.to_datetime(row['dtime'])
+        if not row['dtime'].iloc[0] >= df['dtime'].iloc[-1]:
+            return False
+        row['title'] = row['title'].fillna('')
+        row['duration'] = pd.to_timedelta(row['duration'])
+        row['mov_duration'] = pd.to_timedelta(row['mov_duration'])
+        
+        pos = len(df)
+        self._df = pd.concat([df, row], ignore_index=True)
+        self._stat = stat
+        self._src_files.setdefault(src_file, []).append(pos)
+        self._src_files_lower.setdefault(src_file.lower(), []).append(pos)
+        end = (row['dtime'] + row['duration']).values.astype('int64')
+        self._order = np.append(self._order, pos)
+        self._starts = np.append(self._starts, row['dtime'].values.astype('int64'))
+        self._max_ends = np.append(self._max_ends, np.maximum(self._max_ends[-1], end))
+        return True
+        
+    @staticmethod
+    def _apply(df, entry):
+        # Entries are idempotent, so replaying a journal which has been (partially)
+        # merged into the activity file gives the same result.
+        if entry['op'] == 'put':
+            row = pd.DataFrame([entry['row']])
+            row['dtime'] = pd.to_datetime(row['dtime'])
+            if df is None:
+                df = row
+            else:
+                df = df[ df['src_file'] != entry['src_file'] ]
+                df = pd.concat([df, row], ignore_index=True)
+        elif entry['op'] == 'delete':
+            if df is not None:
+                df = df[ (df['src_file'] != entry['src_file']) | (df['dtime'] != pd.Timestamp(entry['dtime'])) ]
+        else:
+            raise ValueError(f'Invalid journal entry: {entry}')
+        return df.sort_values('dtime', kind='stable').reset_index(drop=True) if df is not None else None
+    
+    @staticmethod
+    def _to_json(val):
+        # Convert to JSON value which is read back the same way as from the CSV file
+        if isinstance(val, np.generic):
+            val = val.item()
+        if val is None or (not isinstance(val, str) and pd.isnull(val)) or val == '':
+            return None
+        if isinstance(val, (pd.Timestamp, datetime.datetime, pd.Timedelta)):
+            return str(val)
+        return val
+    
+    def _set(self, df, stat):
+        self._stat = stat
+        self._df = df
+        if df is None:
+            return
+        
+        df['title'] = df['title'].fillna('')
+        df['duration'] = pd.to_timedelta(df['duration'])
+        df['mov_duration'] = pd.to_timedelta(df['mov_duration'])
+        
+        self._src_files = {}
+        self._src_files_lower = {}
+        for pos, src_file in enumerate(df['src_file']):
+            if isinstance(src_file, str):
+                self._src_files.setdefault(src_file, []).append(pos)
+                self._src_files_lower.setdefault(src_file.lower(), []).append(pos)
+        
+        # Interval index: start times sorted ascending, and the running maximum of the
+        # end times, so that overlap queries only need a binary search.
+        # NaT end time is converted to the minimum int64 value, i.e. never matches.
+        starts = df['dtime'].values.astype('int64')
+        ends = (df['dtime'] + df['duration']).values.astype('int64')
+        self._order = np.argsort(starts, kind='stable')
+        self._starts = starts[self._order]
+        self._max_ends = np.maximum.accumulate(ends[self._order]) if len(df) else ends
+
+
+class PowerCurveCache(FileCache):
+    """
+    The mean-max power (best average power for each period) of each activity, persisted
+    in a CSV file so that the power curve can be calculated without reading the activity 
+    data. df has one row per activity, indexed by the activity dtime (sorted), with a 
+    column for each period. Activities without power data have a row of NaNs.
+    
+    New rows are appended to the file; if an activity has more than one row, the last 
+    one is used. Rows are only removed (by rewriting the file) when an activity is deleted.
+    """
+    def __init__(self, path, periods):
+        super().__init__()
+        self.path = path
+        self.columns = [str(p) for p in periods]
+        
+    def put(self, rows):
+        """
+        Add rows (list of dicts with 'dtime' and the period columns, as returned by
+        ZwiftTraining.calc_max_powers()), replacing existing rows with the same dtime.
+        """
+        if not rows:
+            return
+        new_df = pd.DataFrame(rows, columns=['dtime'] + self.columns)
+        new_df['dtime'] = pd.to_datetime(new_df['dtime'])
+        df = self.df
+        
+        write_header = not truncate_partial_line(self.path)
+        with open(self.path, 'a', newline='') as f:
+            new_df.to_csv(f, index=False, header=write_header)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        new_df = new_df.set_index('dtime').astype('float')
+        df = pd.concat([df[ ~df.index.isin(new_df.index) ], new_df])
+        self._df = df[ ~df.index.duplicated(keep='last') ].sort_index()
+        self._stat = self._file_stat()
+        
+    def delete(self, dtime):
+        """
+        Remove the row of the activity.
+        """
+        df = self.df
+        dtime = pd.Timestamp(dtime)
+        if dtime not in df.index:
+            return
+        df = df.drop(index=dtime)
+        atomic_to_csv(df.reset_index(), self.path)
+        self._df = df
+        self._stat = self._file_stat()
+        
+    def _load(self, stat):
+        df = None
+        if stat is not None:
+            try:
+                df = read_appended_csv(self.path, parse_dates=['dtime'], float_precision='round_trip')
+            except (pd.errors.ParserError, ValueError):
+                df = None
+            if df is None or list(df.columns) != ['dtime'] + self.columns:
+                # Unreadable, or the periods have changed. Start over, the max powers
+                # are calculated again as needed
+                os.remove(self.path)
+                df, stat = None, None
+        if df is None:
+            df = pd.DataFrame(columns=['dtime'] + self.columns)
+            df['dtime'] = pd.to_datetime(df['dtime'])
+        df = df.set_index('dtime').astype('float')
+        self._df = df[ ~df.index.duplicated(keep='last') ].sort_index()
+        self._stat = stat
+
+
+class ImportManifest(FileCache):
+    """
+    The files seen by ZwiftTraining.import_files(), persisted in a CSV file so that the
+    unchanged files of a directory which is imported repeatedly are not read again.
+    df has one row per file path, with the size and mtime of the file when it was seen, the
+    SHA-1 hash of its content, the start time of its activity (NaT if unknown), and its
+    status:
+    - 'imported':  the activity was imported from the file
+    - 'duplicate': the file has the same content or start time as an imported activity
+    - 'skipped':   the file was outside the requested date range or over the maximum
+
+    New rows are appended to the file; if a path has more than one row, the last one
+    is used.
+    """
+    COLUMNS = ['path', 'size', 'mtime_ns', 'hash', 'src_file', 'dtime', 'status']
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._entries = {}
+        self._imported = {}
+
+    def get(self, path, size, mtime_ns):
+        """
+        Get the row of the path (as a namedtuple) if the file has not changed since it
+        was recorded, otherwise None.
+        """
+        self.df
+        entry = self._entries.get(path)
+        if entry is None or entry.size != size or entry.mtime_ns != mtime_ns:
+            return None
+        return entry
+
+    def imported_src_file(self, hash):
+        """
+        Get the src_file of an imported file having the content hash, or None.
+        """
+        self.df
+        return self._imported.get(hash)
+
+    def put(self, rows):
+        """
+        Add rows (list of dicts with the COLUMNS), replacing existing rows with the
+        same path.
+        """
+        if not rows:
+            return
+        new_df = pd.DataFrame(rows, columns=self.COLUMNS)
+        new_df['dtime'] = pd.to_datetime(new_df['dtime'])
+        df = self.df
+
+        write_header = not truncate_partial_line(self.path)
+        with open(self.path, 'a', newline='') as f:
+            new_df.to_csv(f, index=False, header=write_header)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._set(pd.concat([df, new_df], ignore_index=True), self._file_stat())
+
+    @staticmethod
+    def hash_file(file):
+        h = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _load(self, stat):
+        df = None
+        if stat is not None:
+            try:
+                df = read_appended_csv(self.path, dtype={col: str for col in self.COLUMNS if col != 'dtime'})
+            except (pd.errors.ParserError, ValueError):
+                # Unreadable. Start over, the files are hashed again as needed
+                os.remove(self.path)
+                stat = None
+        if df is None:
+            df = pd.DataFrame(columns=self.COLUMNS, dtype=str)
+        df['dtime'] = pd.to_datetime(df['dtime'], errors='coerce')
+        # Bad rows of an interrupted write
+        valid = df['size'].str.isdigit().fillna(False) & df['mtime_ns'].str.isdigit().fillna(False)
+        df = df[ valid.astype(bool) ].dropna(subset=['path', 'hash', 'status'])
+        self._set(df, stat)
+
+    def _set(self, df, stat):
+        df = df[ ~df['path'].duplicated(keep='last') ].reset_index(drop=True)
+        df = df.astype({'size': 'int64', 'mtime_ns': 'int64'})
+        self._entries = dict(zip(df['path'], df.itertuples(index=False)))
+        imported = df[ df['status']=='imported' ]
+        self._imported = dict(zip(imported['hash'], imported['src_file']))
+        self._df = df
+        self._stat = stat
+
+
+class ActivityHistograms:
+    """
+    Histogram of the power and hr values of each activity, saved as a small .npz file
+    per activity (named like the activity data file) in the histograms directory. 
+    
+    Each histogram holds the distinct sample values and the number of samples (seconds)
+    having that value, so the time in any zone layout, for any FTP or max HR, can be
+    summed exactly without reading the activity data. Power samples which are null or 
+    zero, and hr samples which are null, are not counted.
+    """
+    FIELDS = ['power', 'hr']
+    
+    def __init__(self, histograms_dir):
+        self.histograms_dir = histograms_dir
+        self._cache = {}
+        
+    def path(self, dtime):
+        return os.path.join(self.histograms_dir, 
+                            pd.Timestamp(dtime).strftime(ActivityStore.FILENAME_FORMAT) + '.npz')
+    
+    @staticmethod
+    def calc(df):
+        """
+        Returns dict of field -> (values, counts) of the activity data.
+        """
+        hist = OrderedDict()
+        for field in ActivityHistograms.FIELDS:
+            values = df[field].to_numpy(dtype=float)
+            values = values[ ~np.isnan(values) ]
+            if field == 'power':
+                values = values[ values != 0 ]
+            hist[field] = np.unique(values, return_counts=True)
+        return hist
+    
+    def save(self, dtime, df):
+        """
+        Calculate and save the histograms of the activity data. Returns the histograms.
+        """
+        hist = self.calc(df)
+        os.makedirs(self.histograms_dir, exist_ok=True)
+        path = self.path(dtime)
+        tmp_path = path + '.tmp'
+        arrays = OrderedDict()
+        for field, (values, counts) in hist.items():
+            arrays[f'{field}_values'] = values
+            arrays[f'{field}_counts'] = counts
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        self._cache[path] = (file_stat(path), hist)
+        return hist
+    
+    def load(self, dtime):
+        """
+        Returns the histograms of the activity, or None if they haven't been saved.
+        """
+        path = self.path(dtime)
+        stat = file_stat(path)
+        if stat is None:
+            return None
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+        
+        hist = OrderedDict()
+        with np.load(path, allow_pickle=False) as data:
+            for field in self.FIELDS:
+                hist[field] = (data[f'{field}_values'], data[f'{field}_counts'])
+        self._cache[path] = (stat, hist)
+        return hist
+    
+    def delete(self, dtime):
+        path = self.path(dtime)
+        self._cache.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class TrainingLoad(FileCache):
+    """
+    Daily training load (TSS), fitness (CTL) and fatigue (ATL), checkpointed in a CSV
+    file so that the training form can be brought up to date from the last checkpoint
+    instead of being recalculated over the whole history. df has a row with COLUMNS for
+    each checkpointed day, indexed by date.
+
+    Fitness and fatigue are the exponentially weighted means of the daily TSS,
+    calculated with the same recurrence as pandas' ewm(span=...).mean(), so the values
+    are the same as running ewm() over the whole history. Besides the means, each row
+    keeps the ewm weights needed to continue the calculation from that day.
+
+    The checkpoint is only valid as long as the activities and FTP history before it
+    don't change, so reset() must be called with the first affected date when they do.
+    """
+    COLUMNS = ['tss', 'ctl', 'atl', 'ctl_weight', 'atl_weight']
+
+    def __init__(self, path, fitness_period=42, fatigue_period=7):
+        super().__init__()
+        self.path = path
+        self.fitness_period = fitness_period
+        self.fatigue_period = fatigue_period
+
+    def calc(self, daily_tss, last=None):
+        """
+        Returns DataFrame with COLUMNS of the days in daily_tss (Series of TSS indexed by
+        consecutive dates), continuing from the row of the previous day (last), if any.
+        """
+        tss = daily_tss.to_numpy(dtype=float)
+        ctl, ctl_weight = self._ewm(tss, self.fitness_period, last, 'ctl')
+        atl, atl_weight = self._ewm(tss, self.fatigue_period, last, 'atl')
+        df = pd.DataFrame(OrderedDict(tss=tss, ctl=ctl, atl=atl, ctl_weight=ctl_weight,
+                                      atl_weight=atl_weight), index=daily_tss.index)
+        df.index.name = 'date'
+        return df
+
+    def put(self, df):
+        """
+        Append the rows calculated by calc() to the checkpoint.
+        """
+        if not len(df):
+            return
+        state = self.df
+
+        write_header = self._stat is None
+        with open(self.path, 'a', newline='') as f:
+            df[self.COLUMNS].to_csv(f, header=write_header)
+            f.flush()
+            os.fsync(f.fileno())
+
+        state = pd.concat([state[ state.index < df.index[0] ], df[self.COLUMNS]])
+        self._df = state[ ~state.index.duplicated(keep='last') ]
+        self._stat = self._file_stat()
+
+    def reset(self, from_date=None):
+        """
+        Remove the checkpointed days from from_date (inclusive), or all of them.
+        """
+        if from_date is None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.invalidate()
+            return
+
+        df = self.df
+        from_date = pd.Timestamp(from_date).normalize()
+        if not len(df) or df.index[-1] < from_date:
+            return
+        df = df[ df.index < from_date ]
+        if not len(df):
+            self.reset()
+            return
+        atomic_to_csv(df.reset_index(), self.path)
+        self._df = df
+        self._stat = self._file_stat()
+
+    @staticmethod
+    def _ewm(values, span, last, name):
+        # Same as pandas' ewm(span=span, adjust=True).mean() (see ewm() in
+        # pandas/_libs/window/aggregations.pyx), for values without NaN
+        old_wt_factor = 1. - 1. / (1. + (span - 1) / 2)
+        means = np.empty(len(values))
+        weights = np.empty(len(values))
+        if last is None:
+            weighted, old_wt = values[0], 1.
+            start = 1
+            means[0], weights[0] = weighted, old_wt
+        else:
+            weighted, old_wt = last[name], last[f'{name}_weight']
+            start = 0
+        for i in range(start, len(values)):
+            cur = values[i]
+            old_wt *= old_wt_factor
+            if weighted != cur:
+                weighted = (old_wt * weighted + cur) / (old_wt + 1.)
+            old_wt += 1.
+            means[i], weights[i] = weighted, old_wt
+        return means, weights
+
+    def _load(self, stat):
+        df = None
+        if stat is not None:
+            df = pd.read_csv(self.path, parse_dates=['date'], float_precision='round_trip')
+            if list(df.columns) != ['date'] + self.COLUMNS:
+                os.remove(self.path)
+                df, stat = None, None
+        if df is None:
+            df = pd.DataFrame(columns=['date'] + self.COLUMNS)
+            df['date'] = pd.to_datetime(df['date'])
+        df = df.set_index('date').astype('float')
+        self._df = df[ ~df.index.duplicated(keep='last') ].sort_index()
+        self._stat = stat
+
+
 class ZwiftTraining:
     
     DEFAULT_PROFILE_DIR = "my-ztraining-data"
+    DEFAULT_ACTIVITY_FORMAT = "npz"
     POWER_ZONES = [0.55, 0.75, 0.9, 1.05, 1.2, 1.5]
     POWER_LABELS = ['Active Recovery', 'Endurance', 'Tempo', 'Lactate Threshold', 
                     'VO2Max', 'Anaerobic', 'Neuromoscular']
     HR_ZONES = [0.6, 0.72, 0.8, 0.9 ]
     HR_LABELS = ['Zone 1', 'Zone 2', 'Zone 3', 'Zone 4', 'Zone 5']
     SST_RANGE = (0.88, 0.94)
+    # Durations (seconds) of the power curve
+    POWER_CURVE_PERIODS = (list(range(1, 30, 1)) + list(range(30, 60, 5)) + list(range(60, 120, 10)) +
+                           list(range(120, 300, 30)) + list(range(300, 1200, 60)) + 
+                           list(range(1200, 7200, 300)) + list(range(7200, 12*3600+600, 600)))
+    # How to calculate the distance from GPS coordinates, when the activity doesn't have
+    # distance data: 'vincenty' (accurate), 'haversine' (faster, up to 0.6% error), or 
+    # 'geodesic' (geopy, one point at a time. Slow)
+    DISTANCE_METHOD = 'vincenty'
+    DISTANCE_METHODS = ['vincenty', 'haversine', 'geodesic']
+    
+    # FIT sport enum values read by scan_file_summary() and probe_file()
+    FIT_SPORTS = {1: 'running', 2: 'cycling', 5: 'swimming', 11: 'walking', 17: 'hiking'}
     
     def __init__(self, conf_file, quiet=False):
         with open(conf_file) as f:
@@ -104,6 +1539,17 @@ class ZwiftTraining:
             else:
                 self.zwift_client = None
             self._zwift_profile = None
+            self._zwift_activity_client = None
+            self.zwift_sync_stats = None
+            
+        self.catalog = ActivityCatalog(self.activity_file)
+        self.power_curve_cache = PowerCurveCache(self.power_curve_file, self.POWER_CURVE_PERIODS)
+        self.import_manifest = ImportManifest(self.import_manifest_file)
+        self.histograms = ActivityHistograms(self.histograms_dir)
+        self._training_loads = {}
+        self.archive = SampleArchive(self.archive_dir)
+        self.activity_store = ActivityStore.create(self.conf.get('activity-format', self.DEFAULT_ACTIVITY_FORMAT),
+                                                   self.activities_dir)
             
         if not quiet:
             print(f'Zwift user: {self.conf.get("zwift-user")}')
@@ -113,10 +1559,37 @@ class ZwiftTraining:
     def zwift_profile_updates_csv(self):
         return os.path.join(self.profile_dir, 'zwift-profile-updates.csv')
     
+    @property
+    def zwift_sync_file(self):
+        return os.path.join(self.profile_dir, 'zwift-sync.json')
+    
     @property
     def activity_file(self):
         return os.path.join(self.profile_dir, 'activities.csv')
     
+    @property
+    def activities_dir(self):
+        return os.path.join(self.profile_dir, 'activities')
+    
+    @property
+    def histograms_dir(self):
+        return os.path.join(self.profile_dir, 'histograms')
+    
+    @property
+    def archive_dir(self):
+        return os.path.join(self.profile_dir, 'archive')
+    
+    @property
+    def power_curve_file(self):
+        return os.path.join(self.profile_dir, 'power-curve.csv')
+    
+    @property
+    def import_manifest_file(self):
+        return os.path.join(self.profile_dir, 'import-manifest.csv')
+    
+    def training_load_file(self, fitness_period, fatigue_period):
+        return os.path.join(self.profile_dir, f'training-load-{fitness_period}-{fatigue_period}.csv')
+    
     @property
     def profile_history(self):
         if os.path.exists(self.zwift_profile_updates_csv):
@@ -139,6 +1612,21 @@ class ZwiftTraining:
             assert self._zwift_profile['useMetric'], "Not sure what to change if metric is not used"
         return self._zwift_profile
     
+    @property
+    def zwift_activity_client(self):
+        """
+        The client of the Zwift activities of the player, shared by all the Zwift requests:
+        a ZwiftSession for a zwift.Client, otherwise the client's get_activity().
+        """
+        if self._zwift_activity_client is None or self._zwift_activity_client[0] is not self.zwift_client:
+            player_id = self.zwift_profile['id']
+            if isinstance(self.zwift_client, Client):
+                activity_client = ZwiftSession(self.zwift_client.auth_token, player_id)
+            else:
+                activity_client = self.zwift_client.get_activity(player_id)
+            self._zwift_activity_client = (self.zwift_client, activity_client)
+        return self._zwift_activity_client[1]
+    
     def plot_profile_history(self, field, interval='W-SUN', from_dtime=None, to_dtime=None):
         df = self.profile_history
         if df is None or not len(df):
@@ -194,30 +1682,35 @@ class ZwiftTraining:
         plt.show()
         
     def get_activities(self, from_dtime=None, to_dtime=None, sport=None):
-        df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
-        df['title'] = df['title'].fillna('')
-        df['duration'] = pd.to_timedelta(df['duration'])
-        df['mov_duration'] = pd.to_timedelta(df['mov_duration'])
-        
+        df = self.catalog.df
+        if df is None:
+            raise FileNotFoundError(f'Activity file {self.activity_file} does not exist')
+        
+        if from_dtime is not None or to_dtime is not None:
+            if to_dtime is not None:
+                to_dtime = pd.Timestamp(to_dtime)
+                if to_dtime.hour == 0:
+                    to_dtime = to_dtime.replace(hour=23, minute=59, second=59)
+            df = df.iloc[ self.catalog.positions(from_dtime, to_dtime) ]
         if sport:
             df = df[ df['sport']==sport ]
-        if from_dtime is not None:
-            df = df[ df['dtime'] >= pd.Timestamp(from_dtime) ]
-        if to_dtime is not None:
-            to_dtime = pd.Timestamp(to_dtime)
-            if to_dtime.hour == 0:
-                to_dtime = to_dtime.replace(hour=23, minute=59, second=59)
-            df = df[ df['dtime'] <= to_dtime ]
             
-        return df
+        return df.copy()
 
-    def get_activity_data(self, dtime=None, src_file=None):
+    def get_activity_data(self, dtime=None, src_file=None, compact=False):
+        """
+        Get the data (samples) of an activity as DataFrame, or as ActivityData if
+        compact is True.
+        """
         assert dtime or src_file, "Either dtime and/or src_file must be specified"
 
-        df = self.get_activities()
+        df = self.catalog.df
+        if df is None:
+            df = pd.DataFrame(columns=['dtime', 'src_file'])
         if dtime:
             dtime = pd.Timestamp(dtime)
-            df = df[ df['dtime'].dt.date==dtime.date() ]
+            day = dtime.normalize()
+            df = df.iloc[ self.catalog.positions(day, day + pd.Timedelta(days=1) - pd.Timedelta(1)) ]
             if len(df) > 1:
                 df = df[ df['dtime']==dtime ]
         if src_file:
@@ -228,36 +1721,24 @@ class ZwiftTraining:
             return None
 
         dtime = df['dtime'].iloc[0]
-        activities_dir = os.path.join(self.profile_dir, 'activities')
-        csv_filename = dtime.strftime('%Y-%m-%d_%H-%M-%S.csv')
-        csv_filename = os.path.join(activities_dir, csv_filename)
-
-        return pd.read_csv(csv_filename, parse_dates=['dtime'])
+        store = self._find_activity_store(dtime)
+        if store is None:
+            store = self.activity_store
+        df = store.load(dtime)
+        return ActivityData.from_dataframe(df) if compact else df
             
     def activity_exists(self, dtime=None, src_file=None, tolerance=90):
-        if os.path.exists(self.activity_file):
-            df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
-            if dtime is not None:
-                df['end_time'] = df['dtime'] + pd.to_timedelta(df['duration'])
-                df['dtime'] = df['dtime'] - pd.Timedelta(seconds=tolerance)
-                df['end_time'] = df['end_time'] + pd.Timedelta(seconds=tolerance)
-                found = df[(df['dtime'] <= dtime) & (df['end_time'] >= dtime)]
-            elif src_file is not None:
-                # Only need the filename, not the full path
-                assert '/' not in src_file and '\\' not in src_file
-                found = df[ df['src_file'].str.lower()==src_file.lower() ]
-            else:
-                assert False, "Either dtime or src_file must be specified"
-            return len(found) > 0
-        else:
-            return False
+        if dtime is None and src_file is not None:
+            # Only need the filename, not the full path
+            assert '/' not in src_file and '\\' not in src_file
+        return self.catalog.exists(dtime=dtime, src_file=src_file, tolerance=tolerance)
 
     def modify_activity(self, dtime=None, src_file=None, note=None, route=None, bike=None, wheel=None):
         if not os.path.exists(self.activity_file):
             raise RuntimeError("Activity file does not exist. Update or import some activities first")
         
         selector = None
-        activities = pd.read_csv(self.activity_file, parse_dates=['dtime'])
+        activities = self.catalog.df.copy()
         if dtime is not None:
             dtime = pd.Timestamp(dtime)
             dtime_selector = activities['dtime']==dtime
@@ -400,9 +1881,9 @@ class ZwiftTraining:
         if field=='tss':
             ph = self.profile_history
             ftph = FTPHistory(ph)
-            df['ftp'] = df['dtime'].apply(ftph.get_ftp)
-            calc_tss = lambda row: ZwiftTraining.avg_watt_to_tss(row['ftp'], row['power_avg'], row['mov_duration'])
-            df['tss'] = df.apply(calc_tss, axis=1)
+            df['ftp'] = ftph.get_ftp_many(df['dtime'])
+            df['tss'] = ZwiftTraining.avg_watts_to_tss(df['ftp'], ZwiftTraining._normalized_powers(df), 
+                                                       df['mov_duration'])
         
         df = df.set_index('dtime')
         df = df.groupby(pd.Grouper(freq=interval, closed='left', label='left')).agg({field: 'sum'})
@@ -429,8 +1910,7 @@ class ZwiftTraining:
     def delete_activity(self, dtime=None, src_file=None, dry_run=False, quiet=False):
         assert dtime or src_file, "Either dtime and/or src_file must be specified"
         
-        activities = self.get_activities()
-        df = activities.copy()
+        df = self.get_activities()
         if dtime:
             df = df[ df['dtime']==dtime ]
         if src_file:
@@ -441,28 +1921,52 @@ class ZwiftTraining:
             return False
         
         dtime = df['dtime'].iloc[0]
-        activities_dir = os.path.join(self.profile_dir, 'activities')
-        csv_filename = dtime.strftime('%Y-%m-%d_%H-%M-%S.csv')
-        csv_filename = os.path.join(activities_dir, csv_filename)
-
-        if not os.path.exists(csv_filename):
-            sys.stderr.write(f'Warning: activity file {csv_filename} not found\n')
+        store = self._find_activity_store(dtime)
+        if store is None:
+            sys.stderr.write(f'Warning: activity file {self.activity_store.path(dtime)} not found\n')
         else:
             if not quiet:
-                print(f'Deleting {csv_filename}')
+                print(f'Deleting {store.path(dtime)}')
             if not dry_run:
-                os.remove(csv_filename)
+                store.delete(dtime)
 
-        activities = activities.drop(index=df.index)
-        activities = activities.sort_values('dtime')
         if not dry_run:
-            activities.to_csv(self.activity_file, index=False)
+            self.power_curve_cache.delete(dtime)
+            self.histograms.delete(dtime)
+            self.invalidate_training_load(dtime)
+            if self.archive.exists():
+                self.archive.delete(dtime)
+            for _, row in df.iterrows():
+                self.catalog.delete(row['src_file'], row['dtime'])
             
         return df
 
     def import_files(self, dir, max=None, from_dtime=None, to_dtime=None, 
-                     overwrite=False, quiet=False):
-        files = glob.glob(os.path.join(dir, '*'))
+                     overwrite=False, workers=None, quiet=False):
+        """
+        Import TCX/GPX/FIT files in a directory.
+        
+        The files seen are recorded in the import manifest with their size, mtime and 
+        content hash, so that the unchanged files are skipped without reading them when 
+        the directory is imported again. A file is not imported if an activity was 
+        imported from a file with the same content, or if an activity was running at 
+        its start time (e.g. the same ride exported from different services).
+        
+        Parameters:
+        - dir:        Directory to scan
+        - max:        Maximum number of activities to import
+        - from_dtime: Only import activities starting from this datetime
+        - to_dtime:   Only import activities starting before this datetime
+        - overwrite:  False (the default) means skip files which have been imported before
+                      and duplicates of imported activities
+        - workers:    Number of processes to parse the files in parallel. Default is
+                      to parse the files one by one in this process.
+        - quiet:      Do not print messages if True
+        
+        Returns:
+          Number of imported activities
+        """
+        files = sorted(glob.glob(os.path.join(dir, '*')))
         updates = []
         
         if from_dtime:
@@ -475,6 +1979,29 @@ class ZwiftTraining:
         if not quiet:
             print(f'Found {len(files)} files in {dir}')
             
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+            
+        manifest = self.import_manifest
+        # Manifest rows of the files, by path, and their status in the manifest
+        seen = OrderedDict()
+        previous = {}
+        # The content hashes and start times of the candidates, to detect duplicates
+        # among the files of this directory
+        hashes = {}
+        starts = []
+        tolerance = int(90 * 1e9)
+        
+        def record(path, status, **kwargs):
+            seen[path].update(status=status, **kwargs)
+            
+        def overlaps(dtime):
+            value = dtime.value
+            idx = bisect.bisect_left(starts, value - tolerance)
+            return (idx < len(starts) and starts[idx] <= value + tolerance) or \
+                   self.activity_exists(dtime=dtime)
+        
+        candidates = []
         for file in files:
             filename = os.path.split(file)[1]
             extension = filename.split('.')[-1].lower()
@@ -482,30 +2009,129 @@ class ZwiftTraining:
             if extension not in ['tcx', 'gpx', 'fit']:
                 continue
             
-            if self.activity_exists(src_file=filename) and not overwrite:
-                if not quiet:
-                    print(f'Skipping {filename} (already processed).. ')
-                    pass
-                continue
+            path = os.path.abspath(file)
+            st = os.stat(file)
+            entry = manifest.get(path, st.st_size, st.st_mtime_ns)
+            if entry is not None:
+                hash, dtime = entry.hash, entry.dtime
+            else:
+                hash = ImportManifest.hash_file(file)
+                try:
+                    dtime = ZwiftTraining.probe_file(file)['dtime']
+                except Exception:
+                    # Leave it to the parser to report the error
+                    dtime = None
+            dtime = None if pd.isnull(dtime) else pd.Timestamp(dtime)
+            seen[path] = OrderedDict(path=path, size=st.st_size, mtime_ns=st.st_mtime_ns, hash=hash,
+                                     src_file=filename, dtime=dtime, status=None)
+            previous[path] = entry.status if entry is not None else None
             
-            df, meta = ZwiftTraining.parse_file(file)
+            if not overwrite:
+                if self.activity_exists(src_file=filename):
+                    if not quiet:
+                        print(f'Skipping {filename} (already processed).. ')
+                    record(path, 'imported')
+                    continue
+            
+                duplicate_of = hashes.get(hash)
+                if duplicate_of is None:
+                    duplicate_of = manifest.imported_src_file(hash)
+                    if duplicate_of is not None and not self.activity_exists(src_file=duplicate_of):
+                        # The activity has been deleted
+                        duplicate_of = None
+                if duplicate_of is not None:
+                    if not quiet:
+                        print(f'Skipping {filename} (same content as {duplicate_of}).. ')
+                    record(path, 'duplicate')
+                    continue
             
-            if from_dtime and meta['dtime'] < from_dtime:
+            if dtime is not None and ((from_dtime and dtime < from_dtime) or (to_dtime and dtime > to_dtime)):
+                record(path, 'skipped')
                 continue
-            if to_dtime and meta['dtime'] > to_dtime:
+            
+            if not overwrite and dtime is not None and overlaps(dtime):
+                if not quiet:
+                    print(f'Skipping {filename} (overlaps an activity at {dtime}).. ')
+                record(path, 'duplicate')
                 continue
-
-            if not quiet:
-                print(f'Importing {filename}..')
-                
-            self.save_activity(df, meta, overwrite=overwrite, quiet=quiet)
             
-            updates.append(file)
-            if max and len(updates) >= max:
-                break
+            candidates.append(file)
+            hashes[hash] = filename
+            if dtime is not None:
+                bisect.insort(starts, dtime.value)
+            record(path, 'skipped')
+            
+        try:
+            with self.catalog.batch():
+                for file, (df, meta) in ZwiftTraining._parse_files(candidates, workers=workers):
+                    filename = os.path.split(file)[1]
+                    path = os.path.abspath(file)
+                    
+                    if from_dtime and meta['dtime'] < from_dtime:
+                        continue
+                    if to_dtime and meta['dtime'] > to_dtime:
+                        continue
+                    
+                    if not overwrite and seen[path]['dtime'] is None and self.activity_exists(dtime=meta['dtime']):
+                        # The start time was only known after parsing
+                        if not quiet:
+                            print(f'Skipping {filename} (overlaps an activity at {meta["dtime"]}).. ')
+                        record(path, 'duplicate', dtime=meta['dtime'])
+                        continue
+        
+                    if not quiet:
+                        print(f'Importing {filename}..')
+                        
+                    self.save_activity(df, meta, overwrite=overwrite, quiet=quiet)
+                    record(path, 'imported', dtime=meta['dtime'])
+                    
+                    updates.append(file)
+                    if max and len(updates) >= max:
+                        break
+        finally:
+            manifest.put([row for path, row in seen.items() if row['status'] != previous[path]])
             
         return len(updates)
 
+    @staticmethod
+    def _parse_files(files, workers=None):
+        """
+        Generator to parse files, optionally in a process pool. The (file, (df, meta)) 
+        results are yielded in the same order as files. 
+        """
+        if not workers or workers <= 1:
+            for file in files:
+                try:
+                    result = ZwiftTraining.parse_file(file)
+                except Exception:
+                    sys.stderr.write(f'Error: unable to parse {file}\n')
+                    raise
+                yield file, result
+            return
+        
+        def next_result():
+            file, future = pending.popleft()
+            try:
+                return file, future.result()
+            except Exception:
+                sys.stderr.write(f'Error: unable to parse {file}\n')
+                raise
+            
+        # Limit the number of parsed results held in memory
+        max_pending = workers * 2
+        pending = collections.deque()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            try:
+                for file in files:
+                    pending.append((file, executor.submit(ZwiftTraining.parse_file, file)))
+                    if len(pending) >= max_pending:
+                        yield next_result()
+                while pending:
+                    yield next_result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+        
     def import_activity_file(self, path, sport=None, overwrite=False, quiet=False):
         """
         Import activity data and metadata from a TCX/GPX/FILE file.
@@ -523,39 +2149,162 @@ class ZwiftTraining:
         self.save_activity(df, meta, overwrite=overwrite, quiet=quiet)
         
     def save_activity(self, df, meta, overwrite=False, quiet=False):
-        activities_dir = os.path.join(self.profile_dir, 'activities')
-        if not os.path.exists(activities_dir):
-            os.makedirs(activities_dir)
+        # Save activity data
+        dtime = meta['dtime']
+        self.activity_store.save(df, dtime)
+        for store in self._activity_stores()[1:]:
+            # Remove stale copy in other format
+            if store.exists(dtime):
+                store.delete(dtime)
+        self.power_curve_cache.put([ZwiftTraining._calc_activity_max_powers(df, dtime)])
+        self.histograms.save(dtime, df)
+        self.invalidate_training_load(dtime)
+        if self.archive.exists():
+            self.archive.put(dtime, df)
+
+        # Update activities.csv
+        if len(self.catalog.src_file_positions(meta['src_file'])):
+            if not overwrite:
+                if not quiet:
+                    print('Row already exists')
+                return
+            if not quiet:
+                print(f'Overwriting {meta["src_file"]} ({meta["dtime"]})')
+        self.catalog.put(meta)
+        
+    def migrate_activities(self, fmt=None, remove=True, quiet=False):
+        """
+        Convert activity data files saved in other formats (e.g. CSV files from older
+        versions) to the configured activity format.
+        
+        Parameters:
+        - fmt:        Target format ('csv', 'npz', or 'parquet'). Default is the
+                      'activity-format' setting in the configuration file.
+        - remove:     Remove the source files after successful conversion.
+        - quiet:      Do not print messages if True
+        
+        Returns:
+          DataFrame containing file size and load time of each converted activity,
+          before and after the conversion.
+        """
+        dst_store = ActivityStore.create(fmt, self.activities_dir) if fmt else self.activity_store
+        rows = []
+        for cls in ACTIVITY_STORES:
+            if cls.FORMAT == dst_store.FORMAT:
+                continue
+            src_store = cls(self.activities_dir)
+            for dtime in src_store.list_dtimes():
+                t0 = time.perf_counter()
+                df = src_store.load(dtime)
+                t1 = time.perf_counter()
+                dst_store.save(df, dtime)
+                t2 = time.perf_counter()
+                dst_store.load(dtime)
+                t3 = time.perf_counter()
+                
+                rows.append(OrderedDict(dtime=dtime, src_format=src_store.FORMAT,
+                                        dst_format=dst_store.FORMAT,
+                                        src_size=os.path.getsize(src_store.path(dtime)),
+                                        dst_size=os.path.getsize(dst_store.path(dtime)),
+                                        src_load_time=t1-t0, dst_load_time=t3-t2,
+                                        save_time=t2-t1))
+                if remove:
+                    src_store.delete(dtime)
+                    
+        report = pd.DataFrame(rows, columns=['dtime', 'src_format', 'dst_format', 'src_size', 'dst_size',
+                                             'src_load_time', 'dst_load_time', 'save_time'])
+        if not quiet:
+            print(f'Converted {len(report)} activities to {dst_store.FORMAT}')
+            if len(report):
+                src_size, dst_size = report['src_size'].sum(), report['dst_size'].sum()
+                src_time, dst_time = report['src_load_time'].sum(), report['dst_load_time'].sum()
+                print(f'Disk size: {src_size/1e6:.1f} MB -> {dst_size/1e6:.1f} MB ({dst_size/src_size:.0%})')
+                print(f'Load time: {src_time:.2f} s -> {dst_time:.2f} s ({dst_time/src_time:.0%})')
+        return report
+        
+    def _activity_stores(self):
+        # The configured store comes first, followed by stores for the other formats
+        # (e.g. data saved before the format was changed)
+        stores = [self.activity_store]
+        for cls in ACTIVITY_STORES:
+            if cls.FORMAT != self.activity_store.FORMAT:
+                stores.append(cls(self.activities_dir))
+        return stores
+    
+    def _find_activity_store(self, dtime):
+        for store in self._activity_stores():
+            if store.exists(dtime):
+                return store
+        return None
+    
+    def _load_activity_data(self, dtime):
+        # Data of the activity from the sample archive if it has the activity (no file 
+        # to open and parse), otherwise from the activity data file. None if not found
+        data = self.archive.load(dtime) if self.archive.exists() else None
+        if data is not None:
+            return data.to_dataframe()
+        store = self._find_activity_store(dtime)
+        return store.load(dtime) if store is not None else None
+    
+    def rebuild_archive(self, quiet=False):
+        """
+        Create (or recreate) the sample archive from the activity data files. Once it 
+        exists, the archive is kept up to date when activities are saved or deleted, and
+        the power curve and zones calculations read the activity data from it.
+        
+        Returns:
+          Number of activities in the archive
+        """
+        def activities():
+            for dtime in self._list_activity_dtimes():
+                yield dtime, self._find_activity_store(dtime).load(dtime)
+        
+        count = self.archive.rebuild(activities())
+        if not quiet:
+            print(f'Archived {count} activities in {self.archive_dir}')
+        return count
+    
+    def check_archive(self, verify=False, quiet=False):
+        """
+        Check the consistency of the sample archive, and that it has the same activities
+        as the activity data files.
+        
+        Parameters:
+        - verify:     Also compare the samples of each activity with its data file
+        - quiet:      Do not print messages if True
         
-        # Save to CSV file
-        dtime = meta['dtime']
-        csv_filename = dtime.strftime('%Y-%m-%d_%H-%M-%S.csv')
-        csv_filename = os.path.join(activities_dir, csv_filename)
-        df.to_csv(csv_filename, index=False)
-
-        # Update activities.csv
-        if os.path.exists(self.activity_file):
-            df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
-            existing = df[ df['src_file'] == meta['src_file'] ]
-            if len(existing):
-                if not overwrite:
-                    if not quiet:
-                        print('Row already exists')
-                else:
-                    if not quiet:
-                        print(f'Overwriting {meta["src_file"]} ({meta["dtime"]})')
-                    df = df.drop(index=existing.index)
-                    df = df.append(meta, ignore_index=True)
-            else:
-                df = df.append(meta, ignore_index=True)
-        else:
-            df = pd.DataFrame([meta])
-            
-        df = df.sort_values('dtime')
-        df.to_csv(self.activity_file, index=False)
+        Returns:
+          List of the problems found
+        """
+        problems = self.archive.check()
+        if self.archive.exists() and not problems:
+            archived = set(self.archive.dtimes())
+            saved = set(self._list_activity_dtimes())
+            problems += [f'{dtime} is not in the archive' for dtime in sorted(saved - archived)]
+            problems += [f'{dtime} is archived but has no activity data file' for dtime in sorted(archived - saved)]
+            if verify:
+                for dtime in sorted(archived & saved):
+                    expected = self._find_activity_store(dtime).load(dtime)
+                    try:
+                        pd.testing.assert_frame_equal(self.archive.load(dtime).to_dataframe(), expected,
+                                                      check_dtype=False)
+                    except AssertionError:
+                        problems.append(f'Archived samples of {dtime} differ from its data file')
+        if not quiet:
+            for problem in problems:
+                print(f'Error: {problem}')
+            print(f'{len(problems)} problems found in the sample archive')
+        return problems
+    
+    def _list_activity_dtimes(self):
+        dtimes = set()
+        for store in self._activity_stores():
+            dtimes.update(store.list_dtimes())
+        return sorted(dtimes)
         
     def zwift_update(self, start=0, max=0, batch=10, from_dtime=None, to_dtime=None, 
-                     profile=True, overwrite=False, quiet=False):
+                     profile=True, overwrite=False, incremental=True, workers=None, processes=None, 
+                     rate_limit=None, retries=3, quiet=False):
         """
         Update local profile and statistics and optionally scan and update new activities 
         from the online Zwift account.
@@ -571,10 +2320,25 @@ class ZwiftTraining:
         - profile:    True to check for profile updates.
         - overwrite:  True to force overwriting already saved activities. This is only
                       usable if previous import was corrupt.
+        - incremental: Use the sync cursor (zwift-sync.json) for a normal sync, i.e. 
+                      without start, from_dtime, to_dtime and overwrite: stop at the first
+                      activity which was synced by the last complete sync, and continue an
+                      interrupted (or stopped by max) sync from its checkpoint. max is then 
+                      the number of activities to scan in this call.
+        - workers:    Number of threads to download the activities concurrently. Default
+                      is to download them one by one. The activities are still saved
+                      one by one, in the order they are listed.
+        - processes:  Number of processes to decode and process the downloaded activities
+                      in parallel. Default is to process them one by one in this process.
+        - rate_limit: Maximum number of Zwift requests per second (default is no limit)
+        - retries:    Number of times to retry a failed Zwift request, with exponential
+                      backoff.
         - quiet:      True to silence the update.
         
         Returns:
-          Number of updates performed
+          Number of updates performed. The counters of the download (fetch), parse and 
+          save stages of the activities are in zwift_sync_stats: a stage which the next
+          stage waits for a lot is the bottleneck.
         """
         n_updates = 0
         
@@ -587,13 +2351,16 @@ class ZwiftTraining:
         if max > 0:
             n_updates += self._zwift_update_activities(start=start, max=max, batch=batch,
                                                        from_dtime=from_dtime, to_dtime=to_dtime, 
-                                                       overwrite=overwrite, quiet=quiet)
+                                                       overwrite=overwrite, incremental=incremental, 
+                                                       workers=workers, processes=processes,
+                                                       rate_limit=rate_limit, retries=retries, quiet=quiet)
+            if not quiet:
+                print(self.zwift_sync_stats)
             
         return n_updates
 
     def zwift_list_activities(self, start=0, max=10, batch=10):
-        player_id = self.zwift_profile['id']
-        activity_client = self.zwift_client.get_activity(player_id)
+        activity_client = self.zwift_activity_client
         count = 0
         
         metas = []
@@ -647,10 +2414,12 @@ class ZwiftTraining:
             if df is None:
                 df = pd.DataFrame([row])
             else:
-                df = df.append(row, ignore_index=True)
+                df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
                 
             df = df.sort_values('dtime')
             df.to_csv(self.zwift_profile_updates_csv, index=False)
+            # The new FTP may apply to the activities of the last MAX_PRIOR_VALIDITY days
+            self.invalidate_training_load(row['dtime'] - pd.Timedelta(days=FTPHistory.MAX_PRIOR_VALIDITY))
             
             if not quiet:
                 print('Zwift local profile updated')
@@ -692,11 +2461,10 @@ class ZwiftTraining:
         return meta
         
     def _zwift_update_activities(self, start=0, max=20, batch=10,
-                                 from_dtime=None, to_dtime=None,
-                                 overwrite=False, quiet=False):
-        player_id = self.zwift_profile['id']
-        activity_client = self.zwift_client.get_activity(player_id)
-        n_updates = 0
+                                 from_dtime=None, to_dtime=None, overwrite=False, incremental=True,
+                                 workers=None, processes=None, rate_limit=None, retries=3, quiet=False):
+        activity_client = self.zwift_activity_client
+        limiter = RateLimiter(rate_limit)
         
         if overwrite and not max:
             raise ValueError("'overwrite' without 'max' will retrieve too many activities")
@@ -709,50 +2477,231 @@ class ZwiftTraining:
             if to_dtime.hour==0 and to_dtime.minute==0:
                 to_dtime = to_dtime.replace(hour=23, minute=59, second=59)
                 
-        while start < max:
-            limit = start+batch
-            if not quiet:
-                print(f'Querying start: {start}, limit: {limit}')
-            
-            activities = activity_client.list(start=start, limit=limit)
+        def download(activity, meta):
             if not quiet:
-                print(f'Fetched {len(activities)} activities metadata')
-            
-            if not activities:
-                break
+                print(f'Getting activity {meta["title"]} ({meta["dtime"]})')
+            if hasattr(activity_client, 'get_fit'):
+                # Decoded by the parse stage
+                return call_with_retry(lambda: activity_client.get_fit(activity['id']), retries=retries, 
+                                       limiter=limiter)
+            return call_with_retry(lambda: activity_client.get_data(activity['id']), retries=retries, 
+                                   limiter=limiter, no_retry=FitParseError)
+        
+        def report_parse_error(index, activity, meta, e):
+            print(f'Import error ignored: error parsing activity index: {index}, id: {activity["id"]}, datetime: {meta["dtime"]}, title: "{meta["title"]}", duration: {activity["duration"]}: FitParseError: {str(e)}')
+        
+        counters = [StageCounters('fetch'), StageCounters('parse'), StageCounters('save')]
+        fetch_counters, parse_counters, save_counters = counters
+        
+        def sync(start, max_index, stop_dtime=None, skip_dtime=None, newest=None, on_saved=None):
+            # Scan the activities from index start until max_index, the end of the list, or
+            # the first activity at or before stop_dtime, and save those which are new.
+            # Activities at or after skip_dtime are skipped. Returns the number of saved 
+            # activities and the progress of the scan: the index and dtime of the next and
+            # the last scanned activity, the first (newest) scanned activity, and whether 
+            # it reached stop_dtime or the end of the list.
+            scan = dict(index=start, dtime=None, newest=newest, done=False)
             
-            for activity in activities:
-                if start >= max:
-                    break
+            def candidates():
+                # Yields (index, activity, meta) of the activities to download
+                index = start
+                while index < max_index:
+                    limit = index+batch
+                    if not quiet:
+                        print(f'Querying start: {index}, limit: {limit}')
                 
-                meta = ZwiftTraining._parse_meta_from_zwift_activity(activity)
-                if not quiet:
-                    print(f'Found activity {start}: {meta["title"]} ({meta["dtime"]}) (id: {activity["id"]})')
-                    
-                if self.activity_exists(src_file=meta['src_file']) and not overwrite:
-                    start += 1
-                    continue
-                if from_dtime and meta['dtime'] < from_dtime:
-                    start += 1
-                    continue
-                if to_dtime and meta['dtime'] > to_dtime:
-                    start += 1
-                    continue
+                    activities = call_with_retry(lambda: activity_client.list(start=index, limit=limit),
+                                                 retries=retries, limiter=limiter)
+                    if not quiet:
+                        print(f'Fetched {len(activities)} activities metadata')
                 
-                try:
-                    df, meta = self.parse_zwift_activity(activity['id'], meta=meta, quiet=quiet)
-                    self.save_activity(df, meta, overwrite=overwrite, quiet=quiet)
-                    n_updates += 1
-                except FitParseError as e:
-                    print(f'Import error ignored: error parsing activity index: {start}, id: {activity["id"]}, datetime: {meta["dtime"]}, title: "{meta["title"]}", duration: {activity["duration"]}: FitParseError: {str(e)}')
+                    if not activities:
+                        scan['done'] = True
+                        break
                 
-                start += 1
+                    for activity in activities:
+                        if index >= max_index:
+                            break
+                    
+                        meta = ZwiftTraining._parse_meta_from_zwift_activity(activity)
+                        if stop_dtime is not None and meta['dtime'] <= stop_dtime:
+                            if not quiet:
+                                print(f'Reached activity {index} ({meta["dtime"]}), which was synced before')
+                            scan['done'] = True
+                            return
+                        if not quiet:
+                            print(f'Found activity {index}: {meta["title"]} ({meta["dtime"]}) (id: {activity["id"]})')
+                        if scan['newest'] is None:
+                            scan['newest'] = OrderedDict(id=activity['id'], dtime=str(meta['dtime']))
+                        
+                        skip = ((self.activity_exists(src_file=meta['src_file']) and not overwrite) or
+                                (from_dtime and meta['dtime'] < from_dtime) or
+                                (to_dtime and meta['dtime'] > to_dtime) or
+                                (skip_dtime is not None and meta['dtime'] >= skip_dtime))
+                        if not skip:
+                            yield index, activity, meta
+                        index += 1
+                        scan['index'], scan['dtime'] = index, str(meta['dtime'])
+            
+            def downloaded():
+                # Stage 1: download in threads
+                items = (((index, activity, meta), (activity, meta)) for index, activity, meta in candidates())
+                for tag, result in ZwiftTraining._run_ordered(download, items, workers, counters=fetch_counters):
+                    try:
+                        data = result()
+                    except FitParseError as e:
+                        report_parse_error(*tag, e)
+                        continue
+                    yield tag, (data, tag[2])
+            
+            # Stage 2: decode and process in processes
+            parsed = ZwiftTraining._run_ordered(ZwiftTraining._parse_zwift_data, downloaded(), processes, 
+                                                processes=True, counters=parse_counters)
+            n_updates = 0
+            try:
+                with self.catalog.batch():
+                    for (index, activity, meta), result in parsed:
+                        # Stage 3: save one by one, in this thread
+                        try:
+                            df, meta = result()
+                        except FitParseError as e:
+                            report_parse_error(index, activity, meta, e)
+                            continue
+                        t0 = time.perf_counter()
+                        self.save_activity(df, meta, overwrite=overwrite, quiet=quiet)
+                        save_counters.add(time.perf_counter() - t0)
+                        n_updates += 1
+                        if on_saved:
+                            on_saved(index, meta, scan)
+            finally:
+                self.zwift_sync_stats = StageCounters.to_dataframe(counters)
+            return n_updates, scan
+        
+        # The sync cursor is only used for a normal sync, i.e. not for a specific range
+        if not incremental or start or overwrite or from_dtime or to_dtime:
+            return sync(start, max)[0]
+        
+        state = self.zwift_sync_state
+        high_water = state.get('high_water')
+        checkpoint = state.get('checkpoint')
+        n_updates = 0
+        if checkpoint:
+            # First the activities added since the incomplete sync started
+            head_stop = checkpoint['high_water']['dtime'] if checkpoint['high_water'] else None
+            n_updates, head = sync(0, max, stop_dtime=pd.Timestamp(head_stop) if head_stop else None)
+            if not head['done']:
+                return n_updates
+            newest = head['newest'] or checkpoint['high_water']
+            
+            # Then continue the incomplete sync. Activities only move to higher indices when
+            # new ones are added, but go back one batch in case some were deleted
+            start = builtins.max(0, checkpoint['index'] - batch)
+            stop_dtime = pd.Timestamp(checkpoint['stop_dtime']) if checkpoint['stop_dtime'] else None
+            skip_dtime = pd.Timestamp(checkpoint['dtime'])
+            if not quiet:
+                print(f'Resuming sync from activity {start} ({checkpoint["dtime"]})')
+        else:
+            newest = None
+            stop_dtime = pd.Timestamp(high_water['dtime']) if high_water else None
+            skip_dtime = None
             
+        def make_checkpoint(index, dtime, newest):
+            return OrderedDict(index=index, dtime=dtime, stop_dtime=str(stop_dtime) if stop_dtime else None,
+                               high_water=newest)
+        
+        def on_saved(index, meta, scan):
+            # If interrupted, the next sync continues after this activity
+            self._save_zwift_sync_state(high_water, make_checkpoint(index+1, str(meta['dtime']), scan['newest']))
+        
+        n, scan = sync(start, start + max, stop_dtime=stop_dtime, skip_dtime=skip_dtime, newest=newest,
+                       on_saved=on_saved)
+        n_updates += n
+        if scan['done']:
+            self._save_zwift_sync_state(scan['newest'] or high_water, None)
+        elif scan['dtime'] is not None:
+            # Stopped by max. Continue from here next time
+            self._save_zwift_sync_state(high_water, make_checkpoint(scan['index'], scan['dtime'], scan['newest']))
         return n_updates
+    
+    @property
+    def zwift_sync_state(self):
+        """
+        The Zwift sync cursor: 'high_water' is the id and dtime of the newest activity of 
+        the last complete sync, and 'checkpoint' is where to continue an incomplete sync.
+        """
+        if not os.path.exists(self.zwift_sync_file):
+            return {}
+        with open(self.zwift_sync_file) as f:
+            return json.load(f)
+    
+    def _save_zwift_sync_state(self, high_water, checkpoint):
+        state = OrderedDict(high_water=high_water, checkpoint=checkpoint)
+        tmp_path = self.zwift_sync_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.zwift_sync_file)
+    
+    @staticmethod
+    def _run_ordered(func, items, workers=None, processes=False, counters=None):
+        """
+        Generator calling func(*args) for each (tag, args) of items, optionally in a pool 
+        of workers threads (processes if processes is True), with at most workers*2 calls
+        pending. Yields (tag, result) in the same order as items, where result() returns
+        the return value of func or raises its exception. The calls are counted in 
+        counters (StageCounters).
+        """
+        counters = counters or StageCounters()
+        
+        def result_of(call):
+            def result():
+                t0 = time.perf_counter()
+                try:
+                    busy, value = call()
+                except Exception:
+                    counters.failed += 1
+                    raise
+                finally:
+                    counters.wait += time.perf_counter() - t0
+                counters.add(busy)
+                return value
+            return result
+        
+        if not workers or workers <= 1:
+            for tag, args in items:
+                yield tag, result_of(functools.partial(timed_call, func, *args))
+            return
+        
+        max_pending = workers * 2
+        pending = collections.deque()
+        executor_class = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            try:
+                for tag, args in items:
+                    pending.append((tag, executor.submit(timed_call, func, *args)))
+                    counters.max_queued = builtins.max(counters.max_queued, len(pending))
+                    if len(pending) >= max_pending:
+                        tag_, future = pending.popleft()
+                        yield tag_, result_of(future.result)
+                while pending:
+                    tag_, future = pending.popleft()
+                    yield tag_, result_of(future.result)
+            finally:
+                for _, future in pending:
+                    future.cancel()
+    
+    @staticmethod
+    def _parse_zwift_data(data, meta):
+        """
+        Parse the data of a Zwift activity: the FIT file (bytes) or its records, as 
+        returned by the get_data() of zwift.Client's Activity.
+        """
+        records = process_fit_data(decode_fit_file(data)) if isinstance(data, bytes) else data
+        return ZwiftTraining.parse_fit_records(records, meta)
 
     def parse_zwift_activity(self, activity_id, meta=None, quiet=False):
-        player_id = self.zwift_profile['id']
-        activity_client = self.zwift_client.get_activity(player_id)
+        activity_client = self.zwift_activity_client
         if not meta:
             activity = activity_client.get_activity(activity_id)
             meta = ZwiftTraining._parse_meta_from_zwift_activity(activity)
@@ -848,49 +2797,93 @@ class ZwiftTraining:
             plt.show()
 
     def calc_power_curve(self, from_date=None, to_date=None, max_hr=None):
+        """
+        Returns DataFrame containing the max powers (see calc_max_powers()) of each
+        activity in the date range, indexed by dtime, or None if there is none.
+        
+        The max powers of each activity are kept in the power curve cache, so the activity 
+        data is only read for activities which are not in the cache yet, or when max_hr 
+        is specified.
+        """
         if from_date:
             from_date = pd.Timestamp(from_date)
         if to_date:
             to_date = pd.Timestamp(to_date)
             
-        src_pattern = os.path.join(self.profile_dir, 'activities', '20*.csv')
-        files = glob.glob(src_pattern)
-        
-        curve_df = None
-        MIN_POWER = 20
-        MAX_POWER = 3000
-        
         if to_date and to_date.hour==0 and to_date.minute==0:
             to_date = to_date.replace(hour=23, minute=23, second=23)
         
-        for file in sorted(files):
-            filepart = os.path.split(file)[1].split('.')[0]
-            dtime = datetime.datetime.strptime(filepart, '%Y-%m-%d_%H-%M-%S')
+        dtimes = []
+        for dtime in self._list_activity_dtimes():
             if from_date is not None and dtime < from_date:
                 continue
             if to_date is not None and dtime > to_date:
                 continue
-            df = pd.read_csv(file, parse_dates=['dtime'])
-            df = df[['dtime', 'power', 'hr']].dropna()
-            df = df[ (df['power'] >= MIN_POWER) & (df['power'] <= MAX_POWER)]
-            if max_hr is not None:
-                df = df[ df['hr'] <= max_hr ]
-            if len(df) == 0:
-                continue
+            dtimes.append(dtime)
             
-            power = ZwiftTraining.calc_max_powers(df)
-            if not len(power):
-                continue
-    
-            if curve_df is None:
-                curve_df = pd.DataFrame([power]).set_index('dtime')
-            else:
-                del power['dtime']
-                curve_df.loc[dtime] = power
-    
-            curve_df = curve_df.sort_values('dtime')                
+        if max_hr is not None:
+            rows = [ZwiftTraining._calc_activity_max_powers(self._load_activity_data(dtime), dtime, max_hr=max_hr)
+                    for dtime in dtimes]
+            curve_df = pd.DataFrame(rows, columns=self.power_curve_cache.columns + ['dtime'])
+            curve_df = curve_df.set_index('dtime').astype('float')
+        else:
+            cache = self.power_curve_cache
+            cached = cache.df.index
+            missing = [dtime for dtime in dtimes if dtime not in cached]
+            cache.put([ZwiftTraining._calc_activity_max_powers(self._load_activity_data(dtime), dtime)
+                       for dtime in missing])
+            curve_df = cache.df.loc[dtimes]
+        
+        curve_df = curve_df.dropna(how='all').sort_index()
+        return curve_df if len(curve_df) else None
+
+    @staticmethod
+    def _calc_zones_duration(pct, counts, zones):
+        """
+        Returns array of the total counts in each zone: zone 1 is pct in (0, zones[0]], 
+        zone 2 is (zones[0], zones[1]], ..., and the last zone is above zones[-1].
         
-        return curve_df
+        Parameters:
+        - pct:      Array of values relative to FTP or max HR (e.g. 0.75)
+        - counts:   Array of the number of samples (seconds) of each value
+        - zones:    Zone boundaries, e.g. POWER_ZONES
+        """
+        MAX_PCT = 1e10
+        bins = np.searchsorted(np.array([0] + list(zones), dtype=float), pct, side='left')
+        valid = pct <= MAX_PCT
+        duration = np.bincount(bins[valid], weights=counts[valid], minlength=len(zones)+2)
+        # bin 0 is zero or negative values
+        return duration[1:]
+
+    def _get_activity_histograms(self, dtime):
+        """
+        Histograms of the activity (see ActivityHistograms). They are calculated from the
+        activity data and saved if they don't exist yet. Returns None if the activity 
+        data is not found.
+        """
+        hist = self.histograms.load(dtime)
+        if hist is None:
+            df = self._load_activity_data(dtime)
+            if df is None:
+                return None
+            hist = self.histograms.save(dtime, df)
+        return hist
+
+    @staticmethod
+    def _calc_activity_max_powers(df, dtime, max_hr=None):
+        """
+        The max powers of an activity data for the power curve. Samples without hr are 
+        excluded. Returns dict with only dtime if there is no power data.
+        """
+        MIN_POWER = 20
+        MAX_POWER = 3000
+        df = df[['dtime', 'power', 'hr']].dropna()
+        df = df[ (df['power'] >= MIN_POWER) & (df['power'] <= MAX_POWER)]
+        if max_hr is not None:
+            df = df[ df['hr'] <= max_hr ]
+        power = ZwiftTraining.calc_max_powers(df)
+        power['dtime'] = dtime
+        return power
 
     @staticmethod
     def calc_max_powers(df):
@@ -898,15 +2891,7 @@ class ZwiftTraining:
             return {}
         
         dtime = df.iloc[0]['dtime']
-        
-        periods = []
-        periods += list(range(1, 30, 1))
-        periods += list(range(30, 60, 5))
-        periods += list(range(60, 120, 10))
-        periods += list(range(120, 300, 30))
-        periods += list(range(300, 1200, 60))
-        periods += list(range(1200, 7200, 300))
-        periods += list(range(7200, 12*3600+600, 600))
+        periods = ZwiftTraining.POWER_CURVE_PERIODS
         
         df = df[['dtime', 'power']].dropna()
         df['power'] = df['power'].astype('float')
@@ -919,11 +2904,72 @@ class ZwiftTraining:
         if not len(df):
             return {}
         
+        max_powers = ZwiftTraining.calc_mean_max(df['power'].values, periods)
         result = {'dtime': dtime}
-        for p in periods:
-            result[str(p)] = round(df['power'].rolling(p).mean().max(), 1)
+        for p, power in zip(periods, max_powers):
+            result[str(p)] = round(power, 1)
+        return result
+    
+    @staticmethod
+    def calc_mean_max(values, periods):
+        """
+        Returns array containing the maximum average of values over each window length
+        (number of samples) in periods, or NaN if there are fewer samples than the window.
+        
+        The window sums are calculated from a single cumulative sum, so each window length
+        costs one vectorized subtraction instead of a rolling pass. The sums are exact when
+        the values are multiples of 0.5 (as power and hr after smoothing), so the result is 
+        the same as Series.rolling(p).mean().max().
+        """
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        cumsum = np.zeros(n + 1)
+        np.cumsum(values, out=cumsum[1:])
+        
+        result = np.full(len(periods), np.NaN)
+        for i, p in enumerate(periods):
+            if p > n:
+                continue
+            # max of the sums then divide, which is the same as max of the means
+            result[i] = np.max(cumsum[p:] - cumsum[:-p]) / p
         return result
     
+    @staticmethod
+    def calc_normalized_power(values, window=30, duration=None):
+        """
+        Normalized Power of the power samples: the fourth root of the mean of the fourth 
+        power of the 30 seconds rolling average. 
+        
+        duration is the elapsed seconds of each sample. The samples are placed on a one 
+        second grid, and the rolling average of each sample is the average of the samples
+        in the 30 seconds ending at it, so that gaps (e.g. samples removed while not 
+        moving) do not stretch the window. Without duration, the samples are one second 
+        apart. Null samples are ignored, and activities shorter than the window use the 
+        average power. Returns NaN if there is no power data.
+        """
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        values = values[valid]
+        n = len(values)
+        if not n:
+            return np.NaN
+        if duration is None:
+            seconds = np.arange(n)
+        else:
+            seconds = np.round(np.asarray(duration, dtype=float)[valid]).astype('int64')
+            seconds -= seconds.min()
+        sums = np.bincount(seconds, weights=values)
+        if len(sums) < window:
+            return values.mean()
+        cum_sums = np.zeros(len(sums) + 1)
+        np.cumsum(sums, out=cum_sums[1:])
+        cum_counts = np.zeros(len(sums) + 1, dtype='int64')
+        np.cumsum(np.bincount(seconds), out=cum_counts[1:])
+        # One window ending at each second having samples
+        ends = np.unique(seconds[ seconds >= window - 1 ]) + 1
+        rolling = (cum_sums[ends] - cum_sums[ends - window]) / (cum_counts[ends] - cum_counts[ends - window])
+        return np.mean(rolling ** 4) ** 0.25
+    
     def calc_power_zones_duration(self, from_dtime, to_dtime, ftp=None, with_sst=False,
                                   zones=POWER_ZONES, labels=POWER_LABELS):
         #if from_dtime:
@@ -950,45 +2996,32 @@ class ZwiftTraining:
         
         ftph = FTPHistory(ph, default_ftp=ftp)
         
-        empty = pd.DataFrame({'dummy': [0]*(len(zones)+1)}, index=range(1, len(zones)+2))
-        
-        results = [empty]
         ftps = [] # for averaging
-        zones = [0] + zones
-        sst_duration = 0
-        for dtime, adf in activities.iterrows():
-            ftp_at_that_time = ftph.get_ftp(dtime)
-            if not ftp_at_that_time:
-                if ftp is None:
-                    print(f'No FTP at {dtime}')
-                    continue
-                else:
-                    ftp_at_that_time = ftp
+        pct_ftps = []
+        counts = []
+        ftps_at_that_time = ftph.get_ftp_many(activities.index)
+        for dtime, ftp_at_that_time in zip(activities.index, ftps_at_that_time):
+            if np.isnan(ftp_at_that_time):
+                print(f'No FTP at {dtime}')
+                continue
             ftps.append(ftp_at_that_time)
-            data = self.get_activity_data(dtime=dtime, src_file=adf['src_file'])
-            if len(data)==0:
+            hist = self._get_activity_histograms(dtime)
+            if hist is None:
                 sys.stderr.write(f'Error: unable to find activity on {dtime}\n')
                 continue
-            data = data[ (data['power'].notnull()) & (data['power'] != 0) ]
-            data['%ftp'] = data['power'] / ftp_at_that_time
-            data['power_zone'] = None
-            for i_z in range(len(zones)):
-                mi = zones[i_z]
-                ma = zones[i_z+1] if i_z < len(zones)-1 else 1e10
-                data.loc[ ((data['%ftp'] > mi) & (data['%ftp'] <= ma)), 'power_zone' ] = i_z+1
-
-            if with_sst:
-                mi = ZwiftTraining.SST_RANGE[0]
-                ma = ZwiftTraining.SST_RANGE[1]
-                dur = len(data[(data['%ftp'] >= mi) & (data['%ftp'] <= ma)])
-                sst_duration += dur
-
-            secs_in_zone = data.groupby('power_zone').agg({'dtime': 'count'})
-            secs_in_zone = secs_in_zone.rename(columns={'dtime': dtime})
-            results.append(secs_in_zone)
-                
-        tmp = pd.concat(results, axis=1).fillna(0)
-        duration = tmp.sum(axis=1)
+            pct_ftps.append(hist['power'][0] / ftp_at_that_time)
+            counts.append(hist['power'][1])
+        
+        # All activities are binned at once
+        pct_ftp = np.concatenate(pct_ftps) if pct_ftps else np.array([])
+        counts = np.concatenate(counts) if counts else np.array([], dtype=int)
+        duration = pd.Series(ZwiftTraining._calc_zones_duration(pct_ftp, counts, zones), 
+                             index=range(1, len(zones)+2))
+        zones = [0] + zones
+        if with_sst:
+            mi = ZwiftTraining.SST_RANGE[0]
+            ma = ZwiftTraining.SST_RANGE[1]
+            sst_duration = counts[ (pct_ftp >= mi) & (pct_ftp <= ma) ].sum()
         
         if not labels:
             labels = [f'Zone {i+1}' for i in range(len(duration))]
@@ -1207,32 +3240,22 @@ class ZwiftTraining:
             print(f'Error: no cycling activities found between {from_dtime} - {to_dtime}')
             return
         
-        empty = pd.DataFrame({'dummy': [0]*(len(zones)+1)}, index=range(1, len(zones)+2))
-        
-        results = [empty]
-        zones = [0] + zones
-        for dtime, adf in activities.iterrows():
+        pct_hrs = []
+        counts = []
+        for dtime in activities.index:
             max_hr_at_that_time = max_hr # TODO: adjust based on age at that time?
-            data = self.get_activity_data(dtime=dtime, src_file=adf['src_file'])
-            if len(data)==0:
+            hist = self._get_activity_histograms(dtime)
+            if hist is None:
                 sys.stderr.write(f'Error: unable to find activity on {dtime}\n')
                 continue
-            #if pd.isnull(data['hr'].iloc[0]):
-            #    continue
-            data = data[ data['hr'].notnull() ]
-            data['%hr'] = data['hr'] / max_hr_at_that_time
-            data['hr_zone'] = None
-            for i_z in range(len(zones)):
-                mi = zones[i_z]
-                ma = zones[i_z+1] if i_z < len(zones)-1 else 1e10
-                data.loc[ ((data['%hr'] > mi) & (data['%hr'] <= ma)), 'hr_zone' ] = i_z+1
-
-            secs_in_zone = data.groupby('hr_zone').agg({'dtime': 'count'})
-            secs_in_zone = secs_in_zone.rename(columns={'dtime': dtime})
-            results.append(secs_in_zone)
+            pct_hrs.append(hist['hr'][0] / max_hr_at_that_time)
+            counts.append(hist['hr'][1])
                 
-        tmp = pd.concat(results, axis=1).fillna(0)
-        duration = tmp.sum(axis=1).astype(int)
+        pct_hr = np.concatenate(pct_hrs) if pct_hrs else np.array([])
+        counts = np.concatenate(counts) if counts else np.array([], dtype=int)
+        duration = pd.Series(ZwiftTraining._calc_zones_duration(pct_hr, counts, zones).astype(int), 
+                             index=range(1, len(zones)+2))
+        zones = [0] + zones
         
         if not labels:
             labels = [f'Zone {i+1}' for i in range(len(duration))]
@@ -1294,25 +3317,34 @@ class ZwiftTraining:
     
     def calc_training_form(self, sport='cycling', from_dtime=None, to_dtime=None, 
                            fatigue_period=7, fitness_period=42):
-        assert sport=='cycling', "Only 'cycling' is supported for now"
-        
-        activities = self.get_activities(sport=sport, to_dtime=to_dtime)
-        activities = activities[['dtime', 'mov_duration', 'power_avg']].set_index('dtime').dropna()
-    
-        ftph = FTPHistory(self.profile_history)
-        def _calc_tss(row):
-            d = row.name
-            return self.avg_watt_to_tss(ftph.get_ftp(d), row['power_avg'], row['mov_duration'])
-        
-        activities['tss'] = activities.apply(_calc_tss, axis=1)
+        """
+        Daily TSS, fitness (CTL), fatigue (ATL) and form (TSB) until today.
         
-        #if activities.index[-1] < pd.Timestamp.now().normalize():
-        # Add present
-        activities.loc[pd.Timestamp.now(), 'tss'] = 0
+        Unless to_dtime is specified, the calculation continues from the days
+        checkpointed in the training load file, and the complete days are added to it.
+        """
+        assert sport=='cycling', "Only 'cycling' is supported for now"
         
-        activities = activities[['tss']].resample('1D').sum()
-        activities['Fitness (CTL)'] = activities['tss'].ewm(span=fitness_period).mean()
-        activities['Fatigue (ATL)'] = activities['tss'].ewm(span=fatigue_period).mean()
+        if to_dtime is not None:
+            load = TrainingLoad(None, fitness_period=fitness_period, fatigue_period=fatigue_period)
+            df = load.calc(self._calc_daily_tss(sport, to_dtime=to_dtime))
+        else:
+            load = self._training_load(fitness_period, fatigue_period)
+            today = pd.Timestamp.now().normalize()
+            state = load.df
+            state = state[ state.index < today ]
+            if len(state):
+                daily_tss = self._calc_daily_tss(sport, from_dtime=state.index[-1] + pd.Timedelta(days=1))
+                df = load.calc(daily_tss, last=state.iloc[-1])
+            else:
+                df = load.calc(self._calc_daily_tss(sport))
+            load.put(df[ df.index < today ])
+            df = pd.concat([state, df])
+        
+        activities = pd.DataFrame({'tss': df['tss'],
+                                   'Fitness (CTL)': df['ctl'],
+                                   'Fatigue (ATL)': df['atl']}, index=df.index)
+        activities.index.name = 'dtime'
         activities['Form (TSB)'] = activities['Fitness (CTL)'] - activities['Fatigue (ATL)']
         
         if from_dtime:
@@ -1320,6 +3352,47 @@ class ZwiftTraining:
         
         return activities
     
+    def invalidate_training_load(self, from_dtime=None):
+        """
+        Discard the checkpointed training load from the date of from_dtime (or all of it),
+        e.g. after the activities or FTP history before the last checkpoint were modified
+        outside of ZwiftTraining.
+        """
+        paths = glob.glob(os.path.join(self.profile_dir, 'training-load-*-*.csv'))
+        for path in paths:
+            m = re.match(r'training-load-(\d+)-(\d+)\.csv$', os.path.basename(path))
+            if m:
+                self._training_load(int(m.group(1)), int(m.group(2))).reset(from_dtime)
+    
+    def _training_load(self, fitness_period, fatigue_period):
+        key = (fitness_period, fatigue_period)
+        if key not in self._training_loads:
+            self._training_loads[key] = TrainingLoad(self.training_load_file(fitness_period, fatigue_period),
+                                                     fitness_period=fitness_period, 
+                                                     fatigue_period=fatigue_period)
+        return self._training_loads[key]
+    
+    def _calc_daily_tss(self, sport, from_dtime=None, to_dtime=None):
+        # Daily TSS of the activities, from the date of from_dtime (or of the first 
+        # activity) until today
+        activities = self.get_activities(sport=sport, from_dtime=from_dtime, to_dtime=to_dtime)
+        activities = activities.set_index('dtime')
+        activities['power_np'] = ZwiftTraining._normalized_powers(activities)
+        activities = activities[['mov_duration', 'power_np']].dropna()
+    
+        ftph = FTPHistory(self.profile_history)
+        activities['tss'] = self.avg_watts_to_tss(ftph.get_ftp_many(activities.index), 
+                                                  activities['power_np'], activities['mov_duration'])
+        
+        # Add present
+        activities.loc[pd.Timestamp.now(), 'tss'] = 0
+        
+        daily_tss = activities['tss'].resample('1D').sum()
+        if from_dtime is not None:
+            daily_tss = daily_tss.reindex(pd.date_range(pd.Timestamp(from_dtime).normalize(), 
+                                                        daily_tss.index[-1]), fill_value=0)
+        return daily_tss
+    
     def plot_training_form(self, sport='cycling', from_dtime=None, to_dtime=None, 
                            fatigue_period=7, fitness_period=42, ax=None, show=True):
         df = self.calc_training_form(sport=sport, from_dtime=from_dtime, to_dtime=to_dtime,
@@ -1511,6 +3584,28 @@ class ZwiftTraining:
         tss = pd.Timedelta(duration).total_seconds() / 3600 * (avg_watt ** 2) / (ftp ** 2) * 100
         return tss
 
+    @staticmethod
+    def avg_watts_to_tss(ftps, avg_watts, durations):
+        """
+        Vectorized avg_watt_to_tss(). Returns array of TSS, NaN where it can't be calculated.
+        """
+        ftps = np.asarray(ftps, dtype=float)
+        avg_watts = np.asarray(avg_watts, dtype=float)
+        secs = pd.to_timedelta(pd.Series(durations)).dt.total_seconds().values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tss = secs / 3600 * (avg_watts ** 2) / (ftps ** 2) * 100
+        invalid = np.isnan(ftps) | (ftps == 0) | np.isnan(avg_watts) | (avg_watts == 0)
+        tss[invalid] = np.NaN
+        return tss
+
+    @staticmethod
+    def _normalized_powers(activities):
+        # The Normalized Power column of the activity list. Activities imported before
+        # it was calculated use the average power instead
+        if 'power_np' not in activities:
+            return activities['power_avg'].astype(float)
+        return activities['power_np'].astype(float).fillna(activities['power_avg'])
+
     def best_cycling_route(self, max_duration, avg_watt=None, tss=None, ftp=None, min_duration=None, 
                            kind=None, worlds=[], done=None, train_n=20, meetup=False, 
                            allow_events=False, quiet=False):
@@ -1663,7 +3758,7 @@ class ZwiftTraining:
             found = inventory[ inventory['name']==value ]
             if len(found):
                 raise ValueError(f'{kind} "{value}" already exist')
-            inventory = inventory.append(data, ignore_index=True)
+            inventory = pd.concat([inventory, pd.DataFrame([data])], ignore_index=True)
         else:
             data = {key:[val] for key, val in data.items()}
             inventory = pd.DataFrame(data)
@@ -1674,69 +3769,88 @@ class ZwiftTraining:
 
     @staticmethod
     def _process_activity(df, meta, min_kph=3, copy=True):
-        if copy:
-            df = df.copy()
+        """
+        Clean up the samples of a parsed activity and calculate the activity summary in
+        meta. Returns a new DataFrame; df is only modified if copy is False.
         
-        MAX_ELE = 9000
-        MAX_HR = 250
-        MAX_POWER = 2500
-        MAX_CADENCE = 210
+        The channels are processed as float NumPy arrays, and the DataFrame is built once
+        from the moving samples at the end.
+        """
         MAX_SPEED = 100
-        MAX_TEMP = 55
-        
-        df['latt'] = df['latt'].astype('float')
-        df['long'] = df['long'].astype('float')
-        df['elevation'] = df['elevation'].astype('float').clip(upper=MAX_ELE)
-        df['distance'] = df['distance'].astype('float')
-        df['hr'] = df['hr'].astype('float').clip(upper=MAX_HR)
-        df['power'] = df['power'].astype('float').clip(upper=MAX_POWER)
-        df['cadence'] = df['cadence'].astype('float').clip(upper=MAX_CADENCE)
-        df['speed'] = df['speed'].astype('float').clip(upper=MAX_SPEED)
-        df['temp'] = df['temp'].astype('float').clip(upper=MAX_TEMP)
-        
-        mpos = list(df.columns).index('distance')
-        if pd.isnull(df['distance'].iloc[0]):
-            if pd.isnull(df['latt'].iloc[0]):
+        # Upper limit of each channel (speed is recalculated from the movement)
+        LIMITS = OrderedDict([('latt', None), ('long', None), ('elevation', 9000), ('distance', None),
+                              ('hr', 250), ('power', 2500), ('cadence', 210), ('temp', 55)])
+        
+        cols = OrderedDict()
+        for name, limit in LIMITS.items():
+            values = df[name].to_numpy(dtype=float, copy=copy)
+            if not values.flags.writeable:
+                values = values.copy()
+            if limit is not None:
+                np.minimum(values, limit, out=values)
+            cols[name] = values
+        
+        n = len(df)
+        distance = cols['distance']
+        movement = np.empty(n)
+        if np.isnan(distance[0]):
+            latt, long = cols['latt'], cols['long']
+            if np.isnan(latt[0]):
                 assert False, "Unable to calculate distance because GPS coordinates are null"
-            df['prev-latt'] = df['latt'].shift()
-            df['prev-long'] = df['long'].shift()
-            func = lambda row: ZwiftTraining.measure_distance(row['prev-latt'], row['prev-long'], 
-                                                              row['latt'], row['long'])
-            df.insert(mpos, 'movement', df.apply(func, axis=1).fillna(0))
-            df['distance'] = df['movement'].cumsum() / 1000
-            df = df.drop(columns=['prev-latt', 'prev-long'])
+            prev_latt = np.concatenate([[np.NaN], latt[:-1]])
+            prev_long = np.concatenate([[np.NaN], long[:-1]])
+            movement[:] = np.nan_to_num(ZwiftTraining.measure_distances(prev_latt, prev_long, latt, long), nan=0)
+            distance = cols['distance'] = np.cumsum(movement) / 1000
         else:
-            df.insert(mpos, 'movement', (df['distance'] * 1000).diff())
+            meters = distance * 1000
+            np.subtract(meters[1:], meters[:-1], out=movement[1:])
 
-        df.loc[0, 'movement'] = df.loc[0, 'distance'] * 1000
-        df['movement'] = df['movement'].round(3)
+        movement[0] = distance[0] * 1000
+        np.round(movement, 3, out=movement)
         
         max_movement = MAX_SPEED * 1000 / 3600
-        df['movement'] = df['movement'].clip(upper=max_movement)
+        np.minimum(movement, max_movement, out=movement)
         
         # absolute duration
-        start_time = df.iloc[0]['dtime']
-        df.insert(1, 'duration', (df['dtime'] - start_time).dt.total_seconds())
+        duration = (df['dtime'] - df['dtime'].iloc[0]).dt.total_seconds().to_numpy()
         
         # recalculate speed.
-        tick_elapsed = df['duration'].diff().fillna(1)
-        df['speed'] = df['movement'] * 3600 / 1000 / tick_elapsed
-        df['speed'] = df['speed'].replace(np.inf, np.NaN)
-        df.loc[ df['speed'] > 100, 'speed'] = 100
-        
-        # Smoothen speed, power, hr
-        df['speed'] = df['speed'].rolling(3, min_periods=1).mean()
-        df['power'] = df['power'].rolling(2, min_periods=1).mean()
-        df['hr'] = df['hr'].rolling(2, min_periods=1).mean()
-        df['cadence'] = df['cadence'].rolling(2, min_periods=1).mean()
-        df['temp'] = df['temp'].rolling(2, min_periods=1).mean()
+        tick_elapsed = np.empty(n)
+        tick_elapsed[0] = np.NaN
+        np.subtract(duration[1:], duration[:-1], out=tick_elapsed[1:])
+        tick_elapsed[ np.isnan(tick_elapsed) ] = 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = movement * 3600 / 1000 / tick_elapsed
+        speed[ speed == np.inf ] = np.NaN
+        speed[ speed > MAX_SPEED ] = MAX_SPEED
+        
+        # Smoothen speed, power, hr, cadence and temp. These use pandas' rolling mean 
+        # (one pass for the 2 samples channels) to keep its exact rounding
+        speed = pd.Series(speed).rolling(3, min_periods=1).mean().to_numpy()
+        smooth_cols = ['power', 'hr', 'cadence', 'temp']
+        smoothed = pd.DataFrame(np.column_stack([cols[name] for name in smooth_cols])) \
+                     .rolling(2, min_periods=1).mean().to_numpy()
+        for i, name in enumerate(smooth_cols):
+            cols[name] = smoothed[:, i]
+        cols['speed'] = speed
+        cols['movement'] = movement
         
         # remove non-movement
         min_movement = min_kph*1000 / 3600
-        df = df[ df['movement'] >= min_movement]
-        
-        # moving time
-        df.insert(2, 'mov_duration', range(0, len(df)))
+        moving = movement >= min_movement
+        n_moving = np.count_nonzero(moving)
+        
+        # Build the DataFrame with the original columns, plus duration, moving time and
+        # movement (before distance)
+        data = OrderedDict()
+        for i, name in enumerate(df.columns):
+            if i == 1:
+                data['duration'] = duration[moving]
+                data['mov_duration'] = np.arange(n_moving)
+            if name == 'distance':
+                data['movement'] = movement[moving]
+            data[name] = cols[name][moving] if name in cols else df[name].to_numpy()[moving]
+        df = pd.DataFrame(data, index=df.index[moving])
         
         sports = {
             'biking': 'cycling',
@@ -1769,6 +3883,9 @@ class ZwiftTraining:
             meta['hr_max'] = df['hr'].max()
             meta['power_avg'] = np.round(df["power"].mean(), 2)
             meta['power_max'] = df["power"].max()
+            meta['power_np'] = np.round(ZwiftTraining.calc_normalized_power(df["power"].values,
+                                                                            duration=df["duration"].values), 2)
+            meta['power_vi'] = np.round(meta['power_np'] / meta['power_avg'], 3) if meta['power_avg'] else np.NaN
             cadence = df["cadence"]
             cadence = cadence[ cadence > 0 ]
             meta['cadence_avg'] = np.round(cadence.mean(), 2)
@@ -1786,6 +3903,8 @@ class ZwiftTraining:
             meta['hr_max'] = np.NaN
             meta['power_avg'] = np.NaN
             meta['power_max'] = np.NaN
+            meta['power_np'] = np.NaN
+            meta['power_vi'] = np.NaN
             meta['cadence_avg'] = np.NaN
             meta['cadence_max'] = np.NaN
             meta['temp_avg'] = np.NaN
@@ -1800,10 +3919,9 @@ class ZwiftTraining:
         meta['calories'] = calories
         
         # Round some values
-        df = df.copy()
-        df['elevation'] = df['elevation'].astype('float').round(2)
-        df['distance'] = df['distance'].astype('float').round(3)
-        df['speed'] = df['speed'].astype('float').round(2)
+        df['elevation'] = df['elevation'].round(2)
+        df['distance'] = df['distance'].round(3)
+        df['speed'] = df['speed'].round(2)
             
         return df, meta
             
@@ -1821,6 +3939,26 @@ class ZwiftTraining:
         #    lat2 *= 180/(2**31)
         #    lon2 *= 180/(2**31)
         return distance.distance((lat1, lon1), (lat2, lon2)).m
+
+    @staticmethod
+    def measure_distances(lat1, lon1, lat2, lon2, method=None):
+        """
+        Measure distances between arrays of coordinates, in meters. Pairs with null
+        coordinate give NaN.
+        
+        Parameters:
+        - method:   'vincenty', 'haversine', or 'geodesic'. Default is DISTANCE_METHOD
+        """
+        method = method or ZwiftTraining.DISTANCE_METHOD
+        if method == 'vincenty':
+            return vincenty_distance(lat1, lon1, lat2, lon2)
+        elif method == 'haversine':
+            return haversine_distance(lat1, lon1, lat2, lon2)
+        elif method == 'geodesic':
+            return np.array([ZwiftTraining.measure_distance(*coords) 
+                             for coords in zip(lat1, lon1, lat2, lon2)], dtype=float)
+        else:
+            raise ValueError(f'Invalid distance method "{method}". Valid values: {ZwiftTraining.DISTANCE_METHODS}')
     
     @staticmethod
     def parse_file(file):
@@ -1833,60 +3971,246 @@ class ZwiftTraining:
         else:
             assert False, f"Unsupported file extension {file[-3:]}"
         
+    @staticmethod
+    def scan_file_summary(file):
+        """
+        Get the summary of a TCX/FIT file without decoding its samples. Returns OrderedDict
+        of src_file, sport (as written in the file, '' if unknown), and calories (NaN if
+        unknown).
+        """
+        if file[-4:].lower() == '.tcx':
+            return ZwiftTraining._scan_tcx_summary(file)
+        elif file[-4:].lower() == '.fit':
+            return ZwiftTraining._scan_fit_summary(file)
+        else:
+            assert False, f"Unsupported file extension {file[-3:]}"
+            
+    @staticmethod
+    def _scan_tcx_summary(path):
+        """
+        Search the TCX file for the sport and calories, without parsing the XML.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        sport = re.search(rb'<(?:\w+:)?Activity\s[^>]*Sport="([^"]*)"', data)
+        # Like parse_tcx_file(), the calories of all laps are summed up
+        calories = sum([float(m) for m in re.findall(rb'<(?:\w+:)?Calories>([^<]*)<', data) if m.strip()])
+        return OrderedDict(src_file=os.path.split(path)[-1], 
+                           sport=sport.group(1).decode().lower() if sport else '',
+                           calories=calories or np.NaN)
+    
+    @staticmethod
+    def _scan_fit_summary(path):
+        """
+        Walk the messages of a FIT file, only decoding the fields of the session message.
+        """
+        # FIT global message number and field numbers
+        SESSION, SESSION_SPORT, SESSION_CALORIES = 18, 5, 11
+        
+        summary = OrderedDict(src_file=os.path.split(path)[-1], sport='', calories=np.NaN)
+        with open(path, 'rb') as f:
+            data = f.read()
+        for global_num, read, _ in ZwiftTraining._fit_messages(data):
+            if global_num == SESSION:
+                sport = read(SESSION_SPORT, 'B', 0xFF)
+                if sport is not None:
+                    summary['sport'] = ZwiftTraining.FIT_SPORTS.get(sport, '')
+                calories = read(SESSION_CALORIES, 'H', 0xFFFF)
+                if calories is not None:
+                    summary['calories'] = float(calories)
+        return summary
+    
+    @staticmethod
+    def _fit_messages(data):
+        """
+        Generator walking the messages of FIT file data without decoding them. Yields
+        (global message number, read, timestamp) of each data message, where read(field
+        number, struct format, invalid value) decodes a field of the message (None if it
+        is missing or invalid), and timestamp is the FIT timestamp of the message or None.
+        """
+        TIMESTAMP = 253
+        header_size = data[0]
+        end = header_size + struct.unpack_from('<I', data, 4)[0]
+        pos = header_size
+        # local message type -> (global message number, endian, {field number: (offset, size)}, size)
+        definitions = {}
+        last_timestamp = None
+        while pos < end:
+            header = data[pos]
+            pos += 1
+            timestamp = None
+            if header & 0x80:
+                # Compressed timestamp header: 5 bits offset from the last timestamp
+                local = (header >> 5) & 0x3
+                if last_timestamp is not None:
+                    offset = header & 0x1F
+                    timestamp = (last_timestamp & ~0x1F) + offset
+                    if offset < (last_timestamp & 0x1F):
+                        timestamp += 0x20
+                    last_timestamp = timestamp
+            elif header & 0x40:
+                # Definition message
+                endian = '>' if data[pos+1] else '<'
+                global_num, n_fields = struct.unpack_from(endian + 'HB', data, pos+2)
+                pos += 5
+                fields = {}
+                size = 0
+                for i in range(n_fields):
+                    field_num, field_size = data[pos], data[pos+1]
+                    fields[field_num] = (size, field_size)
+                    size += field_size
+                    pos += 3
+                if header & 0x20:
+                    # Developer fields
+                    n_dev_fields = data[pos]
+                    size += sum([data[pos+2+i*3] for i in range(n_dev_fields)])
+                    pos += 1 + n_dev_fields * 3
+                definitions[header & 0x0F] = (global_num, endian, fields, size)
+                continue
+            else:
+                local = header & 0x0F
+            
+            global_num, endian, fields, size = definitions[local]
+            
+            def read(field_num, fmt, invalid, pos=pos, endian=endian, fields=fields):
+                field = fields.get(field_num)
+                if field is None or field[1] != struct.calcsize(fmt):
+                    return None
+                value = struct.unpack_from(endian + fmt, data, pos + field[0])[0]
+                return None if value == invalid else value
+            
+            if TIMESTAMP in fields:
+                timestamp = read(TIMESTAMP, 'I', 0xFFFFFFFF)
+                if timestamp is not None:
+                    last_timestamp = timestamp
+            yield global_num, read, timestamp
+            pos += size
+    
+    @staticmethod
+    def probe_file(file):
+        """
+        Get the start time and sport of a TCX/GPX/FIT file from its first samples, without
+        parsing the whole file. Returns OrderedDict of src_file, dtime (as the dtime of
+        parse_file(), or None if not found), and sport (as written in the file, '' if 
+        unknown).
+        """
+        probe = OrderedDict(src_file=os.path.split(file)[-1], dtime=None, sport='')
+        extension = file[-4:].lower()
+        if extension in ['.tcx', '.gpx']:
+            if extension == '.tcx':
+                time_re = rb'<(?:\w+:)?Trackpoint>\s*<(?:\w+:)?Time>([^<]*)<'
+                sport_re = rb'<(?:\w+:)?Activity\s[^>]*Sport="([^"]*)"'
+            else:
+                time_re = rb'<(?:\w+:)?trkpt\b.*?<(?:\w+:)?time>([^<]*)<'
+                sport_re = rb'<(?:\w+:)?type>([^<]*)<'
+            # Read more of the file until the first sample time is found
+            with open(file, 'rb') as f:
+                data = b''
+                while True:
+                    chunk = f.read(builtins.max(len(data), 65536))
+                    data += chunk
+                    match = re.search(time_re, data, re.DOTALL)
+                    if match or not chunk:
+                        break
+            if match:
+                dtime = pd.to_datetime([match.group(1).decode().strip()], utc=True)
+                probe['dtime'] = dtime.tz_convert(pytz.timezone("Asia/Jakarta")).tz_localize(None)[0]
+            sport = re.search(sport_re, data[:match.start()] if match else data)
+            if sport:
+                probe['sport'] = sport.group(1).decode().lower()
+        elif extension == '.fit':
+            # FIT global message numbers and field numbers
+            FILE_ID, FILE_ID_TIME_CREATED, SPORT, SPORT_SPORT, RECORD = 0, 4, 12, 0, 20
+            with open(file, 'rb') as f:
+                data = f.read()
+            time_created = None
+            for global_num, read, timestamp in ZwiftTraining._fit_messages(data):
+                if global_num == FILE_ID:
+                    time_created = read(FILE_ID_TIME_CREATED, 'I', 0xFFFFFFFF)
+                elif global_num == SPORT:
+                    sport = read(SPORT_SPORT, 'B', 0xFF)
+                    if sport is not None:
+                        probe['sport'] = ZwiftTraining.FIT_SPORTS.get(sport, '')
+                elif global_num == RECORD and timestamp is not None:
+                    break
+            else:
+                timestamp = time_created
+            if timestamp is not None:
+                # FIT time is seconds since 1989-12-31 UTC. Like parse_fit_records(), convert to WIB
+                probe['dtime'] = pd.Timestamp('1989-12-31') + pd.Timedelta(seconds=timestamp, hours=7)
+        else:
+            assert False, f"Unsupported file extension {file[-3:]}"
+        return probe
+    
     @staticmethod    
     def parse_tcx_file(path):
         """
         Convert TCX file to CSV
         """
-        with open(path, 'r') as f:
-            doc = f.read().strip()
-        doc = minidom.parseString(doc)
-        
-        sport = doc.getElementsByTagName('Activities')[0] \
-                   .getElementsByTagName('Activity')[0] \
-                   .attributes['Sport'].value \
-                   .lower()
-        title = xml_path_val(doc, 'Activities|Activity|Notes', '')
-        
+        # Trackpoint children to read, and the column to store it.
+        # Extensions (e.g. ns3:Speed and ns3:Watts) are matched regardless of namespace.
+        TRACKPOINT_FIELDS = {'LatitudeDegrees': 'latt', 'LongitudeDegrees': 'long', 
+                             'AltitudeMeters': 'elevation', 'DistanceMeters': 'distance',
+                             'Cadence': 'cadence', 'Speed': 'speed', 'Watts': 'power'}
+        
+        cols = ColumnBuffer(['latt', 'long', 'elevation', 'distance', 'hr', 'cadence', 'speed', 'power'])
+        times = []
+        sport = None
+        title = None
         calories = 0
-        calories_nodes = doc.getElementsByTagName('Calories')
-        for node in calories_nodes:
-            s = xml_get_text(node)
-            if s.strip():
-                calories += float(s.strip())
+        
+        # Elements are processed and discarded as they are parsed, so memory usage doesn't
+        # depend on the file size
+        parents = []
+        raw_time = None
+        in_trackpoint = False
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            tag = xml_local_name(elem.tag)
+            if event == 'start':
+                if tag == 'Trackpoint':
+                    in_trackpoint = True
+                    raw_time = None
+                    cols.append_row()
+                elif tag == 'Activity' and sport is None:
+                    sport = elem.attrib['Sport'].lower()
+                parents.append(elem)
+                continue
+            
+            parents.pop()
+            parent_tag = xml_local_name(parents[-1].tag) if parents else None
+            if in_trackpoint:
+                try:
+                    if tag == 'Trackpoint':
+                        if raw_time is None:
+                            raise KeyError('Time not found')
+                        times.append(raw_time)
+                        in_trackpoint = False
+                        elem.clear()
+                        parents[-1].remove(elem)
+                    elif tag == 'Time':
+                        raw_time = elem.text
+                    elif tag in TRACKPOINT_FIELDS or (tag == 'Value' and parent_tag == 'HeartRateBpm'):
+                        col = 'hr' if tag == 'Value' else TRACKPOINT_FIELDS[tag]
+                        if not pd.isnull(cols.get(col)):
+                            raise RecursionError(f'Multiple {tag}s found')
+                        cols.set(col, float(elem.text))
+                except Exception as e:
+                    raise e.__class__(f'Error processing {raw_time}: {str(e)}')
+            elif tag == 'Calories':
+                if elem.text and elem.text.strip():
+                    calories += float(elem.text.strip())
+            elif tag == 'Notes' and parent_tag == 'Activity' and title is None:
+                title = elem.text or ''
+            
         if not calories:
             calories = np.NaN
-        
-        trackpoints = doc.getElementsByTagName('Trackpoint')
-        rows = []
-        for trackpoint in trackpoints:
-            raw_time = pd.Timestamp(xml_path_val(trackpoint, 'Time'))
-            try:
-                latt = xml_path_val(trackpoint, 'LatitudeDegrees', np.NaN)
-                long = xml_path_val(trackpoint, 'LongitudeDegrees', np.NaN)
-                elevation = xml_path_val(trackpoint, 'AltitudeMeters', np.NaN)
-                distance = xml_path_val(trackpoint, 'DistanceMeters', np.NaN) # not always specified
-                hr = xml_path_val(trackpoint, 'HeartRateBpm|Value', np.NaN) # not always specified
-                cadence = xml_path_val(trackpoint, 'Cadence', np.NaN) # not always specified
-                speed = xml_path_val(trackpoint, 'Speed', np.NaN) # not always specified
-                if pd.isnull(speed):
-                    speed = xml_path_val(trackpoint, 'ns3:Speed', np.NaN) # not always specified
-                power = xml_path_val(trackpoint, 'Watts', np.NaN) # not always specified
-                if pd.isnull(power):
-                    power = xml_path_val(trackpoint, 'ns3:Watts', np.NaN) # not always specified
-            except Exception as e:
-                raise e.__class__(f'Error processing {raw_time}: {str(e)}')
-                       
-            row = OrderedDict(dtime=raw_time, latt=latt, long=long,
-                              elevation=elevation, distance=distance, hr=hr, cadence=cadence,
-                              speed=speed, power=power, temp=np.NaN
-                              )
-            rows.append(row)
             
-        df = pd.DataFrame(rows)
+        df = pd.DataFrame(cols.columns())
+        df.insert(0, 'dtime', pd.to_datetime(times, utc=True))
+        df['temp'] = np.NaN
         df['dtime'] = df['dtime'].dt.tz_convert(pytz.timezone("Asia/Jakarta")).dt.tz_localize(None)
-        df['distance'] = df['distance'].astype('float') / 1000
-        meta = OrderedDict(dtime=df['dtime'].iloc[0], sport=sport, title=title, 
+        df['distance'] = df['distance'] / 1000
+        meta = OrderedDict(dtime=df['dtime'].iloc[0], sport=sport, title=title or '', 
                            src_file=os.path.split(path)[-1], route='', bike='', 
                            wheel='', note='', calories=calories)
         return ZwiftTraining._process_activity(df, meta, copy=False)
@@ -1896,40 +4220,87 @@ class ZwiftTraining:
         """
         Convert GPX file to CSV
         """
-        with open(path, 'r') as f:
-            doc = f.read().strip()
-        doc = minidom.parseString(doc)
-        
-        title = xml_path_val(doc, 'trk|name', '')
+        # Extension elements of trkpt to read (the local name, in lower case), and the
+        # column to store it. These cover Garmin TrackPointExtension (v1 and v2), 
+        # the plain <power> element written by Strava and Wahoo, Garmin PowerExtension,
+        # and Cluetrust gpxdata.
+        EXTENSION_FIELDS = {'hr': 'hr', 'heartrate': 'hr', 
+                            'cad': 'cadence', 'cadence': 'cadence',
+                            'atemp': 'temp', 'temp': 'temp',
+                            'power': 'power', 'watts': 'power', 'powerinwatts': 'power'}
+        
+        cols = ColumnBuffer(['latt', 'long', 'elevation', 'hr', 'cadence', 'power', 'temp'])
+        times = []
+        title = None
+        trk_type = None
+        
+        parents = []
+        raw_time = None
+        in_trkpt = False
+        in_extensions = False
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            tag = xml_local_name(elem.tag)
+            if event == 'start':
+                if tag == 'trkpt':
+                    in_trkpt = True
+                    raw_time = None
+                    cols.append_row()
+                    try:
+                        cols.set('latt', float(elem.attrib['lat']))
+                        cols.set('long', float(elem.attrib['lon']))
+                    except Exception as e:
+                        raise e.__class__(f'Error processing trackpoint {len(times)}: {str(e)}')
+                elif tag == 'extensions' and in_trkpt:
+                    in_extensions = True
+                parents.append(elem)
+                continue
+            
+            parents.pop()
+            parent_tag = xml_local_name(parents[-1].tag) if parents else None
+            if in_trkpt:
+                try:
+                    if tag == 'trkpt':
+                        if raw_time is None:
+                            raise KeyError('time not found')
+                        times.append(raw_time)
+                        in_trkpt = False
+                        elem.clear()
+                        parents[-1].remove(elem)
+                    elif tag == 'extensions':
+                        in_extensions = False
+                    elif in_extensions:
+                        col = EXTENSION_FIELDS.get(tag.lower())
+                        # Only use the first one if there are several variants
+                        if col and pd.isnull(cols.get(col)) and elem.text and elem.text.strip():
+                            cols.set(col, float(elem.text))
+                    elif tag == 'time' and parent_tag == 'trkpt':
+                        raw_time = elem.text
+                    elif tag == 'ele' and parent_tag == 'trkpt':
+                        cols.set('elevation', float(elem.text))
+                except Exception as e:
+                    raise e.__class__(f'Error processing {raw_time}: {str(e)}')
+            elif parent_tag == 'trk':
+                if tag == 'name' and title is None:
+                    title = elem.text or ''
+                elif tag == 'type' and trk_type is None:
+                    trk_type = elem.text or ''
+                    
+        title = title or ''
         if 'ride' in title.lower():
             sport = 'biking'
         elif 'run' in title.lower():
             sport = 'running'
+        elif trk_type is not None:
+            sport = trk_type.lower()
         else:
-            sport = xml_path_val(doc, 'trk|type').lower()
-        
-        trackpoints = doc.getElementsByTagName('trkpt')
-        rows = []
-        for trackpoint in trackpoints:
-            raw_time = pd.Timestamp(xml_path_val(trackpoint, 'time'))
-            try:
-                latt = trackpoint.attributes['lat'].value
-                long = trackpoint.attributes['lon'].value
-                elevation = xml_path_val(trackpoint, 'ele', np.NaN)
-                cadence = xml_path_val(trackpoint, 'extensions|gpxtpx:cad', np.NaN) # not always specified
-                power = xml_path_val(trackpoint, 'extensions|power', np.NaN) # not always specified
-                hr = xml_path_val(trackpoint, 'extensions|gpxtpx:hr', np.NaN) # not always specified
-                temp = xml_path_val(trackpoint, 'extensions|gpxtpx:atemp', np.NaN) # not always specified
-            except Exception as e:
-                raise e.__class__(f'Error processing {raw_time}: {str(e)}')
-                       
-            row = OrderedDict(dtime=raw_time, latt=latt, long=long,
-                              elevation=elevation, distance=np.NaN, hr=hr, cadence=cadence,
-                              speed=np.NaN, power=power, temp=temp
-                              )
-            rows.append(row)
-            
-        df = pd.DataFrame(rows)
+            raise KeyError('type not found')
+        
+        columns = cols.columns()
+        df = pd.DataFrame(OrderedDict(dtime=pd.to_datetime(times, utc=True), 
+                                      latt=columns['latt'], long=columns['long'],
+                                      elevation=columns['elevation'], distance=np.NaN,
+                                      hr=columns['hr'], cadence=columns['cadence'], speed=np.NaN,
+                                      power=columns['power'], temp=columns['temp']))
         df['dtime'] = df['dtime'].dt.tz_convert(pytz.timezone("Asia/Jakarta")).dt.tz_localize(None)
         
         meta = OrderedDict(dtime=df['dtime'].iloc[0], sport=sport, title=title, src_file=os.path.split(path)[-1],
@@ -1943,41 +4314,113 @@ class ZwiftTraining:
         """
         fitfile = FitFile(path)
         messages = fitfile.get_messages('record')
-        records = [m.get_values() for m in messages]
         meta = OrderedDict(dtime=None, sport='', title='', src_file=os.path.split(path)[-1],
                            route='', bike='', wheel='', note='', )
-        return ZwiftTraining.parse_fit_records(records, meta)
+        return ZwiftTraining.parse_fit_records(messages, meta)
 
     @staticmethod
     def parse_fit_records(records, meta):
-        has_power = False
+        """
+        Convert FIT records to activity data. 
         
-        rows = []
+        Parameters:
+        - records:   fitparse record messages (from FitFile.get_messages('record')), or
+                     the dicts returned by Zwift's get_data()
+        - meta:      the activity metadata
+        """
+        # Columns to read, and the record fields for it (the FIT name and the Zwift name).
+        # If more than one field has a value, the first one is used.
+        FIT_RECORD_FIELDS = OrderedDict([('latt', ['position_lat', 'lat']), 
+                                         ('long', ['position_long', 'lng']),
+                                         ('elevation', ['altitude']), 
+                                         ('distance', ['distance']),
+                                         ('hr', ['heart_rate', 'heartrate']), 
+                                         ('cadence', ['cadence']),
+                                         ('speed', ['speed']), 
+                                         ('power', ['power']),
+                                         ('temp', ['temperature'])])
+        slots = {}
+        for fields in FIT_RECORD_FIELDS.values():
+            for field in fields:
+                slots[field] = len(slots)
+        
+        # Field values go straight into one flat float buffer, one row of slots per record
+        buffer = array.array('d')
+        empty_row = [np.NaN] * len(slots)
+        times = []
+        time_field = None
         for data in records:
-            raw_time = data.get('timestamp', data.get('time', None))
+            if isinstance(data, dict):
+                fields = data.items()
+            else:
+                fields = [(field.name, field.value) for field in data.fields]
+            
+            # Like a dict, a field that appears more than once takes the last value
+            row = list(empty_row)
+            raw_time = None
+            time_name = None
+            for name, value in fields:
+                slot = slots.get(name)
+                if slot is not None:
+                    row[slot] = np.NaN if value is None else value
+                elif name == 'timestamp' or (name == 'time' and time_name != 'timestamp'):
+                    raw_time, time_name = value, name
             assert raw_time, "Unable to get time information in fit record"
-            latt = data.get('position_lat', data.get('lat', np.NaN))
-            long = data.get('position_long', data.get('lng', np.NaN))
-            elevation = data.get('altitude', np.NaN)
-            distance = data.get('distance', np.NaN)
-            hr = data.get('heart_rate', data.get('heartrate', np.NaN))
-            cadence = data.get('cadence', np.NaN)
-            speed = data.get('speed', np.NaN)
-            power = data.get('power', np.NaN)
-            temp = data.get('temperature', np.NaN) 
-    
-            if not has_power and not pd.isnull(power):
-                has_power = True
-                       
-            row = OrderedDict(dtime=raw_time, latt=latt, long=long,
-                              elevation=elevation, distance=distance, hr=hr, cadence=cadence,
-                              speed=speed, power=power, temp=temp
-                              )
-            rows.append(row)
+            if time_field is None:
+                time_field = time_name
+            times.append(raw_time)
+            buffer.extend(row)
             
-        df = pd.DataFrame(rows)
+        values = np.frombuffer(buffer, dtype=float).reshape(-1, len(slots))
+        cols = OrderedDict()
+        for col, fields in FIT_RECORD_FIELDS.items():
+            arr = values[:, slots[fields[0]]].copy()
+            for field in fields[1:]:
+                arr = np.where(np.isnan(arr), values[:, slots[field]], arr)
+            cols[col] = arr
+        
+        # Some adjustments
+        if time_field == 'timestamp':
+            latt, long, dist = cols['latt'], cols['long'], cols['distance']
+            if np.isnan(latt[0]):
+                # Garmin .fit format on trainer.
+                #This below is correct, but disabling this as we'll use general heuristic later
+                #dist /= 1000
+                pass
+            else:
+                # Garmin .fit format with GPS. Position may be in semicircles.
+                if np.nanmax(latt) > 90 or np.nanmin(latt) < -90:
+                    latt *= 180/(2**31)
+                    long *= 180/(2**31)
+                    
+                #Strava (or possibly Zwift) doesn't need to divide elevation by 5.
+                # Don't clear the distance even if it's in cm. Sometimes the GPS is messed up 
+                # but the distance is good (e.g. on trainer session with GPS on. Example: 1873571076.fit)
+                
+            # Some heuristic until we know the rule
+            if not np.isnan(dist).all():
+                max_dist = np.nanmax(dist)
+                if max_dist < 1000:
+                    # the distance is probably alright
+                    pass
+                elif max_dist < 1000000:
+                    # in meters
+                    dist /= 1000
+                else:
+                    # in cm
+                    dist /= 100000
+                    
+        elif time_field == 'time':
+            # Zwift .fit format:
+            # - latt and long is correct
+            # - distance is in km
+            # - elevation is in m
+            # - so nothing to do then!
+            pass
+        
+        df = pd.DataFrame(cols)
         # Time is naive UTC. Convert to WIB
-        df['dtime'] = df['dtime'] + pd.Timedelta(hours=7)
+        df.insert(0, 'dtime', pd.to_datetime(times) + pd.Timedelta(hours=7))
         if not meta.get('dtime', None):
             meta['dtime'] = df['dtime'].iloc[0]
         if not meta.get('sport', None):
@@ -1986,54 +4429,11 @@ class ZwiftTraining:
             meta['title'] = ''
         if not meta.get('src_file', None):
             meta['src_file'] = ''
-        
-        # Some adjustments
-        if len(df):
-            if 'timestamp' in records[0]:
-                if pd.isnull(df['latt'].iloc[0]):
-                    # Garmin .fit format on trainer.
-                    #This below is correct, but disabling this as we'll use general heuristic later
-                    #df['distance'] /= 1000
-                    pass
-                else:
-                    # Garmin .fit format with GPS
-                    if df['latt'].max() > 90 or df['latt'].min() < -90:
-                        df['latt'] *= 180/(2**31)
-                        df['long'] *= 180/(2**31)
-                    
-                    #Strava (or possibly Zwift) doesn't need this below
-                    #df['elevation'] /= 5
-                    
-                    # Clear distance. Some .fit files are in meters, some in km, some in cm
-                    #df['distance'] /= (100 * 1000)  # orginally in cm
-                    # Nope! Sometimes the GPS is messed up but the distance is good
-                    # (e.g. on trainer session with GPS on. Example: 1873571076.fit)
-                    #df['distance'] = np.NaN
-                    
-                # Some heuristic until we know the rule
-                max_dist = df['distance'].max()
-                if not pd.isnull(max_dist):
-                    if max_dist < 1000:
-                        # the distance is probably alright
-                        pass
-                    elif max_dist < 1000000:
-                        # in meters
-                        df['distance'] /= 1000
-                    else:
-                        # in cm
-                        df['distance'] /= 100000
-                    
-            elif 'time' in records[0]:
-                # Zwift .fit format:
-                # - latt and long is correct
-                # - distance is in km
-                # - elevation is in m
-                # - so nothing to do then!
-                pass
             
         # Hack
         if not meta['sport']:
-            if has_power or len(df[ df['speed'] > 20 ]) > 120:
+            has_power = not np.isnan(cols['power']).all()
+            if has_power or np.count_nonzero(cols['speed'] > 20) > 120:
                 meta['sport'] = 'cycling'
             else:
                 meta['sport'] = 'running'
@@ -2041,8 +4441,7 @@ class ZwiftTraining:
         return ZwiftTraining._process_activity(df, meta, copy=False)
 
     def _zwift_update_calories(self, start=0, max=0, batch=10):
-        player_id = self.zwift_profile['id']
-        activity_client = self.zwift_client.get_activity(player_id)
+        activity_client = self.zwift_activity_client
         
         calories_updates = {}
         
@@ -2064,58 +4463,42 @@ class ZwiftTraining:
                 calories_updates[meta['src_file']] = meta['calories']
                 start += 1
 
-        print(f'Updating {len(calories_updates)} activities')            
-        df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
-        for src_file, cal in calories_updates.items():
-            found = df[ df['src_file']==src_file ]
-            if not len(found):
-                print(f'Error: {src_file} not found')
-                continue
-            if len(found) > 1:
-                print(f'Warning: found {len(found)} rows for {src_file}')
-            df.loc[ found.index, 'calories' ] = cal
-            print(f'Row {found.index} updated')
+        self._update_calories(calories_updates)
         
-        df = df.sort_values('dtime')
-        df.to_csv(self.activity_file, index=False)
-
     def _update_tcx_calories(self, import_dir, start=0, max=0):
-        df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
+        df = self.catalog.df
         
         tcx_df = df[ df['src_file'].str.contains('.tcx') ]
         calories_updates = {}
         
         tcx_df = tcx_df.sort_values('dtime', ascending=False)
         
-        for idx, row in tcx_df.iterrows():
+        for idx, src_file in zip(tcx_df.index, tcx_df['src_file']):
             print(f'\rProcessing activity {idx}   ', end='')
             start -= 1
             if start >= 0:
                 continue
             
-            path = os.path.join(import_dir, row['src_file'])
+            path = os.path.join(import_dir, src_file)
             if os.path.exists(path):
-                _, meta = self.parse_tcx_file(path)
-                if not pd.isnull(meta['calories']) and meta['calories']:
-                    calories_updates[ row['src_file'] ] = meta['calories']
+                summary = self.scan_file_summary(path)
+                if not pd.isnull(summary['calories']) and summary['calories']:
+                    calories_updates[ src_file ] = summary['calories']
             
             if len(calories_updates) >= max:
                 break
             
-        print(f'Updating {len(calories_updates)} activities')            
-        df = pd.read_csv(self.activity_file, parse_dates=['dtime'])
-        for src_file, cal in calories_updates.items():
-            found = df[ df['src_file']==src_file ]
-            if not len(found):
-                print(f'Error: {src_file} not found')
-                continue
-            if len(found) > 1:
-                print(f'Warning: found {len(found)} rows for {src_file}')
-            df.loc[ found.index, 'calories' ] = cal
-            print(f'Row {found.index} updated')
+        self._update_calories(calories_updates)
         
-        df = df.sort_values('dtime')
-        df.to_csv(self.activity_file, index=False)
+    def _update_calories(self, calories_updates):
+        """
+        Update the calories of activities, from dict of src_file -> calories.
+        """
+        print(f'Updating {len(calories_updates)} activities')
+        updates = pd.DataFrame({'src_file': list(calories_updates.keys()), 
+                                'calories': list(calories_updates.values())})
+        for src_file in self.catalog.update(updates):
+            print(f'Error: {src_file} not found')
     
     @staticmethod
     def display_zwo(path, ftp, watt='watt'):